@@ -1,6 +1,283 @@
+import os
+import re
+import ast
+import sys
 import json
 import argparse
+import subprocess
+import sysconfig
+import importlib.util
+from typing import Dict, List, Tuple
 
+
+MODEL_UTILS_TAGS = ['input-data-ingestion', 'process', 'output-data-storing']
+APP_SCHEMAS_TAGS = ['api-schemas']
+PARAMETERS_TAGS = ['input-data-definition']
+
+
+# Auxiliar functions
+def _cell_tag(cell) -> str:
+    """
+    Returns the tag of a code cell ("# <tag> (DON'T REMOVE THIS COMMENT)"), or None. Non-breaking spaces are
+    accepted, they are usual in notebooks edited in a browser.
+    """
+    if cell['cell_type'] != 'code' or not cell['source']:
+        return None
+    match = re.match(r"#\s*([\w-]+)\s*\(DON'T REMOVE THIS COMMENT\)", cell['source'][0].replace('\xa0', ' '))
+    return match.group(1) if match else None
+
+
+def tagged_sources(notebook: Dict, tags: List[str]) -> List[str]:
+    return [''.join(cell['source']) for cell in notebook['cells'] if _cell_tag(cell) in tags]
+
+
+def is_light_module(module_name: str, local_dir: str='src') -> bool:
+    """
+    Returns True for the modules that are cheap to import at startup: the standard library and the local modules
+    of the component. The third-party dependencies (pandas, google.cloud...) are heavy.
+    """
+    top_level = module_name.split('.')[0]
+    if top_level in ('__future__', 'typing') or top_level in sys.builtin_module_names:
+        return True
+    if os.path.exists(os.path.join(local_dir, f'{top_level}.py')) or os.path.isdir(os.path.join(local_dir, top_level)):
+        return True
+    try:
+        spec = importlib.util.find_spec(top_level)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None or spec.origin is None:
+        return False
+    if spec.origin in ('built-in', 'frozen'):
+        return True
+    stdlib_dir = os.path.realpath(sysconfig.get_paths()['stdlib'])
+    origin = os.path.realpath(spec.origin)
+    return origin.startswith(stdlib_dir) and 'site-packages' not in origin and 'dist-packages' not in origin
+
+
+def _import_bindings(node) -> List[Tuple[str, str]]:
+    """
+    Returns the (bound name, import statement) of every name bound by an import node, e.g.
+    ('pd', 'import pandas as pd') or ('bigquery', 'from google.cloud import bigquery').
+    """
+    bindings = []
+    for alias in node.names:
+        if isinstance(node, ast.Import):
+            name = alias.asname or alias.name.split('.')[0]
+            statement = f'import {alias.name}' + (f' as {alias.asname}' if alias.asname else '')
+        else:
+            name = alias.asname or alias.name
+            module = '.' * node.level + (node.module or '')
+            statement = f'from {module} import {alias.name}' + (f' as {alias.asname}' if alias.asname else '')
+        bindings.append((name, statement))
+    return bindings
+
+
+def _module_level_names(tree) -> set:
+    """
+    Returns the names used when the module is imported: everything but the bodies of the functions and methods
+    (their decorators, annotations and defaults are evaluated at import time).
+    """
+    names = set()
+
+    def visit(node):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for child in node.decorator_list + node.args.defaults + [default for default in node.args.kw_defaults if default]:
+                visit(child)
+            for argument in node.args.posonlyargs + node.args.args + node.args.kwonlyargs + [node.args.vararg, node.args.kwarg]:
+                if argument is not None and argument.annotation is not None:
+                    visit(argument.annotation)
+            if node.returns is not None:
+                visit(node.returns)
+            return
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        for child in ast.iter_child_nodes(node):
+            visit(child)
+
+    for statement in tree.body:
+        if not isinstance(statement, (ast.Import, ast.ImportFrom)):
+            visit(statement)
+    return names
+
+
+def _functions(tree) -> List:
+    """
+    Returns the functions of the module and the methods of its classes.
+    """
+    functions = []
+    for statement in tree.body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions.append(statement)
+        elif isinstance(statement, ast.ClassDef):
+            functions += [child for child in statement.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    return functions
+
+
+def _function_arguments(function) -> set:
+    arguments = function.args.posonlyargs + function.args.args + function.args.kwonlyargs + [function.args.vararg, function.args.kwarg]
+    return {argument.arg for argument in arguments if argument is not None}
+
+
+def _merge_imports(statements: List[str]) -> List[str]:
+    """
+    Removes duplicated imports and merges the 'from x import a' of the same module in a single statement.
+    """
+    merged, from_names = [], {}
+    for statement in dict.fromkeys(statements):
+        match = re.match(r'from (\S+) import (.+)$', statement)
+        if not match:
+            merged.append(statement)
+        elif match.group(1) in from_names:
+            from_names[match.group(1)].append(match.group(2))
+        else:
+            from_names[match.group(1)] = [match.group(2)]
+            merged.append(match.group(1))
+    return [f'from {item} import {", ".join(from_names[item])}' if item in from_names else item for item in merged]
+
+
+def build_lazy_module(sources: List[str], local_dir: str='src') -> Tuple[str, List[str]]:
+    """
+    Joins the cells of a module and moves the imports of heavy dependencies into the functions that use them,
+    so they are imported on the first call of every stage function instead of at startup (Python caches them,
+    so the next calls only look them up). The imports of the standard library and of the local modules, and the
+    heavy imports used at import time (e.g. in annotations, defaults or module constants), stay at the top of the
+    module, without duplicates. The other statements of the cells are kept in order.
+
+    Returns:
+    - A tuple (source of the module, heavy imports deferred to the functions).
+    """
+    module_imports, import_blocks, deferred = [], [], {}
+    bodies = []
+    for source in sources:
+        tree = ast.parse(source)
+        lines = source.splitlines()
+        removed = set()
+        for node in tree.body:
+            # try/except blocks of imports (e.g. the local modules imported from src/) are kept once
+            if isinstance(node, ast.Try) and all(
+                isinstance(child, (ast.Import, ast.ImportFrom))
+                for child in node.body + [statement for handler in node.handlers for statement in handler.body]
+            ):
+                block_names = {name for child in node.body for name, _ in _import_bindings(child)}
+                import_blocks.append(('\n'.join(lines[node.lineno - 1:node.end_lineno]), block_names))
+                removed.update(range(node.lineno - 1, node.end_lineno))
+                continue
+            if not isinstance(node, (ast.Import, ast.ImportFrom)):
+                continue
+            removed.update(range(node.lineno - 1, node.end_lineno))
+            module_name = node.module if isinstance(node, ast.ImportFrom) else node.names[0].name
+            for name, statement in _import_bindings(node):
+                if (isinstance(node, ast.ImportFrom) and node.level) or is_light_module(module_name or '', local_dir):
+                    module_imports.append(statement)
+                else:
+                    deferred[name] = statement
+        bodies.append((tree, lines, removed))
+
+    # Heavy names used at import time can't be deferred
+    used_at_import = set()
+    for tree, _, _ in bodies:
+        used_at_import |= _module_level_names(tree)
+    for name in list(deferred):
+        if name in used_at_import:
+            module_imports.append(deferred.pop(name))
+
+    cells = []
+    for tree, lines, removed in bodies:
+        insertions = {}
+        for function in _functions(tree):
+            used_names = {node.id for node in ast.walk(function) if isinstance(node, ast.Name)}
+            statements = [deferred[name] for name in deferred if name in used_names and name not in _function_arguments(function)]
+            if not statements:
+                continue
+            body = function.body
+            has_docstring = isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], 'value', None), ast.Constant) and isinstance(body[0].value.value, str)
+            anchor = body[0].end_lineno if has_docstring and len(body) > 1 else body[0].lineno - 1
+            indentation = ' ' * (body[1] if has_docstring and len(body) > 1 else body[0]).col_offset
+            insertions[anchor] = [f'{indentation}{statement}' for statement in _merge_imports(statements)]
+
+        output_lines = []
+        for number, line in enumerate(lines):
+            output_lines += insertions.get(number, [])
+            if number not in removed:
+                output_lines.append(line)
+        cells.append('\n'.join(output_lines).strip('\n'))
+
+    # A block is dropped if its names are already imported by a previous one
+    kept_blocks, imported_names = [], set()
+    for block, block_names in import_blocks:
+        if not block_names <= imported_names:
+            kept_blocks.append(block)
+            imported_names |= block_names
+
+    header = _merge_imports(module_imports) + kept_blocks
+    source = '\n'.join(header) + '\n\n\n' + '\n\n\n'.join(cells) + '\n'
+    return source, sorted(set(deferred.values()))
+
+
+def _import_times(statements: List[str], cwd: str) -> List[Tuple[int, str, int]]:
+    """
+    Runs the imports in a new interpreter with -X importtime and returns its (depth, module, cumulative
+    microseconds) entries, in the order printed: the imports of a module are listed before it, one level deeper.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', '\n'.join(statements)],
+        cwd=cwd, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Error importing {statements}: {result.stderr.strip().splitlines()[-1]}")
+    entries = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)', line)
+        if match:
+            entries.append(((len(match.group(3)) - 1) // 2, match.group(4), int(match.group(2))))
+    return entries
+
+
+def _dependencies_ms(entries: List[Tuple[int, str, int]], depth: int) -> Dict[str, float]:
+    # Imports of the same top-level package (google.cloud, google.api_core...) are added up
+    times = {}
+    for entry_depth, module, microseconds in entries:
+        if entry_depth == depth:
+            package = module.split('.')[0]
+            times[package] = times.get(package, 0) + microseconds
+    return {package: round(microseconds / 1000, 1) for package, microseconds in sorted(times.items(), key=lambda item: -item[1])}
+
+
+def profile_imports(modules: List[str], deferred: List[str], src_dir: str='src', top: int=15) -> Dict:
+    """
+    Reports the import time by dependency of the generated modules, as paid at startup by main.py, and of the
+    deferred dependencies, paid by the first call of the stage functions that use them.
+    """
+    startup_modules = {module for _, module, _ in _import_times(['pass'], src_dir)}
+
+    def dependencies_report(statements: List[str], module: str=None) -> Dict:
+        try:
+            entries = _import_times(statements, src_dir)
+        except RuntimeError as e:
+            return {'error': str(e), 'total_ms': None, 'dependencies_ms': {}}
+        entries = [entry for entry in entries if entry[1] not in startup_modules]
+        if module is None:
+            dependencies = _dependencies_ms(entries, depth=0)
+            return {'total_ms': round(sum(dependencies.values()), 1), 'dependencies_ms': dependencies}
+        # The direct imports of the module are the entries one level deeper printed before it
+        position = next(index for index, entry in enumerate(entries) if entry[:2] == (0, module))
+        start = position
+        while start > 0 and entries[start - 1][0] > 0:
+            start -= 1
+        return {'total_ms': round(entries[position][2] / 1000, 1), 'dependencies_ms': _dependencies_ms(entries[start:position], depth=1)}
+
+    report = {module: dependencies_report([f'import {module}'], module) for module in modules}
+    if deferred:
+        report['deferred'] = dependencies_report(deferred)
+
+    for module, module_report in report.items():
+        print(f"{module}: {module_report['total_ms']} ms", module_report.get('error', ''))
+        for package, milliseconds in list(module_report['dependencies_ms'].items())[:top]:
+            print(f'    {package:<40} {milliseconds:>10} ms')
+    return report
+
+
+# Main functions
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -9,42 +286,37 @@ if __name__ == "__main__":
         type=str,
         required=True
     )
+    parser.add_argument(
+        '--eager_imports',
+        help='Keep the imports of every cell at the top of model_utils.py, as they are written in the notebook.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--profile-imports',
+        help='Report the import time by dependency of the generated model_utils, app_schemas and parameters modules.',
+        dest='profile_imports',
+        action='store_true',
+    )
     args = parser.parse_args()
-    
+
     data = json.load(open(f'{args.notebook_name}.ipynb'))
 
-    python_script_file = open("./src/model_utils.py", "w")
-
-    for cell in data['cells']:
-        if cell['cell_type']=='code' and cell['source']:
-            if "# input-data-ingestion (DON'T REMOVE THIS COMMENT)" in cell['source'][0]:
-                python_script_file.write(''.join(cell['source']))
-                python_script_file.write('\n\n')
-            if "# process (DON'T REMOVE THIS COMMENT)" in cell['source'][0]:
-                python_script_file.write(''.join(cell['source']))
-                python_script_file.write('\n\n')
-            if "# output-data-storing (DON'T REMOVE THIS COMMENT)" in cell['source'][0]:
-                python_script_file.write(''.join(cell['source']))
-                python_script_file.write('\n\n')
-
-    python_script_file.close()
-    
-    python_script_file = open("./src/app_schemas.py", "w")
-
-    for cell in data['cells']:
-        if cell['cell_type']=='code' and cell['source']:
-            if "# api-schemas (DON'T REMOVE THIS COMMENT)" in cell['source'][0]:
-                python_script_file.write(''.join(cell['source']))
-                python_script_file.write('\n\n')
-
-    python_script_file.close()
-    
-    python_script_file = open("./src/parameters.py", "w")
-
-    for cell in data['cells']:
-        if cell['cell_type']=='code' and cell['source']:
-            if "# input-data-definition (DON'T REMOVE THIS COMMENT)" in cell['source'][0]:
-                python_script_file.write(''.join(cell['source']))
-                python_script_file.write('\n\n')
-
-    python_script_file.close()
\ No newline at end of file
+    # Heavy dependencies are imported by the stage functions that use them, so the app starts without them
+    model_utils_sources = tagged_sources(data, MODEL_UTILS_TAGS)
+    if args.eager_imports:
+        model_utils, deferred = '\n\n'.join(model_utils_sources) + '\n', []
+    else:
+        model_utils, deferred = build_lazy_module(model_utils_sources, local_dir='src')
+    with open("./src/model_utils.py", "w") as python_script_file:
+        python_script_file.write(model_utils)
+
+    with open("./src/app_schemas.py", "w") as python_script_file:
+        python_script_file.write('\n\n'.join(tagged_sources(data, APP_SCHEMAS_TAGS)) + '\n')
+
+    with open("./src/parameters.py", "w") as python_script_file:
+        python_script_file.write('\n\n'.join(tagged_sources(data, PARAMETERS_TAGS)) + '\n')
+
+    if deferred:
+        print('Imports deferred to the stage functions:', ', '.join(deferred))
+    if args.profile_imports:
+        profile_imports(['model_utils', 'app_schemas', 'parameters'], deferred, src_dir='src')
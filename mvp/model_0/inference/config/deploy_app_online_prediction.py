@@ -1,9 +1,15 @@
 from typing import Dict, Optional, Sequence, Tuple
 import argparse
+import json
 
 from google.cloud import aiplatform
 from google.cloud.aiplatform import explain
 
+try:
+    from plan_online_capacity import load_capacity_curves, plan_online_capacity
+except ImportError:
+    from config.plan_online_capacity import load_capacity_curves, plan_online_capacity
+
 
 def upload_model_sample(
     project: str,
@@ -100,11 +106,15 @@ def deploy_model_with_dedicated_resources_sample(
     explanation_parameters: Optional[explain.ExplanationParameters] = None,
     metadata: Optional[Sequence[Tuple[str, str]]] = (),
     sync: bool = True,
+    autoscaling_target_cpu_utilization: Optional[int] = None,
+    autoscaling_target_accelerator_duty_cycle: Optional[int] = None,
 ):
     """
     model_name: A fully-qualified model resource name or model ID.
           Example: "projects/123/locations/us-central1/models/456" or
           "456" when project and location are initialized or passed.
+    autoscaling_target_cpu_utilization / autoscaling_target_accelerator_duty_cycle: Utilization (percentage) that
+          the autoscaler keeps in every replica between min_replica_count and max_replica_count. Default: 60.
     """
 
     aiplatform.init(project=project, location=location, staging_bucket=staging_bucket)
@@ -125,6 +135,8 @@ def deploy_model_with_dedicated_resources_sample(
         metadata=metadata,
         sync=sync,
         service_account=service_account,
+        autoscaling_target_cpu_utilization=autoscaling_target_cpu_utilization,
+        autoscaling_target_accelerator_duty_cycle=autoscaling_target_accelerator_duty_cycle,
     )
 
     model.wait()
@@ -134,6 +146,39 @@ def deploy_model_with_dedicated_resources_sample(
     return model
 
 
+def plan_dedicated_resources(
+    capacity_curves_path: str,
+    target_peak_rps: float,
+    p99_slo_ms: float,
+    base_rps: float = 0.0,
+    target_headroom: float = 0.2,
+    min_replica_count: int = 1,
+) -> Dict:
+    """
+    Plans the dedicated resources of the deployment from the capacity curves measured on one replica of the app
+    (see config/plan_online_capacity.py) and returns them as arguments of deploy_model_with_dedicated_resources_sample:
+    machine_type, accelerator_type, accelerator_count, min_replica_count, max_replica_count and the autoscaling target.
+    """
+    plan = plan_online_capacity(
+        load_capacity_curves(capacity_curves_path),
+        target_peak_rps=target_peak_rps,
+        p99_slo_ms=p99_slo_ms,
+        base_rps=base_rps,
+        target_headroom=target_headroom,
+        min_replica_count=min_replica_count,
+    )
+    print(json.dumps({key: value for key, value in plan.items() if key != 'candidates'}, indent=2))
+    return {
+        'machine_type': plan['machine_type'],
+        'accelerator_type': plan['accelerator_type'],
+        'accelerator_count': plan['accelerator_count'],
+        'min_replica_count': plan['min_replica_count'],
+        'max_replica_count': plan['max_replica_count'],
+        'autoscaling_target_cpu_utilization': plan.get('autoscaling_target_cpu_utilization'),
+        'autoscaling_target_accelerator_duty_cycle': plan.get('autoscaling_target_accelerator_duty_cycle'),
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -192,9 +237,9 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         '--cpu_machine_name',
-        help='The type of machine.',
+        help='The type of machine. Required if --capacity_curves_path is not used.',
         type=str,
-        required=True
+        default=None
     )
     parser.add_argument(
         '--gpu_machine_name',
@@ -220,6 +265,47 @@ if __name__ == "__main__":
         type=int, 
         default=8080
     )
+    parser.add_argument(
+        "--capacity_curves_path",
+        help="Capacity curves measured on one replica of the app (see config/plan_online_capacity.py). If it is provided, the machine, the replica bounds and the autoscaling target are planned from them.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--target_peak_rps",
+        help="Peak requests per second that the endpoint must serve. Required with --capacity_curves_path.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--p99_slo_ms",
+        help="p99 latency SLO in milliseconds. Required with --capacity_curves_path.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--base_rps",
+        help="Off-peak requests per second, it sets the minimum number of replicas. Default: 0.",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        "--target_headroom",
+        help="Fraction of the throughput at the SLO kept free in every replica. Default: 0.2.",
+        type=float,
+        default=0.2
+    )
+    parser.add_argument(
+        "--min_replica_count",
+        help="Minimum number of replicas (lower bound of the planned one). Default: 1.",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--plan_only",
+        help="Print the planned resources and exit without uploading or deploying the model.",
+        action='store_true'
+    )
     
     args = parser.parse_args()
     
@@ -227,6 +313,31 @@ if __name__ == "__main__":
     if args.gpu_machine_name or args.gpu_machine_cores:
         if args.gpu_machine_name is None or args.gpu_machine_cores is None:
             raise ValueError('If you need GPU you have to set a value for "gpu_cores" and "gpu_type"')
+
+    if args.capacity_curves_path:
+        if args.target_peak_rps is None or args.p99_slo_ms is None:
+            raise ValueError('If you plan the capacity you have to set a value for "target_peak_rps" and "p99_slo_ms"')
+        dedicated_resources = plan_dedicated_resources(
+            capacity_curves_path=args.capacity_curves_path,
+            target_peak_rps=args.target_peak_rps,
+            p99_slo_ms=args.p99_slo_ms,
+            base_rps=args.base_rps,
+            target_headroom=args.target_headroom,
+            min_replica_count=args.min_replica_count,
+        )
+    else:
+        if args.cpu_machine_name is None:
+            raise ValueError('You have to set a value for "cpu_machine_name" or the capacity curves in "capacity_curves_path"')
+        dedicated_resources = {
+            'machine_type': args.cpu_machine_name,
+            'accelerator_type': args.gpu_machine_name,
+            'accelerator_count': args.gpu_machine_cores,
+            'min_replica_count': args.min_replica_count,
+            'max_replica_count': args.min_replica_count,
+        }
+    if args.plan_only:
+        print(dedicated_resources)
+        raise SystemExit(0)
     
     serving_container_ports=[args.container_port]
     serving_container_args=[f'--app_port={args.app_port}']
@@ -276,9 +387,7 @@ if __name__ == "__main__":
         project=args.project_id,
         location=args.location,
         service_account=args.service_account,
-        machine_type=args.cpu_machine_name,
-        accelerator_type=args.gpu_machine_name,
-        accelerator_count=args.gpu_machine_cores,
         model=model,
-        endpoint=endpoint
+        endpoint=endpoint,
+        **dedicated_resources,
     )
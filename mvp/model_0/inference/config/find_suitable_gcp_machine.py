@@ -1,16 +1,68 @@
+import os
+import json
+import math
 import warnings
 import argparse
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+
+# Catalog shared by every component of the model
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'gcp_machine_catalog.json')
+
+
+class MachineCatalog:
+    """
+    Read-only index of the GCP machine types. Machines are sorted by (ram, cpu) and indexed by name, and the
+    GPU configurations supported by every machine are indexed by GPU type. The catalog is loaded only once per
+    path and its entries are never modified by the search functions.
+    """
+
+    def __init__(self, machines: List[Dict], gpus: Dict):
+        self.machines = tuple(sorted(machines, key=lambda machine: (machine['ram'], machine['cpu'])))
+        self.machines_by_name = {machine['name']: machine for machine in self.machines}
+        self.gpu_cores_by_machine = {
+            machine['name']: {gpu['name']: tuple(sorted(gpu['gpu_cores'])) for gpu in machine.get('supported_gpu_machines', [])}
+            for machine in self.machines
+        }
+        self.gpu_prices = {gpu_name: gpu['hourly_price_usd'] for gpu_name, gpu in gpus.items()}
+
+    def supports_gpu(self, machine: Dict, gpu_type: str=None) -> bool:
+        supported_gpus = self.gpu_cores_by_machine[machine['name']]
+        return bool(supported_gpus) if gpu_type is None else gpu_type in supported_gpus
+
+    def hourly_price(self, machine: Dict, gpu_type: str=None, gpu_cores: int=None) -> float:
+        price = machine.get('hourly_price_usd', 0.0)
+        if gpu_type:
+            price += self.gpu_prices.get(gpu_type, 0.0) * gpu_cores
+        return round(price, 4)
+
+
+@lru_cache(maxsize=None)
+def load_machine_catalog(catalog_path: str=DEFAULT_CATALOG_PATH) -> MachineCatalog:
+    with open(catalog_path) as catalog_file:
+        catalog = json.load(catalog_file)
+    return MachineCatalog(catalog['machines'], catalog.get('gpus', {}))
+
+
+def _select_gpu_cores(supported_gpu_cores: Tuple[int], selected_gpu_cores: int) -> Tuple[int, bool]:
+    """Returns the smallest supported number of GPU cores that covers the request and if it was covered."""
+    compatible_gpus_with_cores = [gpu_cores for gpu_cores in supported_gpu_cores if gpu_cores >= selected_gpu_cores]
+    if compatible_gpus_with_cores:
+        return min(compatible_gpus_with_cores), True
+    return max(supported_gpu_cores), False
 
 
 def find_suitable_gcp_machine(
-    selected_cpu_cores: int, 
-    selected_ram_gb: int, 
-    selected_gpu_cores: int=None, 
-    selected_gpu_type: str=None
+    selected_cpu_cores: int,
+    selected_ram_gb: int,
+    selected_gpu_cores: int=None,
+    selected_gpu_type: str=None,
+    catalog_path: str=DEFAULT_CATALOG_PATH,
 ):
     """
     This function selects an appropriate Google Cloud Platform (GCP) machine type based on specified CPU cores,
-    RAM, and optionally, GPU requirements. It checks against a predefined list of GCP machine types, each with
+    RAM, and optionally, GPU requirements. It checks against the shared catalog of GCP machine types, each with
     its own CPU, RAM, and supported GPU configurations. The function ensures compatibility and returns the most
     suitable machine configuration. It performs validation for GPU requirements and raises warnings if the
     exact requested resources are not available, suggesting the closest alternatives.
@@ -20,6 +72,7 @@ def find_suitable_gcp_machine(
     - selected_ram_gb (int): Amount of RAM required in gigabytes.
     - selected_gpu_cores (int, optional): Number of GPU cores required, to be provided with selected_gpu_type.
     - selected_gpu_type (str, optional): Type of GPU required, to be provided with selected_gpu_cores.
+    - catalog_path (str, optional): Path of the machine catalog. Default: the catalog shared by every component.
 
     Returns:
     - A dictionary containing the closest matching machine type for the requested CPU and RAM specifications.
@@ -30,155 +83,293 @@ def find_suitable_gcp_machine(
     - ValueError: If only one of gpu_cores or gpu_type is provided without the other.
     - ValueError: If the specified gpu_type is not compatible with the selected CPU and RAM configuration.
     """
-        
-    # Extended list of machine types
-    machine_types = [
-        {"name": "n1-standard-4", "cpu": 4, "ram": 15,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [1, 2, 4]}, 
-             {"name": "NVIDIA_TESLA_K80", "gpu_cores": [1, 2, 4, 8]}, 
-             {"name": "NVIDIA_TESLA_P100", "gpu_cores": [1, 2, 4]},
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [1, 2, 4, 8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [1, 2, 4]}
-         ]
-        },
-        {"name": "n1-standard-8", "cpu": 8, "ram": 30,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [1, 2, 4]}, 
-             {"name": "NVIDIA_TESLA_K80", "gpu_cores": [1, 2, 4, 8]}, 
-             {"name": "NVIDIA_TESLA_P100", "gpu_cores": [1, 2, 4]},
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [1, 2, 4, 8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [1, 2, 4]}
-         ]
-        },
-        {"name": "n1-standard-16", "cpu": 16, "ram": 60,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [1, 2, 4]}, 
-             {"name": "NVIDIA_TESLA_K80", "gpu_cores": [2, 4, 8]}, 
-             {"name": "NVIDIA_TESLA_P100", "gpu_cores": [1, 2, 4]},
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [2, 4, 8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [1, 2, 4]}
-         ]
-        },
-        {"name": "n1-standard-32", "cpu": 32, "ram": 120,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [2, 4]}, 
-             {"name": "NVIDIA_TESLA_K80", "gpu_cores": [4, 8]}, 
-             {"name": "NVIDIA_TESLA_P100", "gpu_cores": [2, 4]},
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [4, 8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [2, 4]}
-         ]
-        },
-        {"name": "n1-standard-64", "cpu": 64, "ram": 240,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [4]}, 
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [4]}
-         ]
-        },
-        {"name": "n1-standard-96", "cpu": 96, "ram": 360,
-         "supported_gpu_machines": [
-             {"name": "NVIDIA_TESLA_T4", "gpu_cores": [4]}, 
-             {"name": "NVIDIA_TESLA_V100", "gpu_cores": [8]},
-             {"name": "NVIDIA_TESLA_P4", "gpu_cores": [4]}
-         ]
-        },
-        {"name": "n1-highmem-2", "cpu": 2, "ram": 13},
-        {"name": "n1-highmem-4", "cpu": 4, "ram": 26},
-        {"name": "n1-highmem-8", "cpu": 8, "ram": 52},
-        {"name": "n1-highmem-16", "cpu": 16, "ram": 104},
-        {"name": "n1-highmem-32", "cpu": 32, "ram": 208},
-        {"name": "n1-highmem-64", "cpu": 64, "ram": 416},
-        {"name": "n1-highmem-96", "cpu": 96, "ram": 624}
-    ]
+    catalog = load_machine_catalog(catalog_path)
 
     warning_message = ''
-    
-    # Find the machine type closest to the requested CPU and RAM
-    closest_machine = [machine for machine in machine_types if machine['ram'] >= selected_ram_gb and machine['cpu'] >= selected_cpu_cores and (("supported_gpu_machines" in machine and selected_gpu_type) or not selected_gpu_type)]
-    if closest_machine:
-        closest_machine = min(closest_machine, key=lambda x: (x['ram'], x['cpu']))
-    else:
-        closest_machine = max(machine_types, key=lambda x: (bool(("supported_gpu_machines" in x and selected_gpu_type) or not selected_gpu_type), x['ram']))
+
+    # Find the machine type closest to the requested CPU and RAM (machines are sorted by ram and cpu)
+    closest_machine = next(
+        (machine for machine in catalog.machines
+         if machine['ram'] >= selected_ram_gb and machine['cpu'] >= selected_cpu_cores and (catalog.supports_gpu(machine) or not selected_gpu_type)),
+        None
+    )
+    if closest_machine is None:
+        closest_machine = max(catalog.machines, key=lambda x: (bool(catalog.supports_gpu(x) or not selected_gpu_type), x['ram']))
         warning_message = 'CPU error: there are no machines with the specified cores and ram. It will be used lower values.\n'
-        
-    closest_machine['cpu_machine_name'] = closest_machine.pop('name')
-    closest_machine['cpu_machine_cores'] = closest_machine.pop('cpu')
-    closest_machine['cpu_machine_ram'] = closest_machine.pop('ram')
-            
+
+    suitable_machine = {
+        'cpu_machine_name': closest_machine['name'],
+        'cpu_machine_cores': closest_machine['cpu'],
+        'cpu_machine_ram': closest_machine['ram'],
+    }
+
     # Find the machine type closest to the requested GPU
     if selected_gpu_type:
-        # selected_gpu_type must be in the supported gpu machines by closest cpu machine 
-        if selected_gpu_type not in set([gpu_machine['name'] for gpu_machine in closest_machine['supported_gpu_machines']]):
-            raise ValueError(f"GPU Type was not found or {selected_gpu_type} is not available for the specified CPU and RAM. It could be {list(set([gpu_machine['name'] for gpu_machine in closest_machine['supported_gpu_machines']]))}") 
-        
-        # Select supported gpu machines by closest cpu machine 
-        closest_machine_supported_gpu_machines = closest_machine["supported_gpu_machines"]
-        compatible_gpus_with_type = [gpu for gpu in closest_machine_supported_gpu_machines if gpu['name'] == selected_gpu_type][0]
-            
+        # selected_gpu_type must be in the supported gpu machines by closest cpu machine
+        supported_gpu_machines = catalog.gpu_cores_by_machine[closest_machine['name']]
+        if selected_gpu_type not in supported_gpu_machines:
+            raise ValueError(f"GPU Type was not found or {selected_gpu_type} is not available for the specified CPU and RAM. It could be {list(supported_gpu_machines)}")
+
         # Find the machine type closest to the requested GPU cores
-        compatible_gpus_with_cores = [gpu_cores for gpu_cores in compatible_gpus_with_type['gpu_cores'] if gpu_cores >= selected_gpu_cores]
-        if compatible_gpus_with_cores:
-            compatible_gpus_with_cores = min(compatible_gpus_with_cores)
-        else:
-            compatible_gpus_with_cores = max(compatible_gpus_with_type['gpu_cores'])
+        compatible_gpus_with_cores, is_covered = _select_gpu_cores(supported_gpu_machines[selected_gpu_type], selected_gpu_cores)
+        if not is_covered:
             warning_message = warning_message+'GPU error: there are no machines with the specified cores. It will be used a lower value.\n'
 
+        suitable_machine['gpu_machine_name'] = selected_gpu_type
+        suitable_machine['gpu_machine_cores'] = compatible_gpus_with_cores
 
-        closest_machine['gpu_machine_name'] = compatible_gpus_with_type['name']
-        closest_machine['gpu_machine_cores'] = compatible_gpus_with_cores
-        closest_machine.pop('supported_gpu_machines')
-        
-    # Drop supported_gpu_machines
-    if "supported_gpu_machines" in closest_machine:
-        closest_machine.pop('supported_gpu_machines')
-        
-    # warning message to report changes to resource values
+    # warning message to report changes to resource values
     if warning_message:
         warnings.warn(warning_message)
 
-    return closest_machine
+    return suitable_machine
+
+
+def load_resource_profile(profile_path: str, profile_version: str=None) -> Dict:
+    """
+    Loads a resource profile measured in a local dry run. It accepts the stage profiling report of the training
+    component (tests/stage_profiling_metrics.json, the 'total' measures of 'profile_version' or of the latest
+    version are used) or a plain JSON with the keys 'peak_rss_bytes', 'cpu_utilization' and 'wall_time_seconds'.
+    """
+    with open(profile_path) as profile_file:
+        profile = json.load(profile_file)
+
+    if 'peak_rss_bytes' not in profile:
+        if profile_version is None:
+            profile_version = max(profile, key=lambda version: profile[version].get('generated_at', ''))
+        profile = profile[profile_version]['total']
+
+    return {
+        'peak_rss_gb': profile['peak_rss_bytes'] / 1024 ** 3,
+        'cpu_utilization': profile['cpu_utilization'],
+        'elapsed_seconds': profile['wall_time_seconds'],
+    }
+
+
+def recommend_gcp_machine_from_profile(
+    peak_rss_gb: float,
+    cpu_utilization: float,
+    elapsed_seconds: float,
+    sample_size: int,
+    full_size: int,
+    selected_gpu_cores: int=None,
+    selected_gpu_type: str=None,
+    target_headroom: float=0.2,
+    max_elapsed_hours: float=None,
+    memory_overhead_gb: float=0.0,
+    catalog_path: str=DEFAULT_CATALOG_PATH,
+) -> Dict:
+    """
+    This function recommends the cheapest GCP machine (and GPU) configuration for a full-size run based on the
+    resources measured in a local dry run on a sample. The measures are extrapolated linearly with the data size:
+    the memory above 'memory_overhead_gb' (interpreter, libraries and model) grows with the number of rows, and so
+    does the CPU time. The CPU cores are the cores that the dry run kept busy, increased when the extrapolated
+    elapsed time exceeds 'max_elapsed_hours'. The selected machine keeps at least 'target_headroom' of its RAM and
+    cores free over the expected peak.
+
+    Parameters:
+    - peak_rss_gb (float): Peak resident memory of the dry run in gigabytes.
+    - cpu_utilization (float): CPU time divided by wall time of the dry run (1.0 means one busy core).
+    - elapsed_seconds (float): Wall time of the dry run in seconds.
+    - sample_size (int): Number of rows (or any size unit) used in the dry run.
+    - full_size (int): Number of rows (in the same unit) of the full run.
+    - selected_gpu_cores (int, optional): Number of GPU cores required. If it is provided without
+      selected_gpu_type, the cheapest GPU type is selected.
+    - selected_gpu_type (str, optional): Type of GPU required.
+    - target_headroom (float): Fraction of RAM and cores that must stay free at the expected peak. Default: 0.2.
+    - max_elapsed_hours (float, optional): Maximum expected duration of the full run.
+    - memory_overhead_gb (float): Memory of the dry run that does not depend on the data size. Default: 0.
+    - catalog_path (str, optional): Path of the machine catalog. Default: the catalog shared by every component.
+
+    Returns:
+    - A dictionary with the recommended machine (cpu_machine_name, cpu_machine_cores, cpu_machine_ram and, if
+      GPUs are required, gpu_machine_name and gpu_machine_cores), its hourly price, the expected resources of the
+      full run and the expected headroom of RAM and cores.
+
+    Raises:
+    - ValueError: If the sizes are not positive or the target headroom is not in [0, 1).
+    - ValueError: If the specified gpu_type is not available in any machine.
+    """
+    if sample_size <= 0 or full_size <= 0:
+        raise ValueError('sample_size and full_size must be positive')
+    if not 0 <= target_headroom < 1:
+        raise ValueError('target_headroom must be in [0, 1)')
+
+    catalog = load_machine_catalog(catalog_path)
+    warning_message = ''
+
+    # Extrapolate the dry run to the full data size
+    scale = full_size / sample_size
+    expected_ram_gb = memory_overhead_gb + max(peak_rss_gb - memory_overhead_gb, 0.0) * scale
+    expected_cpu_cores = max(cpu_utilization, 1.0)
+    expected_elapsed_seconds = elapsed_seconds * scale
+    if max_elapsed_hours and expected_elapsed_seconds > max_elapsed_hours * 3600:
+        # Assume the work parallelizes over more cores to fit in the maximum elapsed time
+        expected_cpu_cores = expected_cpu_cores * expected_elapsed_seconds / (max_elapsed_hours * 3600)
+        expected_elapsed_seconds = max_elapsed_hours * 3600
+
+    required_ram_gb = expected_ram_gb / (1 - target_headroom)
+    required_cpu_cores = expected_cpu_cores / (1 - target_headroom)
+
+    # Every machine and GPU combination that can be used
+    gpu_required = bool(selected_gpu_type or selected_gpu_cores)
+    candidates = []
+    for machine in catalog.machines:
+        if not gpu_required:
+            candidates.append((machine, None, None, True))
+            continue
+        for gpu_type, supported_gpu_cores in catalog.gpu_cores_by_machine[machine['name']].items():
+            if selected_gpu_type and gpu_type != selected_gpu_type:
+                continue
+            gpu_cores, is_covered = _select_gpu_cores(supported_gpu_cores, selected_gpu_cores or 1)
+            candidates.append((machine, gpu_type, gpu_cores, is_covered))
+    if not candidates:
+        raise ValueError(f"GPU Type {selected_gpu_type} was not found in the machine catalog. It could be {sorted(catalog.gpu_prices)}")
+
+    # Cheapest combination with enough resources, or the largest one if there isn't any
+    suitable_candidates = [candidate for candidate in candidates
+                           if candidate[0]['ram'] >= required_ram_gb and candidate[0]['cpu'] >= required_cpu_cores and candidate[3]]
+    if suitable_candidates:
+        machine, gpu_type, gpu_cores, _ = min(
+            suitable_candidates,
+            key=lambda candidate: (catalog.hourly_price(*candidate[:3]), candidate[0]['ram'], candidate[0]['cpu'])
+        )
+    else:
+        machine, gpu_type, gpu_cores, _ = max(candidates, key=lambda candidate: (candidate[3], candidate[0]['ram'], candidate[0]['cpu']))
+        warning_message = 'Profile error: there are no machines with the expected resources and headroom. The largest machine will be used.\n'
+
+    recommendation = {
+        'cpu_machine_name': machine['name'],
+        'cpu_machine_cores': machine['cpu'],
+        'cpu_machine_ram': machine['ram'],
+    }
+    if gpu_type:
+        recommendation['gpu_machine_name'] = gpu_type
+        recommendation['gpu_machine_cores'] = gpu_cores
+    recommendation.update({
+        'hourly_price_usd': catalog.hourly_price(machine, gpu_type, gpu_cores),
+        'expected_peak_ram_gb': round(expected_ram_gb, 2),
+        'expected_cpu_cores': round(expected_cpu_cores, 2),
+        'expected_elapsed_hours': round(expected_elapsed_seconds / 3600, 3),
+        'expected_cost_usd': round(catalog.hourly_price(machine, gpu_type, gpu_cores) * math.ceil(expected_elapsed_seconds / 60) / 60, 4),
+        'ram_headroom': round(1 - expected_ram_gb / machine['ram'], 3),
+        'cpu_headroom': round(1 - expected_cpu_cores / machine['cpu'], 3),
+    })
+
+    # warning message to report changes to resource values
+    if warning_message:
+        warnings.warn(warning_message)
+
+    return recommendation
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--cpu_cores',
-        help='Number of CPU cores required.',
+        help='Number of CPU cores required. Required if --profile_path is not used.',
         type=int,
-        required=True
+        default=None
     )
     parser.add_argument(
         "--ram_gb",
-        help="Amount of RAM required in gigabytes.",
+        help="Amount of RAM required in gigabytes. Required if --profile_path is not used.",
         type=int,
-        required=True,
+        default=None,
     )
     parser.add_argument(
-        "--gpu_cores", 
-        help="Number of GPU cores required, to be provided with selected_gpu_type.", 
-        type=int, 
+        "--gpu_cores",
+        help="Number of GPU cores required, to be provided with selected_gpu_type.",
+        type=int,
         default=None
     )
     parser.add_argument(
-        "--gpu_type", 
-        help="Type of GPU required, to be provided with selected_gpu_cores.", 
-        type=str, 
+        "--gpu_type",
+        help="Type of GPU required, to be provided with selected_gpu_cores.",
+        type=str,
         default=None
     )
-    
-    args = parser.parse_args()
-    
-    # gpu_cores and gpu_type must have value both or neither
-    if args.gpu_cores or args.gpu_type:
-        if args.gpu_cores is None or args.gpu_type is None:
-            raise ValueError('If you need GPU you have to set a value for "gpu_cores" and "gpu_type"')
-    
-    closest_machine = find_suitable_gcp_machine(
-        args.cpu_cores, 
-        args.ram_gb, 
-        args.gpu_cores, 
-        args.gpu_type
+    parser.add_argument(
+        "--profile_path",
+        help="Resource profile measured in a local dry run on a sample (e.g. tests/stage_profiling_metrics.json). If it is provided, the machine is recommended from the profile.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--profile_version",
+        help="Version of the stage profiling report to use. Default: the latest one.",
+        type=str,
+        default=None
     )
+    parser.add_argument(
+        "--sample_size",
+        help="Number of rows used in the dry run.",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--full_size",
+        help="Number of rows of the full run.",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--target_headroom",
+        help="Fraction of RAM and cores that must stay free at the expected peak. Default: 0.2.",
+        type=float,
+        default=0.2
+    )
+    parser.add_argument(
+        "--max_elapsed_hours",
+        help="Maximum expected duration of the full run in hours.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--memory_overhead_gb",
+        help="Memory of the dry run that does not depend on the data size, in gigabytes. Default: 0.",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        "--catalog_path",
+        help="Path of the machine catalog. Default: the catalog shared by every component.",
+        type=str,
+        default=DEFAULT_CATALOG_PATH
+    )
+
+    args = parser.parse_args()
+
+    if args.profile_path:
+        if args.sample_size is None or args.full_size is None:
+            raise ValueError('If you use a resource profile you have to set a value for "sample_size" and "full_size"')
+
+        closest_machine = recommend_gcp_machine_from_profile(
+            **load_resource_profile(args.profile_path, args.profile_version),
+            sample_size=args.sample_size,
+            full_size=args.full_size,
+            selected_gpu_cores=args.gpu_cores,
+            selected_gpu_type=args.gpu_type,
+            target_headroom=args.target_headroom,
+            max_elapsed_hours=args.max_elapsed_hours,
+            memory_overhead_gb=args.memory_overhead_gb,
+            catalog_path=args.catalog_path,
+        )
+    else:
+        if args.cpu_cores is None or args.ram_gb is None:
+            raise ValueError('You have to set a value for "cpu_cores" and "ram_gb" or a resource profile in "profile_path"')
+
+        # gpu_cores and gpu_type must have value both or neither
+        if args.gpu_cores or args.gpu_type:
+            if args.gpu_cores is None or args.gpu_type is None:
+                raise ValueError('If you need GPU you have to set a value for "gpu_cores" and "gpu_type"')
+
+        closest_machine = find_suitable_gcp_machine(
+            args.cpu_cores,
+            args.ram_gb,
+            args.gpu_cores,
+            args.gpu_type,
+            args.catalog_path,
+        )
 
     print(closest_machine)
@@ -0,0 +1,370 @@
+import os
+import json
+import math
+import time
+import argparse
+import threading
+import urllib.request
+from typing import Dict, List
+
+try:
+    from find_suitable_gcp_machine import DEFAULT_CATALOG_PATH, load_machine_catalog
+except ImportError:
+    from config.find_suitable_gcp_machine import DEFAULT_CATALOG_PATH, load_machine_catalog
+
+
+# Autoscaling targets accepted by Vertex AI Online Prediction (percentage of CPU utilization or accelerator duty cycle)
+MIN_AUTOSCALING_TARGET = 10
+MAX_AUTOSCALING_TARGET = 100
+
+
+# Auxiliar functions
+def _interpolate(points: List[Dict], x_key: str, y_key: str, x: float) -> float:
+    """Returns the value of 'y_key' at 'x' by linear interpolation of the points (sorted by 'x_key')."""
+    points = [point for point in points if point.get(y_key) is not None]
+    if not points:
+        return None
+    if x <= points[0][x_key]:
+        return points[0][y_key]
+    for previous_point, point in zip(points, points[1:]):
+        if x <= point[x_key]:
+            if point[x_key] == previous_point[x_key]:
+                return point[y_key]
+            weight = (x - previous_point[x_key]) / (point[x_key] - previous_point[x_key])
+            return previous_point[y_key] + weight * (point[y_key] - previous_point[y_key])
+    return points[-1][y_key]
+
+
+def _slo_rps(points: List[Dict], p99_slo_ms: float) -> float:
+    """
+    Returns the highest throughput of a replica whose p99 latency stays within the SLO: the throughput where the
+    latency curve crosses the SLO (linear interpolation), or the highest measured throughput if it never does. It
+    is 0 if the SLO is missed at the lowest measured load.
+    """
+    if points[0]['p99_ms'] > p99_slo_ms:
+        return 0.0
+    for previous_point, point in zip(points, points[1:]):
+        if point['p99_ms'] > p99_slo_ms:
+            weight = (p99_slo_ms - previous_point['p99_ms']) / (point['p99_ms'] - previous_point['p99_ms'])
+            return previous_point['rps'] + weight * (point['rps'] - previous_point['rps'])
+    return points[-1]['rps']
+
+
+def _autoscaling_target(points: List[Dict], utilization_key: str, rps: float) -> int:
+    """
+    Returns the utilization (percentage) of a replica serving 'rps', the autoscaling target that keeps every
+    replica at that throughput. If the curve has no utilization measures, it is estimated as the share of the
+    saturation throughput (the highest measured one).
+    """
+    utilization = _interpolate(points, 'rps', utilization_key, rps)
+    if utilization is None:
+        utilization = rps / max(point['rps'] for point in points)
+    return min(max(round(utilization * 100), MIN_AUTOSCALING_TARGET), MAX_AUTOSCALING_TARGET)
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(int(math.ceil(percentile / 100 * len(values))) - 1, len(values) - 1)] if values else None
+
+
+# Main functions
+def load_capacity_curves(curves_path: str) -> List[Dict]:
+    """
+    Loads the capacity curves of the serving app measured on one replica. The file is a JSON with a list 'curves',
+    one by machine configuration:
+
+        {"curves": [{"machine_type": "n1-standard-4", "accelerator_type": null, "accelerator_count": null,
+                     "points": [{"rps": 50.0, "p99_ms": 12.0, "cpu_utilization": 0.2}, ...]}]}
+
+    Every point is a step of a load test: the throughput served by the replica (rps), its p99 latency in
+    milliseconds and, optionally, its CPU utilization ('cpu_utilization', 1.0 is every core busy) or accelerator
+    duty cycle ('accelerator_duty_cycle') during the step. 'measure_capacity_curve' writes this file.
+    """
+    with open(curves_path) as curves_file:
+        return json.load(curves_file)['curves']
+
+
+def save_capacity_curve(
+    curves_path: str,
+    machine_type: str,
+    points: List[Dict],
+    accelerator_type: str=None,
+    accelerator_count: int=None,
+) -> str:
+    """
+    Adds the curve of a machine configuration to the capacity curves file, replacing its previous curve, and
+    returns its path.
+    """
+    curves = load_capacity_curves(curves_path) if os.path.exists(curves_path) else []
+    curves = [curve for curve in curves
+              if (curve['machine_type'], curve.get('accelerator_type'), curve.get('accelerator_count')) != (machine_type, accelerator_type, accelerator_count)]
+    curves.append({'machine_type': machine_type, 'accelerator_type': accelerator_type, 'accelerator_count': accelerator_count, 'points': points})
+    os.makedirs(os.path.dirname(curves_path) or '.', exist_ok=True)
+    with open(curves_path, 'w') as curves_file:
+        json.dump({'curves': curves}, curves_file, indent=2)
+    return curves_path
+
+
+def measure_capacity_curve(
+    url: str,
+    payload: Dict,
+    concurrency_levels: List[int]=(1, 2, 4, 8, 16, 32),
+    step_seconds: float=10.0,
+    timeout_seconds: float=10.0,
+) -> List[Dict]:
+    """
+    This function measures the capacity curve of one replica of the serving app (e.g. the local container or an
+    endpoint with a single replica, on the machine type to plan): for every concurrency level, that number of
+    clients send 'payload' to 'url' back to back during 'step_seconds'. Failed requests are counted as errors and
+    excluded from the latencies.
+
+    Parameters:
+    - url (str): URL of the prediction route, e.g. http://0.0.0.0:8080/predict.
+    - payload (Dict): Body of the requests.
+    - concurrency_levels (List[int]): Number of concurrent clients of every step, increasing.
+    - step_seconds (float): Duration of every step in seconds. Default: 10.
+    - timeout_seconds (float): Timeout of every request in seconds. Default: 10.
+
+    Returns:
+    - A list of points, one by step, with the concurrency, the served throughput (rps), the p50 and p99 latencies
+      in milliseconds and the error rate.
+    """
+    body = json.dumps(payload).encode()
+    points = []
+    for concurrency in concurrency_levels:
+        latencies, errors, lock = [], [0], threading.Lock()
+        deadline = time.perf_counter() + step_seconds
+
+        def client():
+            while time.perf_counter() < deadline:
+                request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+                start = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(request, timeout=timeout_seconds) as response:
+                        response.read()
+                    with lock:
+                        latencies.append((time.perf_counter() - start) * 1000)
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+
+        step_start = time.perf_counter()
+        clients = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - step_start
+
+        points.append({
+            'concurrency': concurrency,
+            'rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(_percentile(latencies, 50), 3) if latencies else None,
+            'p99_ms': round(_percentile(latencies, 99), 3) if latencies else None,
+            'error_rate': round(errors[0] / max(len(latencies) + errors[0], 1), 4),
+        })
+        print(points[-1])
+    return points
+
+
+def plan_online_capacity(
+    curves: List[Dict],
+    target_peak_rps: float,
+    p99_slo_ms: float,
+    base_rps: float=0.0,
+    target_headroom: float=0.2,
+    min_replica_count: int=1,
+    catalog_path: str=DEFAULT_CATALOG_PATH,
+) -> Dict:
+    """
+    This function plans the deployment of the serving app from the capacity curves of one replica: for every
+    measured machine configuration, a replica can serve the throughput where its p99 latency reaches the SLO, minus
+    'target_headroom' to absorb the load until the autoscaler adds replicas. The replica bounds cover 'base_rps'
+    and 'target_peak_rps' at that throughput, and the autoscaling target is the utilization of a replica serving
+    it. The configuration with the cheapest hourly cost at peak is selected.
+
+    Parameters:
+    - curves (List[Dict]): Capacity curves by machine configuration (see 'load_capacity_curves').
+    - target_peak_rps (float): Peak requests per second that the endpoint must serve.
+    - p99_slo_ms (float): p99 latency SLO in milliseconds.
+    - base_rps (float): Off-peak requests per second, it sets the minimum number of replicas. Default: 0.
+    - target_headroom (float): Fraction of the throughput at the SLO kept free in every replica. Default: 0.2.
+    - min_replica_count (int): Lower bound of the minimum number of replicas (e.g. 2 for availability). Default: 1.
+    - catalog_path (str, optional): Path of the machine catalog. Default: the catalog shared by every component.
+
+    Returns:
+    - A dictionary with the selected configuration (machine_type, accelerator_type, accelerator_count), the
+      replica bounds (min_replica_count, max_replica_count), the autoscaling target
+      (autoscaling_target_cpu_utilization or autoscaling_target_accelerator_duty_cycle), the throughput and
+      expected p99 latency of a replica, the hourly costs and the plan of every configuration in 'candidates'.
+
+    Raises:
+    - ValueError: If the target peak, the SLO or the headroom are not valid.
+    - ValueError: If a machine type is not in the machine catalog.
+    - ValueError: If no configuration meets the SLO.
+    """
+    if target_peak_rps <= 0 or p99_slo_ms <= 0:
+        raise ValueError('target_peak_rps and p99_slo_ms must be positive')
+    if not 0 <= target_headroom < 1:
+        raise ValueError('target_headroom must be in [0, 1)')
+
+    catalog = load_machine_catalog(catalog_path)
+    candidates = []
+    for curve in curves:
+        machine = catalog.machines_by_name.get(curve['machine_type'])
+        if machine is None:
+            raise ValueError(f"Machine type {curve['machine_type']} was not found in the machine catalog")
+        accelerator_type, accelerator_count = curve.get('accelerator_type'), curve.get('accelerator_count')
+        points = sorted((point for point in curve['points'] if point.get('p99_ms') is not None), key=lambda point: point['rps'])
+        candidate = {
+            'machine_type': machine['name'],
+            'accelerator_type': accelerator_type,
+            'accelerator_count': accelerator_count,
+            'hourly_price_usd': catalog.hourly_price(machine, accelerator_type, accelerator_count),
+            'replica_slo_rps': round(_slo_rps(points, p99_slo_ms), 2) if points else 0.0,
+        }
+        candidates.append(candidate)
+        if not candidate['replica_slo_rps']:
+            continue
+
+        replica_rps = candidate['replica_slo_rps'] * (1 - target_headroom)
+        max_replicas = max(math.ceil(target_peak_rps / replica_rps), min_replica_count)
+        min_replicas = min(max(math.ceil(base_rps / replica_rps), min_replica_count, 1), max_replicas)
+        utilization_key = 'accelerator_duty_cycle' if accelerator_type else 'cpu_utilization'
+        candidate.update({
+            'replica_target_rps': round(replica_rps, 2),
+            'expected_p99_ms': round(_interpolate(points, 'rps', 'p99_ms', replica_rps), 3),
+            'min_replica_count': min_replicas,
+            'max_replica_count': max_replicas,
+            f'autoscaling_target_{utilization_key}': _autoscaling_target(points, utilization_key, replica_rps),
+            'min_hourly_cost_usd': round(min_replicas * candidate['hourly_price_usd'], 4),
+            'peak_hourly_cost_usd': round(max_replicas * candidate['hourly_price_usd'], 4),
+        })
+
+    feasible_candidates = [candidate for candidate in candidates if candidate['replica_slo_rps']]
+    if not feasible_candidates:
+        raise ValueError(f'There are no machine configurations with a p99 latency under {p99_slo_ms} ms in the capacity curves')
+
+    plan = dict(min(
+        feasible_candidates,
+        key=lambda candidate: (candidate['peak_hourly_cost_usd'], candidate['min_hourly_cost_usd'], candidate['max_replica_count'])
+    ))
+    plan.update({'target_peak_rps': target_peak_rps, 'p99_slo_ms': p99_slo_ms, 'base_rps': base_rps, 'candidates': candidates})
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--curves_path",
+        help="JSON file of the capacity curves measured on one replica of the serving app.",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--measure_url",
+        help="If it is provided, the capacity curve of the replica serving this URL (e.g. http://0.0.0.0:8080/predict) is measured and saved in curves_path instead of planning.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--payload_path",
+        help="JSON file with the body of the requests of the measure.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--machine_type",
+        help="Machine type of the measured replica.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--accelerator_type",
+        help="Accelerator type of the measured replica.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--accelerator_count",
+        help="Number of accelerators of the measured replica.",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--concurrency_levels",
+        help="Comma-separated number of concurrent clients of every step of the measure. Default: 1,2,4,8,16,32.",
+        type=str,
+        default='1,2,4,8,16,32'
+    )
+    parser.add_argument(
+        "--step_seconds",
+        help="Duration of every step of the measure in seconds. Default: 10.",
+        type=float,
+        default=10.0
+    )
+    parser.add_argument(
+        "--target_peak_rps",
+        help="Peak requests per second that the endpoint must serve.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--p99_slo_ms",
+        help="p99 latency SLO in milliseconds.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--base_rps",
+        help="Off-peak requests per second, it sets the minimum number of replicas. Default: 0.",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        "--target_headroom",
+        help="Fraction of the throughput at the SLO kept free in every replica. Default: 0.2.",
+        type=float,
+        default=0.2
+    )
+    parser.add_argument(
+        "--min_replica_count",
+        help="Lower bound of the minimum number of replicas. Default: 1.",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--catalog_path",
+        help="Path of the machine catalog. Default: the catalog shared by every component.",
+        type=str,
+        default=DEFAULT_CATALOG_PATH
+    )
+
+    args = parser.parse_args()
+
+    if args.measure_url:
+        if args.payload_path is None or args.machine_type is None:
+            raise ValueError('If you measure a capacity curve you have to set a value for "payload_path" and "machine_type"')
+        with open(args.payload_path) as payload_file:
+            payload = json.load(payload_file)
+        points = measure_capacity_curve(
+            args.measure_url,
+            payload,
+            concurrency_levels=[int(concurrency) for concurrency in args.concurrency_levels.split(',')],
+            step_seconds=args.step_seconds,
+        )
+        print(save_capacity_curve(args.curves_path, args.machine_type, points, args.accelerator_type, args.accelerator_count))
+    else:
+        if args.target_peak_rps is None or args.p99_slo_ms is None:
+            raise ValueError('You have to set a value for "target_peak_rps" and "p99_slo_ms" to plan the capacity')
+
+        plan = plan_online_capacity(
+            load_capacity_curves(args.curves_path),
+            target_peak_rps=args.target_peak_rps,
+            p99_slo_ms=args.p99_slo_ms,
+            base_rps=args.base_rps,
+            target_headroom=args.target_headroom,
+            min_replica_count=args.min_replica_count,
+            catalog_path=args.catalog_path,
+        )
+        print(json.dumps(plan, indent=2))
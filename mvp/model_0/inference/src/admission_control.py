@@ -0,0 +1,224 @@
+import hmac
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional
+
+from starlette.responses import JSONResponse
+
+
+DEADLINE_HEADER = 'x-request-deadline-ms'
+PRIORITY_HEADER = 'x-request-priority'
+INTERNAL_TOKEN_HEADER = 'x-internal-token'
+# Status and message of the rejected requests by reason
+REJECTIONS = {
+    'queue_full': (503, 'The server is overloaded, retry later'),
+    'deadline': (503, 'The request would not be served before its deadline'),
+    'expired': (503, 'The deadline of the request expired while it was queued'),
+    'low_priority': (429, 'Low priority requests are shed while the server is loaded'),
+}
+
+
+# Auxiliar functions
+def _header(scope: Dict, name: str) -> Optional[str]:
+    for key, value in scope.get('headers', []):
+        if key == name.encode():
+            return value.decode('latin-1')
+    return None
+
+
+def _parse_deadline_ms(value: str) -> Optional[float]:
+    try:
+        deadline_ms = float(value)
+    except (TypeError, ValueError):
+        return None
+    return deadline_ms if math.isfinite(deadline_ms) else None
+
+
+# Main functions
+class AdmissionController:
+    """
+    This class bounds the work of the server: at most 'max_in_flight' requests are served at the same time and at
+    most 'max_queue' wait for a slot, in arrival order. Instead of queueing every request until the latency of all of
+    them exceeds their timeouts (and the health checks fail), the requests that can't be served in time are rejected
+    early with a Retry-After, so the admitted ones keep a stable latency:
+    - If the queue is full, the request is rejected with a 503.
+    - If the client sent its deadline (X-Request-Deadline-Ms, the milliseconds it will wait) and the expected wait
+      in the queue exceeds it, the request is rejected with a 503 right away. The expected wait is the number of
+      requests ahead divided by 'max_in_flight', times the mean service time (an exponential moving average).
+    - A request that is still queued at its deadline is rejected with a 503.
+
+    Requests have a priority class. 'critical' requests (the 'bypass_paths', e.g. /health, and internal callers with
+    the X-Internal-Token of 'internal_token') are never queued nor rejected. 'low' requests (X-Request-Priority: low,
+    e.g. backfills) are rejected with a 429 once the queue is 'low_priority_queue_share' full, and wait behind the
+    'normal' ones, so they are shed first as the load grows.
+
+    Parameters:
+    - max_in_flight (int): Maximum number of requests served at the same time.
+    - max_queue (int, optional): Maximum number of requests waiting for a slot. Default: 2 * max_in_flight.
+    - bypass_paths (List[str]): Paths that are never shed. Default: /health and /metrics.
+    - internal_token (str, optional): Token of the internal callers that bypass the admission control.
+    - low_priority_queue_share (float): Share of the queue that low priority requests can fill. Default: 0.5.
+    - initial_service_seconds (float): Service time assumed until it is measured. Default: 0.05.
+    - ewma_alpha (float): Weight of the last request in the mean service time. Default: 0.1.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int=None,
+        bypass_paths: List[str]=('/health', '/metrics'),
+        internal_token: str=None,
+        low_priority_queue_share: float=0.5,
+        initial_service_seconds: float=0.05,
+        ewma_alpha: float=0.1,
+    ):
+        if max_in_flight <= 0:
+            raise ValueError('max_in_flight must be positive')
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue if max_queue is not None else 2 * max_in_flight
+        self.bypass_paths = set(bypass_paths)
+        self.internal_token = internal_token
+        self.low_priority_queue_share = low_priority_queue_share
+        self.service_seconds = initial_service_seconds
+        self.ewma_alpha = ewma_alpha
+        self.in_flight = 0
+        self._queues = {'normal': deque(), 'low': deque()}
+        self.stats = {'admitted': 0, 'queued': 0, 'bypassed': 0, **{f'rejected_{reason}': 0 for reason in REJECTIONS}}
+
+    @property
+    def queue_length(self) -> int:
+        return len(self._queues['normal']) + len(self._queues['low'])
+
+    def priority(self, scope: Dict) -> str:
+        if scope.get('path') in self.bypass_paths:
+            return 'critical'
+        if self.internal_token:
+            token = _header(scope, INTERNAL_TOKEN_HEADER)
+            if token and hmac.compare_digest(token, self.internal_token):
+                return 'critical'
+        return 'low' if (_header(scope, PRIORITY_HEADER) or '').lower() == 'low' else 'normal'
+
+    def expected_wait_seconds(self, requests_ahead: int) -> float:
+        return (requests_ahead + 1) / self.max_in_flight * self.service_seconds
+
+    def retry_after_seconds(self) -> int:
+        """Seconds until the current queue is expected to be served, the Retry-After of the rejected requests."""
+        return max(math.ceil(self.expected_wait_seconds(self.queue_length)), 1)
+
+    async def acquire(self, priority: str, deadline: float=None) -> Optional[str]:
+        """
+        Waits for a slot to serve a request. It returns None once the request is admitted (call 'release' when it
+        ends) or the reason why it is rejected (see REJECTIONS).
+
+        Parameters:
+        - priority (str): 'normal' or 'low'.
+        - deadline (float, optional): Deadline of the request as a time.monotonic() value.
+        """
+        if self.in_flight < self.max_in_flight and not self.queue_length:
+            self.in_flight += 1
+            self.stats['admitted'] += 1
+            return None
+        if priority == 'low' and self.queue_length >= self.max_queue * self.low_priority_queue_share:
+            return 'low_priority'
+        if self.queue_length >= self.max_queue:
+            return 'queue_full'
+        requests_ahead = len(self._queues['normal']) + (len(self._queues['low']) if priority == 'low' else 0)
+        if deadline is not None and time.monotonic() + self.expected_wait_seconds(requests_ahead) > deadline:
+            return 'deadline'
+
+        slot = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(slot)
+        self.stats['queued'] += 1
+        try:
+            await asyncio.wait({slot}, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        except asyncio.CancelledError:
+            # The client went away: give the slot to the next request if it was already handed to this one
+            if slot.done() and not slot.cancelled():
+                self.release()
+            else:
+                self._discard(priority, slot)
+            raise
+        if slot.done() and not slot.cancelled():
+            self.stats['admitted'] += 1
+            return None
+        self._discard(priority, slot)
+        return 'expired'
+
+    def _discard(self, priority: str, slot: asyncio.Future):
+        slot.cancel()
+        try:
+            self._queues[priority].remove(slot)
+        except ValueError:
+            pass
+
+    def release(self, service_seconds: float=None):
+        """Ends a request: its slot is handed to the next queued request, normal priority first."""
+        if service_seconds is not None:
+            self.service_seconds += self.ewma_alpha * (service_seconds - self.service_seconds)
+        for queue in (self._queues['normal'], self._queues['low']):
+            while queue:
+                slot = queue.popleft()
+                if not slot.done():
+                    slot.set_result(True)
+                    return
+        self.in_flight -= 1
+
+    def metrics(self) -> Dict:
+        return {
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queue_length': self.queue_length,
+            'mean_service_ms': round(self.service_seconds * 1000, 3),
+            **self.stats,
+        }
+
+
+class AdmissionControlMiddleware:
+    """
+    ASGI middleware that admits the HTTP requests through an AdmissionController. The rejected requests get their
+    status (429 or 503), a JSON message and a Retry-After header without reaching the app. The deadline of the
+    admitted requests (a time.monotonic() value, or None) is in request.state.deadline, so the app can bound its
+    own calls by the time the client has left.
+
+    Example:
+        app.add_middleware(AdmissionControlMiddleware, controller=AdmissionController(max_in_flight=8))
+    """
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        priority = self.controller.priority(scope)
+        if priority == 'critical':
+            self.controller.stats['bypassed'] += 1
+            return await self.app(scope, receive, send)
+
+        deadline_ms = _parse_deadline_ms(_header(scope, DEADLINE_HEADER))
+        deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None
+        rejection = await self.controller.acquire(priority, deadline)
+        if rejection is not None:
+            self.controller.stats[f'rejected_{rejection}'] += 1
+            return await self._reject(rejection, scope, receive, send)
+
+        scope.setdefault('state', {})['deadline'] = deadline
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(time.perf_counter() - start)
+
+    async def _reject(self, rejection: str, scope, receive, send):
+        status_code, message = REJECTIONS[rejection]
+        response = JSONResponse(
+            status_code=status_code,
+            content={"message": message},
+            headers={'Retry-After': str(self.controller.retry_after_seconds())},
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,278 @@
+import time
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+# Auxiliar functions
+def _request_fields(request) -> Dict:
+    if request is None:
+        return {}
+    if isinstance(request, dict):
+        return request
+    return request.model_dump() if hasattr(request, 'model_dump') else request.dict()
+
+
+class DeadlineExceededError(TimeoutError):
+    """A required source didn't answer before the deadline of the request."""
+
+
+class SourceUnavailableError(RuntimeError):
+    """A required source failed in every attempt."""
+
+
+class Source:
+    """
+    An external source read by input_data_ingestion for every request (a feature store, an API, a database...).
+
+    Parameters:
+    - name (str): Name of the source, the key of its value in the results.
+    - fetch (Callable): Coroutine function fetch(client, request) that returns the value of the source for the
+      request. 'client' is the pooled httpx.AsyncClient of the fetcher. The lookup must be idempotent, as it can be
+      sent twice (see 'hedge_after_ms').
+    - optional (bool): If True, a timeout or an error of the source leaves it out of the results (flagged in
+      'missing') instead of failing the request. Default: False.
+    - timeout_ms (float, optional): Timeout of the source in milliseconds, bounded by the deadline of the request.
+    - hedge_after_ms (float, optional): If the source hasn't answered after this delay, a duplicate lookup is
+      sent and the first answer is used. It is also sent right away if the first lookup fails. Default: the
+      'hedge_after_ms' of the fetcher.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[Any, Any], Awaitable],
+        optional: bool=False,
+        timeout_ms: float=None,
+        hedge_after_ms: float=None,
+    ):
+        self.name = name
+        self.fetch = fetch
+        self.optional = optional
+        self.timeout_ms = timeout_ms
+        self.hedge_after_ms = hedge_after_ms
+
+
+def http_source(name: str, url: str, method: str='GET', **source_kwargs) -> Source:
+    """
+    Returns a source that reads a JSON document over HTTP. The fields of the request fill the placeholders of
+    'url', e.g. 'http://feature-store/customers/{customer_id}'.
+    """
+    async def fetch(client, request):
+        if client is None:
+            raise ImportError('httpx is required to read HTTP sources')
+        response = await client.request(method, url.format(**_request_fields(request)))
+        response.raise_for_status()
+        return response.json()
+
+    return Source(name, fetch, **source_kwargs)
+
+
+def sync_source(name: str, function: Callable, **source_kwargs) -> Source:
+    """
+    Returns a source read by a blocking function(request) (e.g. a BigQuery or Firestore client), run in a thread.
+    A timed out call can't be cancelled: it keeps its thread until it ends, but the request doesn't wait for it.
+    """
+    async def fetch(client, request):
+        return await asyncio.get_running_loop().run_in_executor(None, function, request)
+
+    return Source(name, fetch, **source_kwargs)
+
+
+class FetchResult:
+    """
+    Values of the sources of a request. 'missing' has the optional sources left out and why ('timeout' or
+    'error'), 'hedged' the sources that needed a duplicate lookup and 'partial' is True if any source is missing.
+    """
+
+    def __init__(self, values: Dict, missing: Dict[str, str], hedged: List[str], elapsed_ms: float):
+        self.values = values
+        self.missing = missing
+        self.hedged = hedged
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.missing)
+
+    def __getitem__(self, name: str):
+        return self.values[name]
+
+    def get(self, name: str, default=None):
+        return self.values.get(name, default)
+
+    def __repr__(self) -> str:
+        return f'FetchResult(values={self.values}, missing={self.missing}, hedged={self.hedged}, elapsed_ms={self.elapsed_ms})'
+
+
+# Main functions
+class AsyncFetcher:
+    """
+    This class reads the external sources of a request concurrently, so the latency of the ingestion is the one of
+    the slowest source instead of their sum. The lookups share a pool of keep-alive connections (httpx.AsyncClient),
+    every request has a deadline and slow lookups are hedged: a duplicate is sent after a delay and the first
+    answer wins, which cuts the tail latency of sources with sporadic slow answers. Optional sources that time out
+    or fail are flagged in the result instead of failing the request.
+
+    The fetcher runs its own event loop in a background thread, so the stage functions, that are synchronous, call
+    'fetch_sync' and async code awaits 'fetch' in that loop (see 'run').
+
+    Parameters:
+    - sources (List[Source]): Sources to read for every request.
+    - hedge_after_ms (float, optional): Default delay before hedging a lookup. If it isn't provided, lookups
+      are only hedged if their source sets it.
+    - max_connections (int): Maximum number of open connections of the pool. Default: 100.
+    - max_keepalive_connections (int): Maximum number of idle connections kept open. Default: 20.
+
+    Example:
+        fetcher = AsyncFetcher([
+            http_source('customer', 'http://feature-store/customers/{customer_id}'),
+            http_source('recent_orders', 'http://orders/customers/{customer_id}/recent', optional=True, hedge_after_ms=30),
+        ]).start()
+        result = fetcher.fetch_sync(request, deadline=deadline)
+        result['customer'], result.get('recent_orders'), result.missing
+    """
+
+    def __init__(
+        self,
+        sources: List[Source],
+        hedge_after_ms: float=None,
+        max_connections: int=100,
+        max_keepalive_connections: int=20,
+    ):
+        self.sources = list(sources)
+        self.hedge_after_ms = hedge_after_ms
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.stats = {'requests': 0, 'partial_results': 0, 'lookups': 0, 'hedged_lookups': 0, 'hedge_wins': 0, 'timeouts': 0, 'errors': 0}
+        self._client = None
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                import httpx
+            except ImportError:  # only the sources that don't use the client can be read
+                return None
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+            ))
+        return self._client
+
+    async def _fetch_source(self, source: Source, request, deadline: float=None):
+        """Returns the value of a source, its status (None, 'timeout' or 'error'), if it was hedged and its error."""
+        loop = asyncio.get_running_loop()
+        timeouts = [seconds for seconds in (
+            None if deadline is None else deadline - time.monotonic(),
+            None if source.timeout_ms is None else source.timeout_ms / 1000,
+        ) if seconds is not None]
+        end = loop.time() + min(timeouts) if timeouts else None
+        hedge_after_ms = source.hedge_after_ms if source.hedge_after_ms is not None else self.hedge_after_ms
+        hedge_at = None if hedge_after_ms is None else loop.time() + hedge_after_ms / 1000
+        if end is not None and end <= loop.time():
+            return None, 'timeout', False, None
+
+        client = self._get_client()
+        self.stats['lookups'] += 1
+        first_attempt = asyncio.ensure_future(source.fetch(client, request))
+        pending, hedge_attempt, error = {first_attempt}, None, None
+        try:
+            while pending:
+                wake_times = [wake_time for wake_time in (end, hedge_at if hedge_attempt is None else None) if wake_time is not None]
+                wait_seconds = max(min(wake_times) - loop.time(), 0) if wake_times else None
+                done, pending = await asyncio.wait(pending, timeout=wait_seconds, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is hedge_attempt:
+                            self.stats['hedge_wins'] += 1
+                        return attempt.result(), None, hedge_attempt is not None, None
+                    error = attempt.exception()
+
+                if end is not None and loop.time() >= end:
+                    return None, 'timeout', hedge_attempt is not None, None
+                # Hedge a slow lookup, or retry a failed one if it can be hedged
+                if hedge_attempt is None and hedge_at is not None and (loop.time() >= hedge_at or not pending):
+                    self.stats['hedged_lookups'] += 1
+                    hedge_attempt = asyncio.ensure_future(source.fetch(client, request))
+                    pending.add(hedge_attempt)
+            return None, 'error', hedge_attempt is not None, error
+        finally:
+            for attempt in pending:
+                attempt.cancel()
+
+    async def fetch(self, request, deadline: float=None) -> FetchResult:
+        """
+        Reads every source for the request concurrently.
+
+        Parameters:
+        - request: Request of the API (a pydantic model or a dict).
+        - deadline (float, optional): Deadline of the request as a time.monotonic() value. The sources still
+          pending at the deadline are timed out.
+
+        Returns:
+        - A FetchResult with the values of the sources and the optional sources that are missing.
+
+        Raises:
+        - DeadlineExceededError: If a required source timed out.
+        - SourceUnavailableError: If a required source failed.
+        """
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(self._fetch_source(source, request, deadline) for source in self.sources))
+
+        values, missing, hedged = {}, {}, []
+        for source, (value, status, is_hedged, error) in zip(self.sources, outcomes):
+            if is_hedged:
+                hedged.append(source.name)
+            if status is None:
+                values[source.name] = value
+                continue
+            self.stats['timeouts' if status == 'timeout' else 'errors'] += 1
+            if not source.optional:
+                if status == 'timeout':
+                    raise DeadlineExceededError(f'Source {source.name} did not answer before the deadline of the request')
+                raise SourceUnavailableError(f'Source {source.name} failed: {error}') from error
+            missing[source.name] = status
+
+        self.stats['requests'] += 1
+        self.stats['partial_results'] += bool(missing)
+        return FetchResult(values, missing, hedged, round((time.perf_counter() - start) * 1000, 3))
+
+    def start(self) -> 'AsyncFetcher':
+        """
+        Starts the event loop of the fetcher and creates its connection pool. Call it when the app starts, so the
+        first request doesn't pay for it (the SSL context of the pool alone takes hundreds of milliseconds).
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='async-fetcher', daemon=True)
+                self._thread.start()
+                asyncio.run_coroutine_threadsafe(self._create_client(), self._loop).result()
+        return self
+
+    async def _create_client(self):
+        self._get_client()
+
+    def run(self, coroutine):
+        """Runs a coroutine in the event loop of the fetcher and returns its result."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def fetch_sync(self, request, deadline: float=None) -> FetchResult:
+        """Same as 'fetch', for synchronous code like the stage functions."""
+        return self.run(self.fetch(request, deadline))
+
+    def close(self):
+        """Closes the connections of the pool and stops the event loop of the fetcher."""
+        if self._loop is None:
+            return
+        if self._client is not None:
+            self.run(self._client.aclose())
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = None
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from typing import Dict
+
+
+# Leaf frames of threads waiting for work (event loop, thread pool and refresh threads), not counted by default
+IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'), ('socket.py', 'accept')}
+MAX_SECONDS = 60
+_profile_lock = threading.Lock()
+_memory_lock = threading.Lock()
+
+
+# Auxiliar functions
+def _read_rss_bytes():
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+# Main functions
+def sample_stacks(seconds: float, interval: float=0.005, include_idle: bool=False) -> Counter:
+    """
+    Samples the stacks of every thread of the process (except the sampling one) every 'interval' seconds for
+    'seconds' seconds, so the requests served by the event loop and by the thread pool are both profiled while
+    the app keeps serving traffic. Nothing is traced between samples, so the overhead is a stack walk by
+    thread and sample.
+
+    Parameters:
+    - seconds (float): Duration of the profile.
+    - interval (float): Seconds between samples. Default: 0.005.
+    - include_idle (bool): If the stacks of threads waiting for work are counted. Default: False.
+
+    Returns:
+    - The number of samples of every collapsed stack ('thread;frame;frame'), root first.
+
+    Raises:
+    - RuntimeError: If another profile is running.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError('Another profile is running')
+    try:
+        own_thread_id = threading.get_ident()
+        thread_names = {}
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, f'thread-{thread_id}'))
+                samples[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return samples
+    finally:
+        _profile_lock.release()
+
+
+def to_collapsed(samples: Counter) -> str:
+    """
+    Returns the samples as collapsed stacks ('frame;frame;frame count'), the format read by flamegraph.pl,
+    speedscope and most flamegraph viewers.
+    """
+    return ''.join(f'{stack} {count}\n' for stack, count in samples.most_common())
+
+
+def to_speedscope(samples: Counter, interval: float, name: str='inference') -> Dict:
+    """
+    Returns the samples as a speedscope file (https://www.speedscope.app), weighted in seconds.
+    """
+    frames, frame_indexes = [], {}
+    profile_samples, weights = [], []
+    for stack, count in samples.most_common():
+        indexes = []
+        for frame_name in stack.split(';'):
+            if frame_name not in frame_indexes:
+                frame_indexes[frame_name] = len(frames)
+                frames.append({'name': frame_name})
+            indexes.append(frame_indexes[frame_name])
+        profile_samples.append(indexes)
+        weights.append(count * interval)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'debug_profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': profile_samples,
+            'weights': weights,
+        }],
+    }
+
+
+def memory_snapshot(seconds: float=10.0, top: int=20, group_by: str='lineno', frames: int=10) -> Dict:
+    """
+    Returns the top allocations of the process by size, grouped by line ('lineno'), file ('filename') or
+    allocation stack ('traceback'). If tracemalloc is already tracing (e.g. PYTHONTRACEMALLOC=<frames> in the
+    environment of the app), the current allocations are returned. If it isn't, it traces the allocations for
+    'seconds' seconds, so the snapshot shows what the live traffic allocated and kept in that window, and then
+    stops, so there is no overhead between snapshots.
+
+    Returns:
+    - The RSS, the traced memory and the top allocations (size, count and location).
+
+    Raises:
+    - RuntimeError: If another snapshot is running.
+    """
+    import gc
+    import tracemalloc
+
+    if not _memory_lock.acquire(blocking=False):
+        raise RuntimeError('Another memory snapshot is running')
+    try:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(frames)
+            time.sleep(seconds)
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+    finally:
+        _memory_lock.release()
+
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    statistics = snapshot.statistics(group_by)
+    allocations = []
+    for statistic in statistics[:top]:
+        allocations.append({
+            'size_bytes': statistic.size,
+            'count': statistic.count,
+            'location': [f'{frame.filename}:{frame.lineno}' for frame in statistic.traceback][:frames if group_by == 'traceback' else 1],
+        })
+    return {
+        'rss_bytes': _read_rss_bytes(),
+        'traced_seconds': seconds if started_here else None,
+        'traced_bytes': traced_bytes,
+        'peak_traced_bytes': peak_traced_bytes,
+        'gc_counts': list(gc.get_count()),
+        'top_allocations': allocations,
+    }
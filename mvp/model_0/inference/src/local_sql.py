@@ -0,0 +1,235 @@
+import os
+import re
+import glob
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_FIXTURES_DIR = 'tests/fixtures'
+_BACKTICK_TABLE = re.compile(r'`[^`]+`(?:\s*\.\s*`[^`]+`)*')
+_CREATE_TABLE = re.compile(r'\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP(?:ORARY)?\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+# Used when sqlglot isn't installed: the differences between BigQuery and DuckDB found in our queries
+_DIALECT_RULES = [
+    (re.compile(r'\*\s*EXCEPT\s*\(', re.IGNORECASE), '* EXCLUDE ('),
+    (re.compile(r'\bSAFE_CAST\s*\(', re.IGNORECASE), 'TRY_CAST('),
+    (re.compile(r'\bRAND\s*\(\s*\)', re.IGNORECASE), 'RANDOM()'),
+    (re.compile(r'\bINT64\b', re.IGNORECASE), 'BIGINT'),
+    (re.compile(r'\bFLOAT64\b', re.IGNORECASE), 'DOUBLE'),
+    (re.compile(r'\bAS\s+STRING\s*\)', re.IGNORECASE), 'AS VARCHAR)'),
+    (re.compile(r'`([^`]+)`'), r'"\1"'),
+]
+_engines = {}
+
+
+# Auxiliar functions
+def _read_query(query: str) -> str:
+    if query.strip().lower().endswith('.sql') and os.path.exists(query.strip()):
+        with open(query.strip()) as query_file:
+            return query_file.read()
+    return query
+
+
+def _table_name(table_id: str) -> str:
+    return re.sub(r'\W', '_', table_id)
+
+
+def _fixture_table_id(table_id: str) -> str:
+    # Fixtures are named without the project (<dataset>.<table>), so they don't depend on @PROJECT_ID
+    return '.'.join(table_id.split('.')[-2:])
+
+
+def translate_bigquery_sql(sql: str, replacements: Dict=None) -> Tuple[str, Dict[str, str]]:
+    """
+    Translates a BigQuery query to DuckDB: the placeholders (e.g. @PROJECT_ID) are replaced, the backtick table
+    names (`project.dataset.table`) are replaced by local names and the dialect is translated by sqlglot if it is
+    installed, or by the rules of the few BigQuery functions used by our queries if it isn't.
+
+    Returns:
+    - A tuple (DuckDB SQL, dict of local table name: BigQuery table id).
+    """
+    for key, value in (replacements or {}).items():
+        sql = sql.replace(key, str(value))
+
+    tables = {}
+    def local_table(match):
+        table_id = re.sub(r'`\s*\.\s*`', '.', match.group(0)).strip('`')
+        if '.' not in table_id:
+            return match.group(0) # A quoted column or alias
+        tables[_table_name(table_id)] = table_id
+        return _table_name(table_id)
+    sql = _BACKTICK_TABLE.sub(local_table, sql)
+
+    try:
+        import sqlglot
+    except ImportError:
+        for pattern, replacement in _DIALECT_RULES:
+            sql = pattern.sub(replacement, sql)
+        return sql, tables
+    return ';\n'.join(sqlglot.transpile(sql, read='bigquery', write='duckdb')), tables
+
+
+def extract_table_ids(sql: str, replacements: Dict=None) -> List[str]:
+    """
+    Returns the BigQuery tables read by a query, without the tables that the query creates.
+    """
+    translated_sql, tables = translate_bigquery_sql(sql, replacements)
+    created = {name.lower() for name in _CREATE_TABLE.findall(translated_sql)}
+    return [table_id for name, table_id in tables.items() if name.lower() not in created]
+
+
+# Main functions
+class LocalSQLEngine:
+    """
+    This class runs the BigQuery queries of the components (queries/*.sql) in an embedded DuckDB database, so
+    the stages run in test mode offline and in seconds. Every table read by a query is a view over its Parquet
+    fixture in 'fixtures_dir', named <dataset>.<table>.parquet (a file, or a directory of files), or
+    <project>.<dataset>.<table>.parquet if the same table name is in several projects. The tables created by a
+    query (CREATE [OR REPLACE] TABLE) are kept in the database for the next queries and, only if 'persist_tables'
+    (e.g. to generate a fixture once), written as fixtures, so the test runs don't change the fixtures.
+
+    Parameters:
+    - fixtures_dir (str): Directory of the Parquet fixtures. Default: 'tests/fixtures'.
+    - replacements (Dict, optional): Placeholders replaced in every query, e.g. {'@PROJECT_ID': project_id}.
+    - persist_tables (bool): If the tables created by the queries are written as fixtures. Default: False.
+    """
+
+    def __init__(self, fixtures_dir: str=DEFAULT_FIXTURES_DIR, replacements: Dict=None, persist_tables: bool=False):
+        import duckdb
+
+        self.fixtures_dir = fixtures_dir
+        self.replacements = dict(replacements or {})
+        self.persist_tables = persist_tables
+        self.connection = duckdb.connect()
+
+    def fixture_path(self, table_id: str) -> Optional[str]:
+        """
+        Returns the fixture of a table (a Parquet file or a glob of the files of a directory), or None.
+        """
+        for name in (table_id, _fixture_table_id(table_id)):
+            path = os.path.join(self.fixtures_dir, name)
+            if os.path.isfile(path + '.parquet'):
+                return path + '.parquet'
+            if os.path.isdir(path) and glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True):
+                return os.path.join(path, '**', '*.parquet')
+        return None
+
+    def _relations(self) -> set:
+        return {row[0].lower() for row in self.connection.execute('SELECT table_name FROM information_schema.tables').fetchall()}
+
+    def query(self, sql: str, replacements: Dict=None, as_arrow: bool=False):
+        """
+        Runs a query (or a script of several statements) and returns the result of its last statement.
+
+        Returns:
+        - A pandas DataFrame (a pyarrow Table if 'as_arrow'), or None if the last statement doesn't return rows.
+
+        Raises:
+        - FileNotFoundError: If a table read by the query has no fixture.
+        """
+        translated_sql, tables = translate_bigquery_sql(_read_query(sql), {**self.replacements, **(replacements or {})})
+        created = {name.lower() for name in _CREATE_TABLE.findall(translated_sql)}
+        relations = self._relations()
+        for name, table_id in tables.items():
+            if name.lower() in created:
+                self.connection.execute(f'DROP VIEW IF EXISTS {name}')
+            elif name.lower() not in relations:
+                path = self.fixture_path(table_id)
+                if path is None:
+                    raise FileNotFoundError(f"There is no fixture of {table_id} in {self.fixtures_dir}, add {_fixture_table_id(table_id)}.parquet (see download_fixtures)")
+                escaped_path = path.replace("'", "''")
+                self.connection.execute(f"CREATE OR REPLACE VIEW {name} AS SELECT * FROM read_parquet('{escaped_path}')")
+
+        result = self.connection.execute(translated_sql)
+        last_statement = [statement for statement in translated_sql.split(';') if statement.strip()][-1]
+        returns_rows = re.match(r'\s*(\(|SELECT\b|WITH\b|FROM\b|VALUES\b)', last_statement, re.IGNORECASE)
+        dataframe = None
+        if result.description and returns_rows:
+            dataframe = result.fetch_arrow_table() if as_arrow else result.df()
+
+        if self.persist_tables:
+            for name, table_id in tables.items():
+                if name.lower() in created:
+                    os.makedirs(self.fixtures_dir, exist_ok=True)
+                    output_path = os.path.join(self.fixtures_dir, _fixture_table_id(table_id) + '.parquet').replace("'", "''")
+                    self.connection.execute(f"COPY {name} TO '{output_path}' (FORMAT PARQUET)")
+        return dataframe
+
+
+def run_query(
+    query: str,
+    project_id: str,
+    location: str='us-central1',
+    replacements: Dict=None,
+    test_mode: bool=False,
+    fixtures_dir: str=None,
+    as_arrow: bool=False,
+):
+    """
+    Runs a query of the component in BigQuery or, in test mode, in a local DuckDB database over Parquet fixtures
+    (see 'LocalSQLEngine'). It is the way to run the queries of the ingestion stages, so the same stages run
+    offline with test_mode=True. The local database is shared by the queries of the process, so the tables
+    created by a query can be read by the next ones. They aren't written in the fixtures directory.
+
+    Parameters:
+    - query (str): SQL or path of a .sql file.
+    - project_id (str): Project of the job. It replaces @PROJECT_ID.
+    - location (str): Location of the job. Default: 'us-central1'.
+    - replacements (Dict, optional): Other placeholders replaced in the query.
+    - test_mode (bool): If the query runs locally. Default: False.
+    - fixtures_dir (str, optional): Directory of the fixtures. Default: LOCAL_SQL_FIXTURES_DIR or 'tests/fixtures'.
+    - as_arrow (bool): If the result is a pyarrow Table, to be passed to the next stages as a StageData without
+      converting it to pandas (see src/stage_data.py). Default: False.
+
+    Returns:
+    - A pandas DataFrame (or a pyarrow Table) with the result, or None if the query doesn't return rows.
+    """
+    replacements = {'@PROJECT_ID': project_id, **(replacements or {})}
+    sql = _read_query(query)
+    if test_mode:
+        fixtures_dir = fixtures_dir or os.environ.get('LOCAL_SQL_FIXTURES_DIR', DEFAULT_FIXTURES_DIR)
+        if fixtures_dir not in _engines:
+            _engines[fixtures_dir] = LocalSQLEngine(fixtures_dir)
+        return _engines[fixtures_dir].query(sql, replacements, as_arrow)
+
+    from google.cloud import bigquery
+    for key, value in replacements.items():
+        sql = sql.replace(key, str(value))
+    job = bigquery.Client(project=project_id, location=location).query(sql)
+    rows = job.result()
+    if job.statement_type != 'SELECT':
+        return None
+    return rows.to_arrow() if as_arrow else rows.to_dataframe()
+
+
+def download_fixtures(
+    queries: List[str],
+    project_id: str,
+    fixtures_dir: str=DEFAULT_FIXTURES_DIR,
+    limit: int=1000,
+    replacements: Dict=None,
+    location: str='us-central1',
+) -> List[str]:
+    """
+    Writes a sample of 'limit' rows of every BigQuery table read by the queries as Parquet fixtures of
+    'LocalSQLEngine'. Existing fixtures aren't replaced.
+
+    Returns:
+    - The paths of the new fixtures.
+    """
+    from google.cloud import bigquery
+
+    replacements = {'@PROJECT_ID': project_id, **(replacements or {})}
+    table_ids = []
+    for query in queries:
+        table_ids += [table_id for table_id in extract_table_ids(_read_query(query), replacements) if table_id not in table_ids]
+
+    client = bigquery.Client(project=project_id, location=location)
+    engine = LocalSQLEngine(fixtures_dir, persist_tables=False)
+    fixture_paths = []
+    for table_id in table_ids:
+        if engine.fixture_path(table_id) is not None:
+            continue
+        os.makedirs(fixtures_dir, exist_ok=True)
+        fixture_path = os.path.join(fixtures_dir, _fixture_table_id(table_id) + '.parquet')
+        client.query(f'SELECT * FROM `{table_id}` LIMIT {int(limit)}').result().to_dataframe().to_parquet(fixture_path, index=False)
+        fixture_paths.append(fixture_path)
+    return fixture_paths
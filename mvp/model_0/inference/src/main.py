@@ -1,10 +1,24 @@
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import FastAPI, Header, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, Response
 import uvicorn
 import argparse
+import hmac
+import os
+import time
+from typing import Optional
 from pydantic import BaseModel, ValidationError
+from admission_control import AdmissionController, AdmissionControlMiddleware
+from async_fetch import DeadlineExceededError
 from model_utils import input_data_ingestion, model_ingestion, feature_generation, point_prediction_generation
 from app_schemas import PredictionRequest, PredictionResponse
+from vector_search import SegmentedVectorSearcher, SimilarRequest, SimilarResponse
+from prediction_lookup import PredictionLookupStore
+from model_cache import ModelCache, parse_model_keys
+from request_coalescing import RequestCoalescer, coalescing_key
+from debug_profiler import MAX_SECONDS, memory_snapshot, sample_stacks, to_collapsed, to_speedscope
+from stage_data import copy_stats
+from tracing import TRACEPARENT_HEADER, Tracer
 from parameters import (
     input_data_ingestion_project_id, 
     input_data_ingestion_version, 
@@ -37,24 +51,125 @@ from parameters import (
 
 app = FastAPI(title='{{cookiecutter.applicationName}} API')
 
-# Attempt to load the logistic regression model
-try:
-    model = model_ingestion(
+# Admission control, enabled when ADMISSION_MAX_IN_FLIGHT is set: at most ADMISSION_MAX_IN_FLIGHT requests are served at
+# the same time and ADMISSION_MAX_QUEUE (default: twice as many) wait, the others are rejected early with a 503 or a 429
+# and a Retry-After, and so are the ones that would wait longer than their X-Request-Deadline-Ms header. /health,
+# /metrics and the internal callers with the X-Internal-Token header equal to ADMISSION_INTERNAL_TOKEN are never shed,
+# and the requests with X-Request-Priority: low are shed first
+admission_controller = None
+if os.environ.get('ADMISSION_MAX_IN_FLIGHT'):
+    admission_controller = AdmissionController(
+        max_in_flight=int(os.environ['ADMISSION_MAX_IN_FLIGHT']),
+        max_queue=int(os.environ['ADMISSION_MAX_QUEUE']) if os.environ.get('ADMISSION_MAX_QUEUE') else None,
+        internal_token=os.environ.get('ADMISSION_INTERNAL_TOKEN') or None,
+    )
+    app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
+# Tracing of the requests, disabled unless TRACE_OTLP_ENDPOINT (OTLP/HTTP collector) or TRACE_FILE_PATH (OTLP/JSON
+# lines file) is set. TRACE_SAMPLE_RATE is the share of the new traces sampled, the requests with a traceparent header
+# follow the decision of the caller. Every stage call is a child span of the span of its request
+tracer = Tracer.from_env(service_name='inference', resource_attributes=input_data_ingestion_labels)
+input_data_ingestion, model_ingestion, feature_generation, point_prediction_generation = (
+    tracer.wrap_stage(stage_function) for stage_function in (input_data_ingestion, model_ingestion, feature_generation, point_prediction_generation)
+)
+
+# Attempt to load the logistic regression model. In multi-model serving (see below), model_ingestion input files with
+# the {model_name} or {version} placeholders are only loaded by request, so there isn't a model to load at startup
+routed_model_inputs = bool(os.environ.get('MODEL_CACHE_MAX_MB')) and any(
+    '{model_name}' in value or '{version}' in value
+    for value in list(model_ingestion_input_files_queries or []) + list(model_ingestion_input_files_storage_uris or [])
+)
+app.state.model = None
+if routed_model_inputs:
+    print("Multi-model serving: the models are loaded by request")
+else:
+    try:
+        model = model_ingestion(
+            project_id=model_ingestion_project_id,
+            version=model_ingestion_version,
+            location=model_ingestion_location,
+            secret_path=model_ingestion_secret_path,
+            input_files_queries=model_ingestion_input_files_queries,
+            input_files_storage_uris=model_ingestion_input_files_storage_uris,
+            test_mode=model_ingestion_test_mode,
+            labels=model_ingestion_labels,
+        )
+    except Exception as e:
+        # This will catch any model loading error
+        print(f"Error loading model: {e}")
+    else:
+        app.state.model = model
+
+# Multi-model serving, enabled when MODEL_CACHE_MAX_MB is set: the model_name/version pairs requested by
+# /models/{model_name}/versions/{version}/predict (or the X-Model-Name and X-Model-Version headers of /predict) are
+# loaded on demand by model_ingestion and kept in memory while they fit in MODEL_CACHE_MAX_MB, the least recently used
+# are evicted. The placeholders {model_name} and {version} of the model_ingestion input files are replaced by the
+# ones of the request. MODEL_CACHE_ALLOWED_MODELS limits the models served (comma-separated model_name or
+# model_name:version). The model loaded at startup, if any, is served without headers and isn't counted in the budget
+def load_routed_model(model_name: str, version: str):
+    def route(value: str) -> str:
+        return value.replace('{model_name}', model_name).replace('{version}', version)
+
+    return model_ingestion(
         project_id=model_ingestion_project_id,
-        version=model_ingestion_version,
+        version=version,
         location=model_ingestion_location,
         secret_path=model_ingestion_secret_path,
-        input_files_queries=model_ingestion_input_files_queries,
-        input_files_storage_uris=model_ingestion_input_files_storage_uris,
+        input_files_queries=[route(query) for query in model_ingestion_input_files_queries or []] or None,
+        input_files_storage_uris=[route(uri) for uri in model_ingestion_input_files_storage_uris or []] or None,
         test_mode=model_ingestion_test_mode,
-        labels=model_ingestion_labels,
+        labels={**(model_ingestion_labels or {}), 'model_name': model_name, 'version': version},
     )
-except Exception as e:
-    # This will catch any model loading error
-    app.state.model = None
-    print(f"Error loading model: {e}")
-else:
-    app.state.model = model
+
+app.state.model_cache = None
+if os.environ.get('MODEL_CACHE_MAX_MB'):
+    app.state.model_cache = ModelCache(
+        loader=load_routed_model,
+        max_bytes=int(float(os.environ['MODEL_CACHE_MAX_MB']) * 1024 ** 2),
+        allowed_models=parse_model_keys(os.environ.get('MODEL_CACHE_ALLOWED_MODELS')),
+    )
+
+# Attempt to load the vector index, /similar is enabled when VECTOR_INDEX_PATH (local directory or gs:// URI of the
+# index built in postprocessing) is set. VECTOR_SEARCH_K is the default search_k (recall vs latency) of the queries
+# and the delta segments of the index are reloaded every VECTOR_INDEX_REFRESH_SECONDS
+app.state.vector_searcher = None
+if os.environ.get('VECTOR_INDEX_PATH'):
+    try:
+        app.state.vector_searcher = SegmentedVectorSearcher(
+            index_root=os.environ['VECTOR_INDEX_PATH'],
+            default_search_k=int(os.environ.get('VECTOR_SEARCH_K', 0)) or None,
+            refresh_seconds=float(os.environ.get('VECTOR_INDEX_REFRESH_SECONDS', 0)) or None,
+        )
+    except Exception as e:
+        print(f"Error loading vector index: {e}")
+
+# Attempt to load the precomputed predictions, /predict answers the entities scored by the last batch prediction job
+# from memory when PREDICTION_LOOKUP_PATH (local directory or gs:// URI of the files stored by prediction_storing in
+# postprocessing) is set. The entity is read from the field PREDICTION_LOOKUP_ENTITY_FIELD of the request (default:
+# PREDICTION_LOOKUP_ENTITY_COLUMN, the entity column of the files) and PREDICTION_LOOKUP_PREDICTION_COLUMN is served.
+# Predictions older than PREDICTION_LOOKUP_MAX_AGE_SECONDS and absent entities are scored by the live pipeline, and
+# the files are listed again every PREDICTION_LOOKUP_REFRESH_SECONDS
+app.state.prediction_lookup = None
+app.state.prediction_lookup_entity_field = None
+if os.environ.get('PREDICTION_LOOKUP_PATH'):
+    try:
+        app.state.prediction_lookup = PredictionLookupStore(
+            path=os.environ['PREDICTION_LOOKUP_PATH'],
+            entity_column=os.environ.get('PREDICTION_LOOKUP_ENTITY_COLUMN', 'entity_id'),
+            prediction_column=os.environ.get('PREDICTION_LOOKUP_PREDICTION_COLUMN') or None,
+            max_age_seconds=float(os.environ.get('PREDICTION_LOOKUP_MAX_AGE_SECONDS', 0)) or None,
+            refresh_seconds=float(os.environ.get('PREDICTION_LOOKUP_REFRESH_SECONDS', 0)) or None,
+        )
+        app.state.prediction_lookup_entity_field = os.environ.get('PREDICTION_LOOKUP_ENTITY_FIELD', app.state.prediction_lookup.entity_column)
+    except Exception as e:
+        print(f"Error loading prediction lookup: {e}")
+
+# Deadline of the external sources read by input_data_ingestion for every request (src/async_fetch.py), the optional
+# sources still pending at the deadline are left out and a required one fails the request with a 504
+INPUT_FETCH_DEADLINE_MS = float(os.environ.get('INPUT_FETCH_DEADLINE_MS', 0)) or None
+
+# Identical requests (same payload and model version) in flight at the same time share one execution of the pipeline
+request_coalescer = RequestCoalescer()
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -80,20 +195,107 @@ async def general_exception_handler(request: Request, exc: Exception):
 
 @app.get("/health", response_class=Response)
 async def health_check():
-    if app.state.model is None:
+    # In multi-model serving the models are loaded by request, so the app is healthy without a model loaded at startup
+    if app.state.model is None and app.state.model_cache is None:
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             content={"status": "unhealthy", "detail": "Model is not loaded"}
         )
     return Response(status_code=status.HTTP_200_OK, content="healthy")
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "prediction_lookup": app.state.prediction_lookup.metrics() if app.state.prediction_lookup is not None else None,
+        "stage_data": copy_stats(),
+        "tracing": tracer.stats,
+        "request_coalescing": request_coalescer.stats,
+        "model_cache": app.state.model_cache.metrics() if app.state.model_cache is not None else None,
+        "admission_control": admission_controller.metrics() if admission_controller is not None else None,
+    }
+
 @app.post("/predict", response_model=PredictionResponse)
-async def predict(request: PredictionRequest):
-    if app.state.model is None:
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Model is not loaded")
+async def predict(
+    request: PredictionRequest,
+    response: Response,
+    http_request: Request,
+    traceparent: Optional[str]=Header(None),
+    x_model_name: Optional[str]=Header(None),
+    x_model_version: Optional[str]=Header(None),
+):
+    # The span of the request is a child of the span of the caller if it sent a traceparent header, and its own
+    # traceparent is returned so the caller can link the trace
+    with tracer.span('POST /predict', parent=traceparent, kind='server') as span:
+        response.headers[TRACEPARENT_HEADER] = span.traceparent
+        try:
+            # Deadline of the client (X-Request-Deadline-Ms) set by the admission control
+            client_deadline = getattr(http_request.state, 'deadline', None)
+            return await predict_request(request, span, x_model_name, x_model_version, client_deadline)
+        except HTTPException as e:
+            span.set_attribute('http.status_code', e.status_code)
+            raise
+
+@app.post("/models/{model_name}/versions/{model_version}/predict", response_model=PredictionResponse)
+async def predict_model(
+    model_name: str,
+    model_version: str,
+    request: PredictionRequest,
+    response: Response,
+    http_request: Request,
+    traceparent: Optional[str]=Header(None),
+):
+    return await predict(request, response, http_request, traceparent, x_model_name=model_name, x_model_version=model_version)
+
+async def predict_request(
+    request: PredictionRequest,
+    span,
+    model_name: str=None,
+    model_version: str=None,
+    client_deadline: float=None,
+) -> PredictionResponse:
+    deadlines = [
+        time.monotonic() + INPUT_FETCH_DEADLINE_MS / 1000 if INPUT_FETCH_DEADLINE_MS else None,
+        client_deadline,
+    ]
+    deadline = min((deadline for deadline in deadlines if deadline is not None), default=None)
+    if model_name is not None or model_version is not None:
+        # The model is loaded (or waited for) by the pipeline in the threadpool, not in the event loop
+        if app.state.model_cache is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Multi-model serving is not enabled")
+        if model_name is None or model_version is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Both the model name and version are required")
+        if not app.state.model_cache.is_allowed(model_name, model_version):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model {model_name} version {model_version} is not served")
+        span.set_attribute('model_name', model_name)
+        span.set_attribute('model_version', model_version)
+        served_model_version = f'{model_name}/{model_version}'
+    else:
+        # Entities scored by the last batch job are answered from memory, absent or stale ones by the live pipeline
+        if app.state.prediction_lookup is not None:
+            prediction = app.state.prediction_lookup.lookup(getattr(request, app.state.prediction_lookup_entity_field, None))
+            span.set_attribute('prediction_lookup.hit', prediction is not None)
+            if prediction is not None:
+                return PredictionResponse(prediction=prediction)
+
+        if app.state.model is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Model is not loaded")
+        served_model_version = point_prediction_generation_version
 
+    # Upstream retries and fan-out send identical requests within milliseconds: they wait for the execution in flight
+    # and get its prediction or its error. The pipeline runs in the threadpool, so it doesn't block the event loop
+    coalescing_request_key = coalescing_key(request, served_model_version)
+    span.set_attribute('coalesced', request_coalescer.is_in_flight(coalescing_request_key))
+    return await request_coalescer.run(
+        coalescing_request_key,
+        lambda: run_in_threadpool(run_pipeline, request, deadline, model_name, model_version),
+    )
+
+def run_pipeline(request: PredictionRequest, deadline: float=None, model_name: str=None, model_version: str=None) -> PredictionResponse:
     try:
     # A need to add the parameters in the beganing of this script        
+        # The stages pass the request as a StageData (src/stage_data.py): a one-row Arrow table from
+        # StageData.from_request(request), scored by the model without converting it to pandas
+        model = app.state.model if model_name is None else app.state.model_cache.get(model_name, model_version)
         input_data = input_data_ingestion(
             project_id=input_data_ingestion_project_id,
             version=input_data_ingestion_version,
@@ -102,6 +304,7 @@ async def predict(request: PredictionRequest):
             request=request,
             test_mode=input_data_ingestion_test_mode,
             labels=input_data_ingestion_labels,
+            deadline=deadline,
         )
     
         feature_datasets = feature_generation(
@@ -114,9 +317,9 @@ async def predict(request: PredictionRequest):
             labels=feature_generation_labels,
         )
         prediction = point_prediction_generation(
-            model=app.state.model,
+            model=model,
             project_id=point_prediction_generation_project_id,
-            version=point_prediction_generation_version,
+            version=model_version or point_prediction_generation_version,
             feature_datasets=feature_datasets,
             location=point_prediction_generation_location,
             secret_path=point_prediction_generation_secret_path,
@@ -125,10 +328,86 @@ async def predict(request: PredictionRequest):
         )
     
         return PredictionResponse(prediction=prediction)
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f"An error occurred during prediction: {str(e)}")
     except Exception as e:
         # Catching any prediction related error
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred during prediction: {str(e)}")
 
+@app.post("/similar", response_model=SimilarResponse)
+def similar(request: SimilarRequest):
+    # Sync endpoint: FastAPI runs it in its threadpool, so the searches don't block the event loop
+    if app.state.vector_searcher is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Vector index is not loaded")
+    if (request.ids is None) == (request.vectors is None):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Set either ids or vectors")
+
+    try:
+        if request.ids is not None:
+            results = app.state.vector_searcher.search_by_ids(request.ids, k=request.k, search_k=request.search_k)
+        else:
+            results = app.state.vector_searcher.search_by_vectors(request.vectors, k=request.k, search_k=request.search_k)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e).strip("'"))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+    return SimilarResponse(results=results, index_version=app.state.vector_searcher.version)
+
+# /debug/profile and /debug/memory inspect the live process (e.g. a slow replica) without redeploying it. They are
+# enabled when DEBUG_TOKEN is set, and every request must send it in the X-Debug-Token header
+def check_debug_token(x_debug_token: Optional[str]):
+    debug_token = os.environ.get('DEBUG_TOKEN')
+    if not debug_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not x_debug_token or not hmac.compare_digest(x_debug_token, debug_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid debug token")
+
+@app.get("/debug/profile")
+def debug_profile(
+    seconds: float=10.0,
+    interval: float=0.005,
+    format: str='collapsed',
+    include_idle: bool=False,
+    x_debug_token: Optional[str]=Header(None),
+):
+    # Sync endpoint: the sampling runs in the threadpool while the event loop keeps serving the traffic it profiles
+    check_debug_token(x_debug_token)
+    if not 0 < seconds <= MAX_SECONDS or not 0 < interval <= seconds:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"seconds must be between 0 and {MAX_SECONDS} and interval between 0 and seconds")
+    if format not in ('collapsed', 'speedscope'):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="format must be 'collapsed' or 'speedscope'")
+
+    try:
+        samples = sample_stacks(seconds, interval=interval, include_idle=include_idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    if format == 'speedscope':
+        return JSONResponse(
+            content=to_speedscope(samples, interval),
+            headers={"Content-Disposition": 'attachment; filename="profile.speedscope.json"'},
+        )
+    return Response(content=to_collapsed(samples), media_type="text/plain")
+
+@app.get("/debug/memory")
+def debug_memory(
+    seconds: float=10.0,
+    top: int=20,
+    group_by: str='lineno',
+    x_debug_token: Optional[str]=Header(None),
+):
+    check_debug_token(x_debug_token)
+    if not 0 <= seconds <= MAX_SECONDS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"seconds must be between 0 and {MAX_SECONDS}")
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="group_by must be 'lineno', 'filename' or 'traceback'")
+
+    try:
+        return memory_snapshot(seconds, top=top, group_by=group_by)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -0,0 +1,205 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from debug_profiler import _read_rss_bytes
+except ImportError:
+    from src.debug_profiler import _read_rss_bytes
+
+
+# Auxiliar functions
+class _ByteCounter:
+    """File-like object that only counts the bytes written, to size a pickle without keeping it in memory."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data) -> int:
+        # Large buffers (e.g. NumPy arrays) are written as PickleBuffer objects, without a length
+        size = memoryview(data).nbytes
+        self.size += size
+        return size
+
+
+def estimate_model_bytes(model) -> Optional[int]:
+    """
+    Returns the size of a model as the size of its pickle, close to its memory for the models of arrays (sklearn,
+    LinearScorer, boosters...), or None if it can't be pickled.
+    """
+    counter = _ByteCounter()
+    try:
+        pickle.dump(model, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    return counter.size
+
+
+def parse_model_keys(models: str) -> Optional[List[Tuple[str, Optional[str]]]]:
+    """
+    Returns the (model_name, version) pairs of a comma-separated list of 'model_name' or 'model_name:version'
+    (every version of the model), or None if the list is empty.
+    """
+    keys = []
+    for model in (models or '').split(','):
+        if model.strip():
+            model_name, _, version = model.strip().partition(':')
+            keys.append((model_name, version or None))
+    return keys or None
+
+
+# Main functions
+class ModelCache:
+    """
+    This class serves several models (model_name/version pairs) from one app: every model is loaded the first time
+    it is requested and kept in memory while the models fit in 'max_bytes'. When a load exceeds the budget, the least
+    recently used models are evicted. The loads are serialized, so the peak memory of the app is bounded by the
+    budget plus a single model being loaded, and the requests of a model that is being loaded wait for it instead of
+    loading it again. The models already loaded are served while another one is loaded.
+
+    The size of a model is 'size_function(model)' (default: the size of its pickle) or, if it is None, the growth
+    of the resident memory of the process during its load. An evicted model is freed once the requests that are
+    using it end.
+
+    Parameters:
+    - loader (Callable): Function loader(model_name, version) that returns the model, e.g. a call to model_ingestion.
+    - max_bytes (int): Memory budget of the loaded models in bytes. A model larger than the budget is loaded alone.
+    - allowed_models (List[Tuple[str, str]], optional): (model_name, version) pairs that can be loaded, a version
+      None allows every version of the model. Default: every model.
+    - size_function (Callable, optional): Function that returns the size of a model in bytes.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str, str], Any],
+        max_bytes: int,
+        allowed_models: List[Tuple[str, Optional[str]]]=None,
+        size_function: Callable[[Any], Optional[int]]=estimate_model_bytes,
+    ):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.allowed_models = allowed_models
+        self.size_function = size_function
+        self._models = OrderedDict()
+        self._model_metrics = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'evictions': 0}
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(entry['size_bytes'] for entry in self._models.values())
+
+    def is_allowed(self, model_name: str, version: str) -> bool:
+        if self.allowed_models is None:
+            return True
+        return (model_name, version) in self.allowed_models or (model_name, None) in self.allowed_models
+
+    def _hit(self, key: Tuple[str, str]):
+        entry = self._models.get(key)
+        if entry is not None:
+            self._models.move_to_end(key)
+            entry['last_used_at'] = time.time()
+            self._model_metrics[key]['hits'] += 1
+            self.stats['hits'] += 1
+        return entry
+
+    def _evict(self, loaded_key: Tuple[str, str]):
+        while self.resident_bytes > self.max_bytes and len(self._models) > 1:
+            key = next(key for key in self._models if key != loaded_key)
+            entry = self._models.pop(key)
+            metrics = self._model_metrics[key]
+            metrics['evictions'] += 1
+            metrics['resident_seconds'] += time.time() - entry['loaded_at']
+            self.stats['evictions'] += 1
+
+    def get(self, model_name: str, version: str):
+        """
+        Returns the model, loading it if it isn't in the cache.
+
+        Raises:
+        - KeyError: If the model isn't in 'allowed_models'.
+        - The error of the loader if the model can't be loaded.
+        """
+        if not self.is_allowed(model_name, version):
+            raise KeyError(f'Model {model_name} version {version} is not served by this app')
+        key = (model_name, version)
+        with self._lock:
+            entry = self._hit(key)
+        if entry is not None:
+            return entry['model']
+
+        with self._load_lock:
+            with self._lock:
+                # It may have been loaded by another request while this one was waiting
+                entry = self._hit(key)
+                if entry is not None:
+                    return entry['model']
+                self.stats['misses'] += 1
+                metrics = self._model_metrics.setdefault(key, {
+                    'loads': 0, 'hits': 0, 'evictions': 0, 'load_seconds': 0.0, 'last_load_seconds': None,
+                    'size_bytes': None, 'resident_seconds': 0.0,
+                })
+
+            rss_start = _read_rss_bytes()
+            load_start = time.perf_counter()
+            try:
+                model = self.loader(model_name, version)
+            except Exception:
+                with self._lock:
+                    self.stats['load_errors'] += 1
+                raise
+            load_seconds = time.perf_counter() - load_start
+            size_bytes = self.size_function(model) if self.size_function is not None else None
+            if size_bytes is None:
+                rss_end = _read_rss_bytes()
+                size_bytes = max(rss_end - rss_start, 0) if rss_start is not None and rss_end is not None else 0
+
+            with self._lock:
+                now = time.time()
+                self._models[key] = {'model': model, 'size_bytes': size_bytes, 'loaded_at': now, 'last_used_at': now}
+                metrics.update({
+                    'loads': metrics['loads'] + 1,
+                    'load_seconds': metrics['load_seconds'] + load_seconds,
+                    'last_load_seconds': load_seconds,
+                    'size_bytes': size_bytes,
+                })
+                self.stats['loads'] += 1
+                self._evict(key)
+            return model
+
+    def metrics(self) -> Dict:
+        """
+        Returns the memory used by the loaded models and the budget, the hits, misses, loads and evictions of the
+        cache and, by model, its load time, size, hits, evictions and residency (if it is loaded now, since when and
+        the seconds it was loaded in total).
+        """
+        with self._lock:
+            now = time.time()
+            models = []
+            for (model_name, version), metrics in self._model_metrics.items():
+                entry = self._models.get((model_name, version))
+                models.append({
+                    'model_name': model_name,
+                    'version': version,
+                    'resident': entry is not None,
+                    'loaded_at': datetime.fromtimestamp(entry['loaded_at'], timezone.utc).isoformat() if entry else None,
+                    'last_used_at': datetime.fromtimestamp(entry['last_used_at'], timezone.utc).isoformat() if entry else None,
+                    'size_bytes': metrics['size_bytes'],
+                    'loads': metrics['loads'],
+                    'hits': metrics['hits'],
+                    'evictions': metrics['evictions'],
+                    'last_load_seconds': None if metrics['last_load_seconds'] is None else round(metrics['last_load_seconds'], 3),
+                    'mean_load_seconds': round(metrics['load_seconds'] / metrics['loads'], 3) if metrics['loads'] else None,
+                    'resident_seconds': round(metrics['resident_seconds'] + (now - entry['loaded_at'] if entry else 0), 1),
+                })
+            return {
+                'max_bytes': self.max_bytes,
+                'resident_bytes': self.resident_bytes,
+                'resident_models': len(self._models),
+                **self.stats,
+                'models': models,
+            }
@@ -0,0 +1,197 @@
+import os
+import re
+import itertools
+import time
+import tempfile
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+
+# Auxiliar functions
+def _list_files(path: str, dataset_index: int) -> List[Dict]:
+    """
+    Lists the Parquet files of the dataset 'dataset_index' stored under 'path' by 'prediction_storing'
+    (<path>/.../dataset-<i>/.../*.parquet, e.g. a file of every chunk and of the unchanged predictions), with
+    their size and update time.
+    """
+    pattern = re.compile(rf'(^|/)dataset-{dataset_index}/(.+/)?[^/.][^/]*\.parquet$')
+    if path.startswith('gs://'):
+        from google.cloud import storage
+        bucket_name, _, prefix = path[len('gs://'):].partition('/')
+        prefix = prefix.rstrip('/') + '/' if prefix else ''
+        return [
+            {'uri': f'gs://{bucket_name}/{blob.name}', 'size': blob.size, 'updated': blob.updated.timestamp(), 'generation': blob.generation}
+            for blob in storage.Client().list_blobs(bucket_name, prefix=prefix)
+            if pattern.search(blob.name[len(prefix):])
+        ]
+
+    files = []
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            uri = os.path.join(directory, file_name)
+            if pattern.search(os.path.relpath(uri, path).replace(os.sep, '/')):
+                file_stat = os.stat(uri)
+                files.append({'uri': uri, 'size': file_stat.st_size, 'updated': file_stat.st_mtime, 'generation': file_stat.st_mtime_ns})
+    return files
+
+
+# Main functions
+class PredictionLookupStore:
+    """
+    This class serves the predictions of the last batch prediction job (the files stored by 'prediction_storing' in
+    postprocessing) from an in-memory hash index by entity, so the entities already scored are answered in
+    microseconds instead of running the pipeline again. A prediction is fresh while the file it was loaded from is
+    younger than 'max_age_seconds' (the age of every entity is the one of its own file, so the entities only found
+    in old files are stale even if other files are new); absent and stale entities must be scored by the live
+    pipeline. An entity in several files gets the prediction of the newest one.
+
+    If 'refresh_seconds' is set, a background thread lists the files every 'refresh_seconds' and, if they
+    changed (e.g. a new daily job), loads them and swaps the new index in atomically.
+
+    Parameters:
+    - path (str): Local directory or GCS URI (gs://bucket/path) of the batch predictions.
+    - entity_column (str): Column that identifies the entities. Ids are compared as strings.
+    - prediction_column (str, optional): Column served as prediction. Default: a dict with every other column.
+    - max_age_seconds (float, optional): Age of the predictions before they are stale. Default: never stale.
+    - refresh_seconds (float, optional): Seconds between listings of the files. Default: no reloads.
+    - dataset_index (int): Prediction dataset served (dataset-<i>). Default: 0.
+    - cache_dir (str, optional): Local directory to download GCS files. Default: a temporary directory.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        entity_column: str,
+        prediction_column: str=None,
+        max_age_seconds: float=None,
+        refresh_seconds: float=None,
+        dataset_index: int=0,
+        cache_dir: str=None,
+    ):
+        self.path = path.rstrip('/')
+        self.entity_column = entity_column
+        self.prediction_column = prediction_column
+        self.max_age_seconds = max_age_seconds
+        self.dataset_index = dataset_index
+        self.cache_dir = cache_dir or tempfile.mkdtemp(prefix='prediction-lookup-')
+        self._state = None
+        self._counters_lock = threading.Lock()
+        self._counters = {'lookups': 0, 'hits': 0, 'misses': 0, 'stale': 0, 'lookup_seconds': 0.0}
+        self.refresh()
+
+        self._stop = threading.Event()
+        if refresh_seconds:
+            thread = threading.Thread(target=self._refresh_loop, args=(refresh_seconds,), name='prediction-lookup-refresh', daemon=True)
+            thread.start()
+
+    def _read_file(self, file: Dict):
+        import pyarrow.parquet as pq
+
+        local_path = file['uri']
+        if local_path.startswith('gs://'):
+            from google.cloud import storage
+            local_path = os.path.join(self.cache_dir, f"{file['generation']}-{os.path.basename(local_path)}")
+            storage.Blob.from_string(file['uri'], client=storage.Client()).download_to_filename(local_path)
+        columns = [self.entity_column, self.prediction_column] if self.prediction_column else None
+        table = pq.read_table(local_path, columns=columns)
+        if file['uri'].startswith('gs://'):
+            os.remove(local_path)
+        return table
+
+    def refresh(self) -> bool:
+        """
+        Lists the files and loads them if they changed since the last load.
+
+        Returns:
+        - True if the served predictions changed.
+        """
+        files = sorted(_list_files(self.path, self.dataset_index), key=lambda file: file['uri'])
+        signature = tuple((file['uri'], file['generation']) for file in files)
+        # The newest files are loaded last, so their predictions win
+        if self._state is not None and signature == self._state['signature']:
+            return False
+
+        load_start = time.perf_counter()
+        predictions = {}
+        for file in sorted(files, key=lambda file: file['updated']):
+            table = self._read_file(file)
+            entity_ids = table.column(self.entity_column).to_pylist()
+            if self.prediction_column:
+                values = table.column(self.prediction_column).to_pylist()
+            else:
+                values = table.drop_columns([self.entity_column]).to_pylist()
+            # Every prediction keeps the update time of its file, to check its own age
+            predictions.update(zip(map(str, entity_ids), zip(values, itertools.repeat(file['updated']))))
+
+        # A single assignment, so the requests see the previous predictions or the new ones
+        self._state = {
+            'signature': signature,
+            'predictions': predictions,
+            'files': len(files),
+            'updated_at': max((file['updated'] for file in files), default=None),
+            'loaded_at': time.time(),
+            'load_seconds': time.perf_counter() - load_start,
+        }
+        return True
+
+    def _refresh_loop(self, refresh_seconds: float):
+        while not self._stop.wait(refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing prediction lookup: {e}")
+
+    def close(self):
+        self._stop.set()
+
+    @property
+    def staleness_seconds(self) -> Optional[float]:
+        """
+        Age of the served predictions: seconds since their newest file was written. Every prediction is checked
+        against the age of its own file (see 'lookup').
+        """
+        updated_at = self._state['updated_at']
+        return None if updated_at is None else max(time.time() - updated_at, 0.0)
+
+    def lookup(self, entity_id) -> Optional[Any]:
+        """
+        Returns the prediction of the entity, or None if the entity is absent or its prediction is stale.
+        """
+        lookup_start = time.perf_counter()
+        state = self._state
+        prediction, updated_at = (None, None) if entity_id is None else state['predictions'].get(str(entity_id), (None, None))
+        stale = prediction is not None and self.max_age_seconds is not None and time.time() - updated_at > self.max_age_seconds
+        lookup_seconds = time.perf_counter() - lookup_start
+
+        with self._counters_lock:
+            self._counters['lookups'] += 1
+            self._counters['hits' if prediction is not None and not stale else 'stale' if stale else 'misses'] += 1
+            self._counters['lookup_seconds'] += lookup_seconds
+        return None if stale else prediction
+
+    def metrics(self) -> Dict:
+        """
+        Returns the size and age of the served predictions, and the hits, misses (absent entities), stale
+        predictions, hit rate and mean latency of the lookups.
+        """
+        state = self._state
+        with self._counters_lock:
+            counters = dict(self._counters)
+        lookups = counters.pop('lookups')
+        lookup_seconds = counters.pop('lookup_seconds')
+        staleness_seconds = self.staleness_seconds
+        return {
+            'path': self.path,
+            'entities': len(state['predictions']),
+            'files': state['files'],
+            'updated_at': datetime.fromtimestamp(state['updated_at'], timezone.utc).isoformat() if state['updated_at'] else None,
+            'loaded_at': datetime.fromtimestamp(state['loaded_at'], timezone.utc).isoformat(),
+            'load_seconds': round(state['load_seconds'], 3),
+            'staleness_seconds': None if staleness_seconds is None else round(staleness_seconds, 1),
+            'max_age_seconds': self.max_age_seconds,
+            'lookups': lookups,
+            **counters,
+            'hit_rate': round(counters['hits'] / lookups, 4) if lookups else None,
+            'mean_lookup_microseconds': round(lookup_seconds / lookups * 1e6, 3) if lookups else None,
+        }
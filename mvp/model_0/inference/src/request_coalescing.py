@@ -0,0 +1,64 @@
+import json
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+
+# Auxiliar functions
+def coalescing_key(request, model_version: str) -> str:
+    """
+    Returns the key of a request of the API (a pydantic model or a dict) for a model version: its fields as
+    canonical JSON (sorted keys, no whitespace), so identical payloads get the same key whatever the order of their
+    fields. The fields are the ones validated by the schema, so equivalent values (e.g. 1 and 1.0 in a float
+    field) are already normalized.
+    """
+    fields = request if isinstance(request, dict) else (request.model_dump() if hasattr(request, 'model_dump') else request.dict())
+    return json.dumps([model_version, fields], sort_keys=True, separators=(',', ':'), default=str)
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # The error is raised to every waiter, this avoids the 'exception was never retrieved' warning without them
+    if not task.cancelled():
+        task.exception()
+
+
+# Main functions
+class RequestCoalescer:
+    """
+    This class runs at most one execution of a coroutine function by key at the same time (single flight): the
+    requests that arrive while an identical one is in flight wait for its execution and all get its result, or its
+    error. The execution is a task of its own, so a waiter that is cancelled (e.g. its client disconnected) doesn't
+    cancel it for the others. Once it ends, the key is released: it isn't a cache, the next identical request runs
+    again.
+
+    Example:
+        prediction = await coalescer.run(coalescing_key(request, version), lambda: run_in_threadpool(pipeline, request))
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.stats = {'executions': 0, 'coalesced_requests': 0, 'in_flight': 0}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    def _release(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        self.stats['in_flight'] = len(self._in_flight)
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable]):
+        """
+        Returns the result of function() for the key, running it only if there isn't an execution of the same key
+        in flight. The error of the execution is raised to every request that waited for it.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            task.add_done_callback(_retrieve_exception)
+            task.add_done_callback(lambda done_task: self._release(key, done_task))
+            self.stats['executions'] += 1
+            self.stats['in_flight'] = len(self._in_flight)
+        else:
+            self.stats['coalesced_requests'] += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,341 @@
+import os
+import json
+import tempfile
+import threading
+from typing import Dict, List, Optional, Union
+
+from pydantic import BaseModel
+
+
+INDEX_FILE_NAME = 'index.ann'
+IDS_FILE_NAME = 'ids.npy'
+INDEX_MANIFEST_FILE_NAME = 'index_manifest.json'
+CURRENT_FILE_NAME = 'CURRENT'
+DELTA_VECTORS_FILE_NAME = 'vectors.npy'
+DELTA_DELETED_IDS_FILE_NAME = 'deleted_ids.npy'
+
+
+# API schemas
+class SimilarRequest(BaseModel):
+    ids: Optional[List[Union[int, str]]] = None
+    vectors: Optional[List[List[float]]] = None
+    k: int = 10
+    search_k: Optional[int] = None
+
+
+class Neighbor(BaseModel):
+    id: Union[int, str]
+    distance: float
+
+
+class SimilarResponse(BaseModel):
+    results: List[List[Neighbor]]
+    index_version: str
+
+
+# Auxiliar functions
+def _download_directory(input_uri: str, local_dir: str) -> str:
+    from google.cloud import storage
+    client = storage.Client()
+    bucket_name, _, prefix = input_uri[len('gs://'):].partition('/')
+    os.makedirs(local_dir, exist_ok=True)
+    for blob in client.list_blobs(bucket_name, prefix=prefix.rstrip('/') + '/'):
+        blob.download_to_filename(os.path.join(local_dir, os.path.basename(blob.name)))
+    return local_dir
+
+
+def _read_text(uri: str):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(uri, client=storage.Client())
+        return blob.download_as_text() if blob.exists() else None
+    if not os.path.exists(uri):
+        return None
+    with open(uri) as input_file:
+        return input_file.read()
+
+
+def _brute_force_distances(vectors, query, metric: str):
+    """
+    Distances of the rows of 'vectors' to 'query', with the same definitions as Annoy.
+    """
+    import numpy as np
+
+    if metric == 'angular':
+        norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query) or 1.0)
+        cosine = vectors @ query / np.where(norms > 0, norms, 1.0)
+        return np.sqrt(np.maximum(2 - 2 * cosine, 0))
+    if metric == 'euclidean':
+        return np.linalg.norm(vectors - query, axis=1)
+    if metric == 'manhattan':
+        return np.abs(vectors - query).sum(axis=1)
+    if metric == 'dot':
+        return vectors @ query
+    return (vectors != query).sum(axis=1).astype(np.float32)
+
+
+def _merge_delta_segments(segments: List[tuple]) -> tuple:
+    # Same rules as merge_delta_segments of postprocessing/src/vector_index.py: newer segments win and the base
+    # ids deleted or replaced by a delta are hidden
+    import numpy as np
+
+    live = {}
+    hidden_ids = set()
+    for ids, vectors, deleted_ids in segments:
+        for entity_id in deleted_ids.tolist():
+            live.pop(entity_id, None)
+            hidden_ids.add(entity_id)
+        for entity_id, vector in zip(ids.tolist(), vectors):
+            live[entity_id] = vector
+            hidden_ids.add(entity_id)
+    dimensions = segments[0][1].shape[1] if segments else 0
+    delta_vectors = np.vstack(list(live.values())).astype(np.float32) if live else np.empty((0, dimensions), dtype=np.float32)
+    return list(live), delta_vectors, hidden_ids
+
+
+# Main functions
+class VectorSearcher:
+    """
+    This class serves the Annoy index built by 'build_vector_index' (postprocessing/src/vector_index.py). The index
+    is memory-mapped, so it is loaded instantly and shared by every worker process of the app through the page cache.
+
+    Recall and latency are tuned by query with 'search_k', the number of nodes inspected: a bigger search_k gives
+    better recall and slower queries. By default it is 'default_search_k', or n_trees * k if it is None (the
+    default of Annoy).
+
+    Parameters:
+    - index_path (str): Local directory or GCS URI (gs://bucket/path) of the index. GCS indexes are downloaded to
+      'cache_dir' first.
+    - default_search_k (int, optional): search_k of the queries that don't set it.
+    - cache_dir (str, optional): Local directory to download GCS indexes. Default: a temporary directory.
+    """
+
+    def __init__(self, index_path: str, default_search_k: int=None, cache_dir: str=None):
+        from annoy import AnnoyIndex
+        import numpy as np
+
+        if index_path.startswith('gs://'):
+            index_path = _download_directory(index_path, cache_dir or tempfile.mkdtemp(prefix='vector-index-'))
+        with open(os.path.join(index_path, INDEX_MANIFEST_FILE_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.version = self.manifest['version']
+        self.dimensions = self.manifest['dimensions']
+        self.default_search_k = default_search_k
+
+        self.index = AnnoyIndex(self.dimensions, self.manifest['metric'])
+        self.index.load(os.path.join(index_path, INDEX_FILE_NAME))
+        self.ids = np.load(os.path.join(index_path, IDS_FILE_NAME), allow_pickle=False).tolist()
+        self.items_by_id = {entity_id: item for item, entity_id in enumerate(self.ids)}
+
+    def _neighbors(self, items: List[int], distances: List[float], exclude_item: int=None) -> List[Dict]:
+        return [
+            {'id': self.ids[item], 'distance': distance}
+            for item, distance in zip(items, distances)
+            if item != exclude_item
+        ]
+
+    def search_by_vectors(self, vectors: List[List[float]], k: int=10, search_k: int=None) -> List[List[Dict]]:
+        """
+        Returns the k nearest neighbors ({'id', 'distance'}) of every vector.
+
+        Raises:
+        - ValueError: If a vector doesn't have the dimensions of the index.
+        """
+        search_k = search_k or self.default_search_k or -1
+        results = []
+        for vector in vectors:
+            if len(vector) != self.dimensions:
+                raise ValueError(f'Every vector must have {self.dimensions} dimensions, got {len(vector)}')
+            items, distances = self.index.get_nns_by_vector(vector, k, search_k=search_k, include_distances=True)
+            results.append(self._neighbors(items, distances))
+        return results
+
+    def search_by_ids(self, ids: List[Union[int, str]], k: int=10, search_k: int=None) -> List[List[Dict]]:
+        """
+        Returns the k nearest neighbors ({'id', 'distance'}) of the embedding of every id, without the id itself.
+
+        Raises:
+        - KeyError: If an id isn't in the index.
+        """
+        search_k = search_k or self.default_search_k or -1
+        results = []
+        for entity_id in ids:
+            if entity_id not in self.items_by_id:
+                raise KeyError(f'id {entity_id} is not in the index')
+            item = self.items_by_id[entity_id]
+            items, distances = self.index.get_nns_by_item(item, k + 1, search_k=search_k, include_distances=True)
+            results.append(self._neighbors(items, distances, exclude_item=item)[:k])
+        return results
+
+
+class SegmentedVectorSearcher:
+    """
+    This class serves an index maintained by 'SegmentedVectorIndex' (postprocessing/src/vector_index.py): a base
+    Annoy index plus delta segments with new, changed and deleted embeddings, listed in <index_root>/CURRENT. The
+    deltas are searched by brute force next to the base index and the base results hidden by a delta are
+    filtered out. A directory with a single index built by 'build_vector_index' is served as a base without deltas.
+
+    If 'refresh_seconds' is set, a background thread reloads CURRENT every 'refresh_seconds' and swaps the new
+    segments in atomically, so new embeddings are served without restarting the app or waiting for a rebuild.
+
+    Parameters:
+    - index_root (str): Local directory or GCS URI (gs://bucket/path) of the index.
+    - default_search_k (int, optional): search_k of the queries that don't set it (see 'VectorSearcher').
+    - refresh_seconds (float, optional): Seconds between reloads of CURRENT. Default: no reloads.
+    - cache_dir (str, optional): Local directory to download GCS segments. Default: a temporary directory.
+    - overfetch_factor (int): Neighbors asked to the base index by neighbor returned, to make up for the ones
+      hidden by the deltas. If too few are left, the query is repeated with overfetch_factor^2 times more. Default: 2.
+    """
+
+    def __init__(self, index_root: str, default_search_k: int=None, refresh_seconds: float=None, cache_dir: str=None, overfetch_factor: int=2):
+        self.index_root = index_root.rstrip('/')
+        self.overfetch_factor = max(int(overfetch_factor), 2)
+        self.default_search_k = default_search_k
+        self.cache_dir = cache_dir or tempfile.mkdtemp(prefix='vector-index-')
+        self._bases = {}
+        self._deltas = {}
+        self._current_text = None
+        self._state = None
+        self.refresh()
+
+        self._stop = threading.Event()
+        if refresh_seconds:
+            thread = threading.Thread(target=self._refresh_loop, args=(refresh_seconds,), name='vector-index-refresh', daemon=True)
+            thread.start()
+
+    def _segment_path(self, segment: str) -> str:
+        uri = f'{self.index_root}/{segment}'
+        return _download_directory(uri, os.path.join(self.cache_dir, segment)) if uri.startswith('gs://') else uri
+
+    def _load_delta(self, segment: str) -> tuple:
+        import numpy as np
+
+        if segment not in self._deltas:
+            path = self._segment_path(segment)
+            self._deltas[segment] = tuple(
+                np.load(os.path.join(path, file_name), allow_pickle=False)
+                for file_name in (IDS_FILE_NAME, DELTA_VECTORS_FILE_NAME, DELTA_DELETED_IDS_FILE_NAME)
+            )
+        return self._deltas[segment]
+
+    def refresh(self) -> bool:
+        """
+        Reloads CURRENT and swaps the new segments in if it changed. Segments are immutable, so only the new ones
+        are loaded.
+
+        Returns:
+        - True if the served index changed.
+        """
+        current_text = _read_text(f'{self.index_root}/{CURRENT_FILE_NAME}')
+        if self._state is not None and current_text == self._current_text:
+            return False
+        if current_text is None:
+            current = {'base': None, 'deltas': []}
+            base = VectorSearcher(self.index_root, cache_dir=self.cache_dir)
+            current['version'] = base.version
+        else:
+            current = json.loads(current_text)
+            if current['base'] not in self._bases:
+                self._bases = {current['base']: VectorSearcher(self._segment_path(current['base']))}
+            base = self._bases[current['base']]
+        delta_names = [delta['name'] for delta in current['deltas']]
+        delta_ids, delta_vectors, hidden_ids = _merge_delta_segments([self._load_delta(segment) for segment in delta_names])
+        self._deltas = {segment: self._deltas[segment] for segment in delta_names}
+
+        # A single assignment, so the queries see the previous state or the new one
+        self._state = {
+            'version': current['version'],
+            'base': base,
+            'delta_ids': delta_ids,
+            'delta_items_by_id': {entity_id: row for row, entity_id in enumerate(delta_ids)},
+            'delta_vectors': delta_vectors,
+            'hidden_ids': hidden_ids,
+        }
+        self._current_text = current_text
+        return True
+
+    def _refresh_loop(self, refresh_seconds: float):
+        while not self._stop.wait(refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing vector index: {e}")
+
+    def close(self):
+        self._stop.set()
+
+    @property
+    def version(self) -> str:
+        return self._state['version']
+
+    @property
+    def dimensions(self) -> int:
+        return self._state['base'].dimensions
+
+    def _search(self, state: Dict, vector, k: int, search_k: int, exclude_id=None) -> List[Dict]:
+        import numpy as np
+
+        base = state['base']
+        metric = base.manifest['metric']
+        hidden_ids = state['hidden_ids']
+        # Over-fetch by a bounded factor, so the latency of a query depends on k and not on the size of the deltas
+        # (Annoy inspects n * n_trees nodes by default), and only fetch more if too few neighbors survive the
+        # filter of the hidden ids. The whole index is fetched as a last resort.
+        n = min(self.overfetch_factor * k + (exclude_id is not None), len(base.ids))
+        while True:
+            items, distances = base.index.get_nns_by_vector(vector, n, search_k=search_k, include_distances=True)
+            neighbors = [
+                {'id': base.ids[item], 'distance': distance}
+                for item, distance in zip(items, distances)
+                if base.ids[item] not in hidden_ids and base.ids[item] != exclude_id
+            ]
+            if len(neighbors) >= k or n >= len(base.ids):
+                break
+            n = min(n * self.overfetch_factor ** 2, len(base.ids))
+        if state['delta_ids']:
+            delta_distances = _brute_force_distances(state['delta_vectors'], np.asarray(vector, dtype=np.float32), metric)
+            neighbors += [
+                {'id': entity_id, 'distance': float(distance)}
+                for entity_id, distance in zip(state['delta_ids'], delta_distances)
+                if entity_id != exclude_id
+            ]
+        # Annoy returns the dot product as distance of the 'dot' metric, the bigger the closer
+        neighbors.sort(key=lambda neighbor: -neighbor['distance'] if metric == 'dot' else neighbor['distance'])
+        return neighbors[:k]
+
+    def search_by_vectors(self, vectors: List[List[float]], k: int=10, search_k: int=None) -> List[List[Dict]]:
+        """
+        Returns the k nearest neighbors ({'id', 'distance'}) of every vector in the base index and the deltas.
+
+        Raises:
+        - ValueError: If a vector doesn't have the dimensions of the index.
+        """
+        state = self._state
+        search_k = search_k or self.default_search_k or -1
+        results = []
+        for vector in vectors:
+            if len(vector) != state['base'].dimensions:
+                raise ValueError(f"Every vector must have {state['base'].dimensions} dimensions, got {len(vector)}")
+            results.append(self._search(state, vector, k, search_k))
+        return results
+
+    def search_by_ids(self, ids: List[Union[int, str]], k: int=10, search_k: int=None) -> List[List[Dict]]:
+        """
+        Returns the k nearest neighbors ({'id', 'distance'}) of the latest embedding of every id, without the id
+        itself.
+
+        Raises:
+        - KeyError: If an id isn't in the index or was deleted.
+        """
+        state = self._state
+        search_k = search_k or self.default_search_k or -1
+        results = []
+        for entity_id in ids:
+            if entity_id in state['delta_items_by_id']:
+                vector = state['delta_vectors'][state['delta_items_by_id'][entity_id]].tolist()
+            elif entity_id in state['base'].items_by_id and entity_id not in state['hidden_ids']:
+                vector = state['base'].index.get_item_vector(state['base'].items_by_id[entity_id])
+            else:
+                raise KeyError(f'id {entity_id} is not in the index')
+            results.append(self._search(state, vector, k, search_k, exclude_id=entity_id))
+        return results
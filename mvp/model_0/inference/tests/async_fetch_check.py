@@ -0,0 +1,142 @@
+"""
+Checks the deadlines, hedging and partial results of 'AsyncFetcher' (src/async_fetch.py) against a local stand-in
+server with injected latency and failures, so they are checked without the real feature store or APIs:
+- deadline: a required source slower than the deadline fails the request with DeadlineExceededError, at the
+  deadline and not when the source answers.
+- hedge_win: a source whose first lookup is slow is hedged, and the duplicate lookup answers first.
+- optional_timeout: an optional source that times out is left out of a partial result.
+- required_failure: a required source that fails in every attempt fails the request with SourceUnavailableError.
+It fails (exit code 1) if any check doesn't pass.
+
+Usage: python tests/async_fetch_check.py [--slow_ms 500]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+# Run from the component directory: python tests/async_fetch_check.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.async_fetch import AsyncFetcher, DeadlineExceededError, SourceUnavailableError, http_source
+
+
+# Auxiliar functions
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /<name>?delay_ms=<ms>&status=<code>&first_delay_ms=<ms> with {'source': name, 'attempt': n} after
+    'delay_ms' (or 'first_delay_ms' for the first request of the path, to make a lookup slow only once).
+    """
+    protocol_version = 'HTTP/1.1'
+    # Small responses must not wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests[url.path] += 1
+            attempt = self.server.requests[url.path]
+        delay_ms = float(params.get('first_delay_ms', params.get('delay_ms', 0)) if attempt == 1 else params.get('delay_ms', 0))
+        time.sleep(delay_ms / 1000)
+
+        body = json.dumps({'source': url.path.strip('/'), 'attempt': attempt}).encode()
+        try:
+            self.send_response(int(params.get('status', 200)))
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # the lookups timed out or hedged are cancelled
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = Counter()
+    threading.Thread(target=server.serve_forever, name='stand-in-server', daemon=True).start()
+    return server
+
+
+def _deadline(milliseconds: float) -> float:
+    return time.monotonic() + milliseconds / 1000
+
+
+# Main functions
+def run_checks(slow_ms: float=500) -> List[Dict]:
+    """
+    This function runs every check against a new stand-in server.
+
+    Returns:
+    - The report of every check: 'passed' and what was observed.
+    """
+    server = start_stand_in_server()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    reports = []
+
+    def check(name: str, sources: list, deadline_ms: float=None, **fetcher_kwargs) -> Dict:
+        fetcher = AsyncFetcher(sources, **fetcher_kwargs).start()
+        start = time.perf_counter()
+        try:
+            result, error = fetcher.fetch_sync({}, deadline=None if deadline_ms is None else _deadline(deadline_ms)), None
+        except Exception as e:
+            result, error = None, e
+        report = {'check': name, 'elapsed_ms': round((time.perf_counter() - start) * 1000, 1), 'error': type(error).__name__ if error else None}
+        if result is not None:
+            report.update({'values': result.values, 'missing': result.missing, 'hedged': result.hedged})
+        report['stats'] = dict(fetcher.stats)
+        fetcher.close()
+        return report
+
+    try:
+        report = check('deadline', [http_source('slow', f'{base_url}/slow?delay_ms={slow_ms}')], deadline_ms=100)
+        report['passed'] = report['error'] == DeadlineExceededError.__name__ and report['elapsed_ms'] < slow_ms / 2
+        reports.append(report)
+
+        report = check('hedge_win', [http_source('flaky', f'{base_url}/flaky?first_delay_ms={slow_ms}&delay_ms=5', hedge_after_ms=30)])
+        report['passed'] = (
+            report['error'] is None and report['values']['flaky']['attempt'] == 2 and report['hedged'] == ['flaky']
+            and report['stats']['hedge_wins'] == 1 and report['elapsed_ms'] < slow_ms / 2
+        )
+        reports.append(report)
+
+        report = check('optional_timeout', [
+            http_source('required', f'{base_url}/required?delay_ms=5'),
+            http_source('optional', f'{base_url}/optional?delay_ms={slow_ms}', optional=True, timeout_ms=50),
+        ])
+        report['passed'] = (
+            report['error'] is None and 'required' in report['values'] and report['missing'] == {'optional': 'timeout'}
+            and report['elapsed_ms'] < slow_ms / 2
+        )
+        reports.append(report)
+
+        report = check('required_failure', [http_source('broken', f'{base_url}/broken?status=500', hedge_after_ms=30)])
+        report['passed'] = report['error'] == SourceUnavailableError.__name__ and server.requests['/broken'] == 2
+        reports.append(report)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slow_ms', help='Latency injected in the slow answers, in milliseconds. Default: 500.', type=float, default=500)
+    args = parser.parse_args()
+
+    reports = run_checks(args.slow_ms)
+    for report in reports:
+        print(report)
+    failed = [report['check'] for report in reports if not report['passed']]
+    print(f'{len(reports) - len(failed)}/{len(reports)} checks passed' + (f', failed: {failed}' if failed else ''))
+    sys.exit(1 if failed else 0)
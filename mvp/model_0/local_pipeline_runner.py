@@ -0,0 +1,524 @@
+"""
+Runs the stages of the notebooks of the model locally as a single DAG, from 'input_data_ingestion' of preprocessing
+to 'embedding_storing' of the embedding extraction, without running the notebooks by hand.
+
+Every stage output is cached by a key computed from the code of the stage (its tagged cell and the src modules it
+imports), its parameters and the hashes of the outputs of its upstream stages, so a stage whose key is already cached
+is skipped and its output is only read if a stage that runs needs it. A change in a stage runs it again and the stages
+downstream of it only if its output changed. Independent branches (e.g. the batch prediction and the embedding
+extraction) run at the same time.
+
+The parameters are read from a JSON file: 'params' are passed to every stage that has an argument with the same name,
+'stages' are the parameters of a single stage, and 'skip' are stages that are not run (e.g. the hyperparameter tuning,
+then 'hyperparameters' must be a parameter of 'training.model_training'):
+
+    {
+        "params": {"project_id": "my-project", "version": "v1", "model_name": "model_0", "test_mode": true},
+        "stages": {
+            "preprocessing.input_data_ingestion": {"valid_test_rate": [0.1, 0.1], "input_files_queries": ["queries/input.sql"]},
+            "training.model_training": {"hyperparameters": {"max_depth": 3}}
+        },
+        "skip": ["training.hp_feature_ingestion", "training.hp_tuning"]
+    }
+
+Usage: python local_pipeline_runner.py --config_path pipeline_config.json [--targets <stage> ...] [--force <stage> ...]
+"""
+import os
+import re
+import ast
+import sys
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(MODEL_DIR, '.pipeline_cache')
+NOTEBOOKS = {
+    'preprocessing': 'preprocessing/preprocessing.ipynb',
+    'training': 'training/training.ipynb',
+    'batch_prediction': 'postprocessing/postprocessing_batch_prediction.ipynb',
+    'embedding_extraction': 'postprocessing/postprocessing_embeddign_extraction.ipynb',
+}
+STAGE_TAGS = ('input-data-ingestion', 'process', 'output-data-storing')
+
+
+class PipelineStage:
+    """
+    A stage of the pipeline: a function of a tagged cell of a notebook.
+
+    Parameters:
+    - name (str): Name of the stage, '<notebook>.<stage>' (see NOTEBOOKS).
+    - function_name (str, optional): Function of the stage. Default: the name of the stage without the notebook.
+    - inputs (Dict, optional): Argument: upstream stage whose output is passed to it, or (upstream stage, index) to
+      pass an element of the output.
+    - after (List[str], optional): Upstream stages that write the data read by the stage (e.g. in BigQuery or GCS),
+      so they run before it and a new run of them runs it again.
+    """
+
+    def __init__(self, name: str, function_name: str=None, inputs: Dict=None, after: List[str]=None):
+        self.name = name
+        self.notebook = name.split('.')[0]
+        self.function_name = function_name or name.split('.', 1)[1]
+        self.inputs = {argument: upstream if isinstance(upstream, tuple) else (upstream, None) for argument, upstream in (inputs or {}).items()}
+        self.after = list(after or [])
+
+    @property
+    def upstream(self) -> List[str]:
+        return [upstream for upstream, _ in self.inputs.values()] + self.after
+
+
+PIPELINE = [
+    PipelineStage('preprocessing.input_data_ingestion'),
+    PipelineStage('preprocessing.feature_generation', inputs={'input_data': 'preprocessing.input_data_ingestion'}),
+    PipelineStage('preprocessing.feature_storing', inputs={'feature_data': 'preprocessing.feature_generation'}),
+    PipelineStage('training.hp_feature_ingestion', 'feature_ingestion', after=['preprocessing.feature_storing']),
+    PipelineStage('training.hp_tuning', inputs={'hp_feature_data': 'training.hp_feature_ingestion'}),
+    PipelineStage('training.feature_ingestion', after=['preprocessing.feature_storing']),
+    PipelineStage('training.model_training', inputs={'feature_data': 'training.feature_ingestion', 'hyperparameters': ('training.hp_tuning', 0)}),
+    PipelineStage('training.model_and_metric_storing', inputs={'model_metadata': 'training.model_training'}),
+    PipelineStage('batch_prediction.input_data_ingestion'),
+    PipelineStage('batch_prediction.feature_generation', inputs={'input_data': 'batch_prediction.input_data_ingestion'}),
+    PipelineStage('batch_prediction.model_ingestion', after=['training.model_and_metric_storing']),
+    PipelineStage('batch_prediction.batch_prediction_generation', inputs={'model': 'batch_prediction.model_ingestion', 'feature_datasets': 'batch_prediction.feature_generation'}),
+    PipelineStage('batch_prediction.prediction_storing', inputs={'prediction_datasets': 'batch_prediction.batch_prediction_generation'}),
+    PipelineStage('embedding_extraction.model_ingestion', after=['training.model_and_metric_storing']),
+    PipelineStage('embedding_extraction.embedding_generation', inputs={'model': 'embedding_extraction.model_ingestion'}),
+    PipelineStage('embedding_extraction.embedding_storing', inputs={'embedding_datasets': 'embedding_extraction.embedding_generation'}),
+]
+
+
+# Auxiliar functions
+def _hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hash_json(value) -> str:
+    return _hash_bytes(json.dumps(value, sort_keys=True, default=repr).encode())
+
+
+def _cell_tag(cell: Dict) -> str:
+    source = ''.join(cell['source'])
+    match = re.match(r"#\s*(.+?)\s*\(DON'T REMOVE THIS COMMENT\)", source.replace('\xa0', ' '))
+    return match.group(1) if match else None
+
+
+def _local_module_sources(source: str, src_dir: str, seen: set=None) -> Dict[str, str]:
+    """
+    Returns the sources of the modules of src_dir imported by a source (as 'x' or 'src.x'), and of the modules
+    imported by them.
+    """
+    seen = set() if seen is None else seen
+    modules = {}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            names = [node.module]
+        elif isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        else:
+            continue
+        for name in names:
+            module_name = name[len('src.'):] if name.startswith('src.') else name
+            module_path = os.path.join(src_dir, module_name.replace('.', os.sep) + '.py')
+            if module_name in seen or not os.path.isfile(module_path):
+                continue
+            seen.add(module_name)
+            with open(module_path) as module_file:
+                modules[module_name] = module_file.read()
+            modules.update(_local_module_sources(modules[module_name], src_dir, seen))
+    return modules
+
+
+def _materialize(output):
+    # Streams (e.g. the batches of embedding_generation) are read once, so they are stored as a tuple
+    if hasattr(output, '__next__'):
+        return tuple(output)
+    return output
+
+
+class _ComponentScope:
+    """
+    Working directory and 'src' package of the component whose stages are running, as both are global to the
+    process: the stages of the same component run at the same time and the stages of another component wait
+    until they finish.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._component_dir = None
+        self._active = 0
+        self._src_modules = {}
+        self._initial_cwd = os.getcwd()
+        self._initial_src_modules = None
+
+    @staticmethod
+    def _pop_src_modules() -> Dict:
+        return {name: sys.modules.pop(name) for name in list(sys.modules) if name == 'src' or name.startswith('src.')}
+
+    def _switch(self, component_dir: str):
+        if self._component_dir is None:
+            self._initial_src_modules = self._pop_src_modules()
+        else:
+            self._src_modules[self._component_dir] = self._pop_src_modules()
+            sys.path.remove(self._component_dir)
+        sys.modules.update(self._src_modules.get(component_dir, {}))
+        sys.path.insert(0, component_dir)
+        os.chdir(component_dir)
+        self._component_dir = component_dir
+
+    @contextmanager
+    def enter(self, component_dir: str):
+        with self._condition:
+            self._condition.wait_for(lambda: self._active == 0 or self._component_dir == component_dir)
+            if self._component_dir != component_dir:
+                self._switch(component_dir)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                if self._active == 0:
+                    self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            if self._component_dir is not None:
+                self._pop_src_modules()
+                sys.path.remove(self._component_dir)
+                sys.modules.update(self._initial_src_modules)
+                os.chdir(self._initial_cwd)
+                self._component_dir = None
+
+
+class StageCache:
+    """
+    Outputs of the stages by key, in 'cache_dir'. The outputs are pickled in artifacts/<hash of the output>.pkl,
+    so equal outputs are stored once, and the key of every run of a stage points to its output in
+    stages/<stage>/<key>.json.
+    """
+
+    def __init__(self, cache_dir: str=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _record_path(self, stage_name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, 'stages', stage_name, f'{key}.json')
+
+    def _artifact_path(self, artifact_hash: str) -> str:
+        return os.path.join(self.cache_dir, 'artifacts', f'{artifact_hash}.pkl')
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(data)
+        os.replace(temporary_path, path)
+
+    def lookup(self, stage_name: str, key: str) -> Dict:
+        """
+        Returns the record of a cached run of the stage, or None.
+        """
+        try:
+            with open(self._record_path(stage_name, key)) as record_file:
+                record = json.load(record_file)
+        except (OSError, ValueError):
+            return None
+        return record if os.path.isfile(self._artifact_path(record['artifact'])) else None
+
+    def store(self, stage_name: str, key: str, output, seconds: float) -> Dict:
+        data = pickle.dumps(output, protocol=4)
+        artifact_hash = _hash_bytes(data)
+        if not os.path.isfile(self._artifact_path(artifact_hash)):
+            self._write(self._artifact_path(artifact_hash), data)
+        record = {
+            'stage': stage_name,
+            'key': key,
+            'artifact': artifact_hash,
+            'artifact_bytes': len(data),
+            'seconds': round(seconds, 3),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        self._write(self._record_path(stage_name, key), json.dumps(record, indent=2).encode())
+        return record
+
+    def load(self, artifact_hash: str):
+        with open(self._artifact_path(artifact_hash), 'rb') as artifact_file:
+            return pickle.load(artifact_file)
+
+
+# Main functions
+class LocalPipelineRunner:
+    """
+    This class runs the stages of PIPELINE in topological order in a pool of threads, skipping the stages whose
+    output is cached (see StageCache). The key of a stage is the hash of:
+    - its code: the source of its tagged cell and of the modules of the component's src that it imports,
+    - its parameters: the common ones that are arguments of its function and its own ones,
+    - its upstream stages: the hash of the output of every input and the key of every 'after' stage, as the
+      output of a stage that writes to a storage (e.g. the paths) doesn't change when the data changes.
+
+    The notebooks are only loaded (their tagged cells executed) if one of their stages runs.
+
+    Parameters:
+    - params (Dict, optional): Parameters passed to every stage with an argument of the same name.
+    - stage_params (Dict, optional): Parameters of every stage, by stage name.
+    - skip (List[str], optional): Stages that are not run. Their outputs must be given in 'stage_params'.
+    - cache_dir (str): Directory of the cache. Default: .pipeline_cache in the model directory.
+    - max_workers (int): Max stages running at the same time. Default: 4.
+    - stages (List[PipelineStage]): Stages of the pipeline. Default: PIPELINE.
+    """
+
+    def __init__(
+        self,
+        params: Dict=None,
+        stage_params: Dict=None,
+        skip: List[str]=None,
+        cache_dir: str=DEFAULT_CACHE_DIR,
+        max_workers: int=4,
+        stages: List[PipelineStage]=None,
+    ):
+        self.params = dict(params or {})
+        self.stage_params = {name: dict(values) for name, values in (stage_params or {}).items()}
+        self.skip = set(skip or [])
+        self.cache = StageCache(cache_dir)
+        self.max_workers = max_workers
+        self.stages = {stage.name: stage for stage in (stages or PIPELINE) if stage.name not in self.skip}
+        unknown_stages = (set(self.stage_params) | self.skip) - {stage.name for stage in (stages or PIPELINE)}
+        if unknown_stages:
+            raise ValueError(f'Unknown stages: {sorted(unknown_stages)}')
+
+        self._cells = {}
+        self._modules = {}
+        self._module_locks = {notebook: threading.Lock() for notebook in NOTEBOOKS}
+        self._artifacts = {}
+        self._artifacts_lock = threading.Lock()
+        self._scope = _ComponentScope()
+
+    def _notebook_path(self, notebook: str) -> str:
+        return os.path.join(MODEL_DIR, NOTEBOOKS[notebook])
+
+    def _stage_cells(self, notebook: str) -> List[Tuple[int, str]]:
+        if notebook not in self._cells:
+            with open(self._notebook_path(notebook)) as notebook_file:
+                cells = json.load(notebook_file)['cells']
+            self._cells[notebook] = [
+                (index, ''.join(cell['source'])) for index, cell in enumerate(cells)
+                if cell['cell_type'] == 'code' and _cell_tag(cell) in STAGE_TAGS
+            ]
+        return self._cells[notebook]
+
+    def _function_definition(self, stage: PipelineStage) -> Tuple[str, ast.FunctionDef]:
+        for _, source in self._stage_cells(stage.notebook):
+            for node in ast.parse(source).body:
+                if isinstance(node, ast.FunctionDef) and node.name == stage.function_name:
+                    return source, node
+        raise ValueError(f'There is no function {stage.function_name} in the tagged cells of {NOTEBOOKS[stage.notebook]}')
+
+    def code_hash(self, stage: PipelineStage) -> str:
+        source, _ = self._function_definition(stage)
+        src_dir = os.path.join(os.path.dirname(self._notebook_path(stage.notebook)), 'src')
+        return _hash_json({'cell': source, 'modules': _local_module_sources(source, src_dir)})
+
+    def stage_kwargs(self, stage: PipelineStage) -> Dict:
+        """
+        Returns the parameters of a stage, without its inputs.
+        """
+        _, function = self._function_definition(stage)
+        arguments = {argument.arg for argument in function.args.args + function.args.kwonlyargs}
+        kwargs = {name: value for name, value in self.params.items() if name in arguments and name not in stage.inputs}
+        kwargs.update(self.stage_params.get(stage.name, {}))
+        return kwargs
+
+    def stage_key(self, stage: PipelineStage, records: Dict) -> str:
+        upstream = {}
+        for argument, (upstream_name, index) in stage.inputs.items():
+            if upstream_name in self.stages and argument not in self.stage_params.get(stage.name, {}):
+                upstream[argument] = [records[upstream_name]['artifact'], index]
+        for upstream_name in stage.after:
+            if upstream_name in self.stages:
+                upstream[upstream_name] = records[upstream_name]['key']
+        return _hash_json({
+            'stage': stage.name,
+            'code': self.code_hash(stage),
+            'params': self.stage_kwargs(stage),
+            'upstream': upstream,
+        })
+
+    def _module(self, notebook: str) -> Dict:
+        """
+        Executes the tagged cells of a notebook once, in the scope of its component, and returns their globals.
+        """
+        with self._module_locks[notebook]:
+            if notebook not in self._modules:
+                notebook_path = self._notebook_path(notebook)
+                namespace = {'__name__': f'local_pipeline_{notebook}', '__file__': notebook_path}
+                for index, source in self._stage_cells(notebook):
+                    exec(compile(source, f'{notebook_path} (cell {index})', 'exec'), namespace)
+                self._modules[notebook] = namespace
+            return self._modules[notebook]
+
+    def _artifact(self, record: Dict):
+        with self._artifacts_lock:
+            if record['artifact'] not in self._artifacts:
+                self._artifacts[record['artifact']] = self.cache.load(record['artifact'])
+            return self._artifacts[record['artifact']]
+
+    def _run_stage(self, stage: PipelineStage, key: str, records: Dict) -> Dict:
+        kwargs = self.stage_kwargs(stage)
+        for argument, (upstream_name, index) in stage.inputs.items():
+            if argument in kwargs:
+                continue
+            if upstream_name not in self.stages:
+                raise ValueError(f'{upstream_name} is skipped, {argument} must be a parameter of {stage.name}')
+            output = self._artifact(records[upstream_name])
+            kwargs[argument] = output if index is None else output[index]
+
+        with self._scope.enter(os.path.dirname(self._notebook_path(stage.notebook))):
+            function = self._module(stage.notebook)[stage.function_name]
+            start_time = time.perf_counter()
+            output = _materialize(function(**kwargs))
+            seconds = time.perf_counter() - start_time
+
+        record = self.cache.store(stage.name, key, output, seconds)
+        with self._artifacts_lock:
+            self._artifacts[record['artifact']] = output
+        return record
+
+    def _selected_stages(self, targets: List[str]=None) -> List[str]:
+        selected, pending = set(), list(targets or self.stages)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError(f'Unknown or skipped stage: {name}')
+            if name not in selected:
+                selected.add(name)
+                pending.extend(upstream for upstream in self.stages[name].upstream if upstream in self.stages)
+        return [name for name in self.stages if name in selected]
+
+    def run(self, targets: List[str]=None, force: List[str]=None) -> Dict:
+        """
+        Runs the target stages and their upstream stages. A stage is submitted as soon as its upstream stages are
+        completed, so independent branches run at the same time.
+
+        Parameters:
+        - targets (List[str], optional): Stages to run with their upstream stages. Default: every stage.
+        - force (List[str], optional): Stages to run even if their output is cached.
+
+        Returns:
+        - A dict of stage name: {'status' ('cached' or 'ran'), 'key', 'artifact', 'seconds'}.
+
+        Raises:
+        - RuntimeError: If a stage fails. The stages already running are completed (and cached) before.
+        """
+        force = set(force or [])
+        pending = self._selected_stages(targets)
+        records, report, running, failures = {}, {}, {}, []
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while pending or running:
+                    ready = [name for name in pending if all(upstream in records for upstream in self.stages[name].upstream if upstream in self.stages)]
+                    if not failures and ready:
+                        for name in ready:
+                            pending.remove(name)
+                            stage = self.stages[name]
+                            key = self.stage_key(stage, records)
+                            record = None if name in force else self.cache.lookup(name, key)
+                            if record is not None:
+                                records[name] = record
+                                report[name] = {'status': 'cached', 'key': key, 'artifact': record['artifact'], 'seconds': record['seconds']}
+                                print(f'{name}: cached ({key[:12]})')
+                            else:
+                                print(f'{name}: running ({key[:12]})')
+                                running[executor.submit(self._run_stage, stage, key, dict(records))] = name
+                        continue
+                    if not running:
+                        break
+
+                    completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        name = running.pop(future)
+                        try:
+                            records[name] = future.result()
+                        except Exception as error:
+                            failures.append((name, error))
+                            print(f'{name}: failed ({type(error).__name__}: {error})')
+                            continue
+                        report[name] = {'status': 'ran', 'key': records[name]['key'], 'artifact': records[name]['artifact'], 'seconds': records[name]['seconds']}
+                        print(f'{name}: completed in {records[name]["seconds"]}s')
+        finally:
+            self._scope.close()
+
+        if failures:
+            name, error = failures[0]
+            raise RuntimeError(f'The stage {name} failed, {len(pending)} stages were not run') from error
+        if pending:
+            raise RuntimeError(f'The upstream stages of {pending} are not in the pipeline or form a cycle')
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config_path",
+        help="JSON file with the 'params', 'stages' (parameters by stage) and 'skip' (stages not run) of the pipeline.",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--targets",
+        help="Stages to run with their upstream stages. Default: every stage.",
+        type=str,
+        nargs='*',
+        default=None,
+    )
+    parser.add_argument(
+        "--force",
+        help="Stages to run even if their output is cached.",
+        type=str,
+        nargs='*',
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the cached stage outputs. Default: .pipeline_cache in the model directory.",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Max stages running at the same time. Default: 4.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--report_path",
+        help="Optional JSON file to write the status, key and duration of every stage.",
+        type=str,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    with open(args.config_path) as config_file:
+        config = json.load(config_file)
+
+    runner = LocalPipelineRunner(
+        params=config.get('params'),
+        stage_params=config.get('stages'),
+        skip=config.get('skip'),
+        cache_dir=os.path.abspath(args.cache_dir),
+        max_workers=args.max_workers,
+    )
+    pipeline_report = runner.run(targets=args.targets, force=args.force)
+
+    if args.report_path:
+        with open(args.report_path, 'w') as report_file:
+            json.dump(pipeline_report, report_file, indent=2)
+    print('pipeline_report: ', json.dumps(pipeline_report, indent=2))
@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+
+# Model loaded once per worker by the pool initializer
+_worker_model = None
+_worker_model_load_seconds = None
+
+
+# Auxiliar functions
+def _rows_count(chunk) -> int:
+    if isinstance(chunk, tuple):
+        return _rows_count(chunk[0]) if chunk else 0
+    if hasattr(chunk, 'num_rows'):
+        return chunk.num_rows
+    return len(chunk)
+
+
+def _slice_rows(dataset, start: int, stop: int):
+    if hasattr(dataset, 'iloc'):
+        return dataset.iloc[start:stop]
+    if hasattr(dataset, 'num_rows'):
+        return dataset.slice(start, stop - start)
+    return dataset[start:stop]
+
+
+def _init_worker(model_loader: Callable[[], Any]):
+    global _worker_model, _worker_model_load_seconds
+    load_start = time.perf_counter()
+    _worker_model = model_loader()
+    _worker_model_load_seconds = time.perf_counter() - load_start
+
+
+def _worker_id() -> str:
+    return f'{os.getpid()}-{threading.current_thread().name}'
+
+
+def _score_chunk(predict_fn: Callable[[Any, Any], Any], chunk_id: int, chunk):
+    score_start = time.perf_counter()
+    prediction = predict_fn(_worker_model, chunk)
+    return chunk_id, prediction, {
+        'worker_id': _worker_id(),
+        'rows': _rows_count(chunk),
+        'seconds': time.perf_counter() - score_start,
+        'model_load_seconds': _worker_model_load_seconds,
+    }
+
+
+class StageFunction:
+    """
+    Picklable adapter to use a stage function of the notebook as the prediction function or the sink of the
+    engine. The fixed arguments are given as keyword arguments, e.g.
+    StageFunction(batch_prediction_generation, 'model', 'feature_datasets', project_id=project_id, version=version)
+    is called as batch_prediction_generation(model=model, feature_datasets=chunk, project_id=project_id, version=version).
+    Positional arguments named None are dropped, e.g. StageFunction(prediction_storing, None, 'prediction_datasets', ...)
+    is a sink that ignores the chunk id.
+    """
+
+    def __init__(self, stage_function: Callable, *argument_names: str, **stage_kwargs):
+        self.stage_function = stage_function
+        self.argument_names = argument_names
+        self.stage_kwargs = stage_kwargs
+
+    def __call__(self, *args):
+        stage_args = {name: value for name, value in zip(self.argument_names, args) if name is not None}
+        return self.stage_function(**stage_args, **self.stage_kwargs)
+
+
+# Main functions
+def iter_feature_chunks(feature_datasets, chunk_size: int) -> Iterator:
+    """
+    Splits the feature datasets in chunks of 'chunk_size' rows without copying them (pandas, pyarrow and numpy
+    slices are views). If 'feature_datasets' is a tuple, its datasets are split in lockstep and every chunk is a
+    tuple with the same structure, so the chunk can be given as 'feature_datasets' to the stage functions. Any
+    other iterable (e.g. the pages of a BigQuery query, see 'iter_query_chunks') is yielded as it is.
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+
+    datasets = feature_datasets if isinstance(feature_datasets, tuple) else (feature_datasets,)
+    if not all(hasattr(dataset, '__getitem__') and (hasattr(dataset, '__len__') or hasattr(dataset, 'num_rows')) for dataset in datasets):
+        yield from feature_datasets
+        return
+
+    rows = _rows_count(datasets[0]) if datasets else 0
+    for start in range(0, rows, chunk_size):
+        chunk = tuple(_slice_rows(dataset, start, min(start + chunk_size, rows)) for dataset in datasets)
+        if not isinstance(feature_datasets, tuple):
+            yield chunk[0]
+        else:
+            # A StageData (Arrow tables) is chunked as a StageData, its slices are views too
+            yield chunk if type(feature_datasets) is tuple else type(feature_datasets)(chunk)
+
+
+def iter_query_chunks(query: str, project_id: str, chunk_size: int, location: str='us-central1') -> Iterator:
+    """
+    Streams the result of a BigQuery query as pandas DataFrames of at most 'chunk_size' rows, so the full result
+    is never held in memory. Every chunk is a tuple (DataFrame,) as the 'feature_datasets' of the stage functions.
+    """
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=project_id, location=location)
+    rows = client.query(query).result(page_size=chunk_size)
+    for dataframe in rows.to_dataframe_iterable():
+        yield (dataframe,)
+
+
+class BatchScoringEngine:
+    """
+    This class scores a stream of feature chunks across a pool of workers. Every worker loads the model once with
+    'model_loader', and the predictions are given to 'sink' (e.g. 'prediction_storing') in the same order as the
+    chunks, as soon as every previous chunk is ready. At most 'max_pending_chunks' chunks are being scored or waiting
+    to be stored at the same time, so the memory is bounded whatever the size of the input.
+
+    Parameters:
+    - model_loader (Callable): Function without arguments that returns the model (e.g. a StageFunction of
+      'model_ingestion'). It must be picklable to be sent to the worker processes.
+    - predict_fn (Callable): Function (model, chunk) -> predictions of the chunk (e.g. a StageFunction of
+      'batch_prediction_generation'). It must be picklable too.
+    - n_workers (int, optional): Number of workers. Default: number of CPUs.
+    - max_pending_chunks (int, optional): Maximum number of chunks in memory. Default: 2 * n_workers.
+    - use_processes (bool): Use processes (default) or threads. Threads avoid pickling the chunks and the model,
+      and are enough if the model releases the GIL while predicting.
+    """
+
+    def __init__(
+        self,
+        model_loader: Callable[[], Any],
+        predict_fn: Callable[[Any, Any], Any],
+        n_workers: int=None,
+        max_pending_chunks: int=None,
+        use_processes: bool=True,
+    ):
+        self.model_loader = model_loader
+        self.predict_fn = predict_fn
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.max_pending_chunks = max(max_pending_chunks or 2 * self.n_workers, 1)
+        self.use_processes = use_processes
+
+    def _executor(self):
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker, initargs=(self.model_loader,))
+        # Threads share the module, so the model is loaded only once for all of them
+        _init_worker(self.model_loader)
+        return ThreadPoolExecutor(max_workers=self.n_workers)
+
+    def score(self, chunks: Iterable, sink: Optional[Callable[[int, Any], Any]]=None, skip_chunk_ids=()) -> Dict:
+        """
+        Scores every chunk and gives the predictions to 'sink' in order.
+
+        Parameters:
+        - chunks (Iterable): Feature chunks (see 'iter_feature_chunks' and 'iter_query_chunks'). Chunk ids are their
+          positions in this iterable.
+        - sink (Callable, optional): Function (chunk_id, predictions) called with the predictions of every chunk in
+          order (e.g. a StageFunction of 'prediction_storing').
+        - skip_chunk_ids (optional): Ids of the chunks that are not scored, e.g. the chunks already committed by a
+          previous run of the same job (see 'ChunkManifest').
+
+        Returns:
+        - A report with the number of chunks scored and skipped and rows, the elapsed time, the rows per second of the
+          whole job and the rows per second, chunks and model load time of every worker.
+        """
+        skip_chunk_ids = set(skip_chunk_ids)
+        skipped_chunks = 0
+        workers = {}
+        in_flight = set()
+        ready = {}
+        chunk_ids = []
+        next_position = 0
+        total_rows = 0
+        job_start = time.perf_counter()
+
+        def collect(done_futures):
+            nonlocal total_rows
+            for future in done_futures:
+                in_flight.discard(future)
+                chunk_id, prediction, stats = future.result()
+                ready[chunk_id] = prediction
+                worker = workers.setdefault(stats['worker_id'], {
+                    'chunks': 0, 'rows': 0, 'busy_seconds': 0.0, 'model_load_seconds': stats['model_load_seconds'],
+                })
+                worker['chunks'] += 1
+                worker['rows'] += stats['rows']
+                worker['busy_seconds'] += stats['seconds']
+                total_rows += stats['rows']
+
+        def emit_ready():
+            nonlocal next_position
+            while next_position < len(chunk_ids) and chunk_ids[next_position] in ready:
+                chunk_id = chunk_ids[next_position]
+                prediction = ready.pop(chunk_id)
+                if sink is not None:
+                    sink(chunk_id, prediction)
+                next_position += 1
+
+        with self._executor() as executor:
+            for chunk_id, chunk in enumerate(chunks):
+                if chunk_id in skip_chunk_ids:
+                    skipped_chunks += 1
+                    continue
+                # Backpressure: wait until there is room for another chunk in memory
+                while len(in_flight) + len(ready) >= self.max_pending_chunks:
+                    done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done_futures)
+                    emit_ready()
+                chunk_ids.append(chunk_id)
+                in_flight.add(executor.submit(_score_chunk, self.predict_fn, chunk_id, chunk))
+                del chunk
+            while in_flight:
+                done_futures, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done_futures)
+                emit_ready()
+
+        wall_time = time.perf_counter() - job_start
+        for worker in workers.values():
+            worker['rows_per_second'] = round(worker['rows'] / worker['busy_seconds'], 2) if worker['busy_seconds'] else None
+            worker['busy_seconds'] = round(worker['busy_seconds'], 6)
+        return {
+            'chunks': len(chunk_ids),
+            'skipped_chunks': skipped_chunks,
+            'rows': total_rows,
+            'wall_time_seconds': round(wall_time, 6),
+            'rows_per_second': round(total_rows / wall_time, 2) if wall_time else None,
+            'workers': workers,
+        }
+
@@ -0,0 +1,155 @@
+import os
+import json
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+
+MANIFEST_FILE_NAME = '_manifest.json'
+
+
+# Auxiliar functions
+def _read_text(uri: str):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(uri, client=storage.Client())
+        return blob.download_as_text() if blob.exists() else None
+    if not os.path.exists(uri):
+        return None
+    with open(uri) as input_file:
+        return input_file.read()
+
+
+def _atomic_write(uri: str, write_fn: Callable[[str], Any]):
+    """
+    Writes a file atomically: 'write_fn' writes a temporary file in the same directory, which then replaces the
+    destination, so readers see the previous file or the new one but never a partial one. GCS objects are always
+    replaced atomically, so they are written through a local temporary file and uploaded.
+    """
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        with tempfile.TemporaryDirectory() as temporary_dir:
+            temporary_path = os.path.join(temporary_dir, os.path.basename(uri))
+            write_fn(temporary_path)
+            storage.Blob.from_string(uri, client=storage.Client()).upload_from_filename(temporary_path)
+        return
+
+    directory = os.path.dirname(uri) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.basename(uri))
+    os.close(file_descriptor)
+    try:
+        write_fn(temporary_path)
+        with open(temporary_path, 'rb') as temporary_file:
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, uri)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def chunk_output_paths(output_bucket_paths: List[str], chunk_id: int) -> List[str]:
+    """
+    Returns the paths where a chunk must be stored. Every chunk has its own paths, so storing a chunk again
+    after a failure replaces it instead of duplicating its rows.
+    """
+    return [f"{output_bucket_path.rstrip('/')}/chunk-{chunk_id:06d}" for output_bucket_path in output_bucket_paths or []]
+
+
+# Main functions
+class ChunkManifest:
+    """
+    This class keeps the progress of a chunked job of a version in <checkpoint_path>/<version>/_manifest.json, with
+    the ids of the chunks already committed and their outputs. The manifest is replaced atomically after every
+    chunk, so a restart of the same version resumes from the last committed chunk.
+
+    Parameters:
+    - checkpoint_path (str): Local directory or GCS URI (gs://bucket/path) of the checkpoints.
+    - version (str): Version of the job. Every version has its own manifest.
+    - chunk_size (int, optional): Rows per chunk. Chunk ids are positions in the input, so a restart must use the
+      same chunk size as the first run.
+
+    Raises:
+    - ValueError: If the manifest of the version was created with another chunk size.
+    """
+
+    def __init__(self, checkpoint_path: str, version: str, chunk_size: int=None):
+        self.manifest_uri = f"{checkpoint_path.rstrip('/')}/{version}/{MANIFEST_FILE_NAME}"
+        manifest_text = _read_text(self.manifest_uri)
+        self.manifest = json.loads(manifest_text) if manifest_text else {
+            'version': version,
+            'chunk_size': chunk_size,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'completed_chunks': {},
+            'completed': False,
+        }
+        if chunk_size is not None and self.manifest['chunk_size'] not in (None, chunk_size):
+            raise ValueError(f"The checkpoint of version {version} was created with chunk_size={self.manifest['chunk_size']}, it can't be resumed with chunk_size={chunk_size}")
+
+    @property
+    def completed_chunk_ids(self) -> set:
+        return {int(chunk_id) for chunk_id in self.manifest['completed_chunks']}
+
+    def mark_completed(self, chunk_id: int, outputs=None):
+        self.manifest['completed_chunks'][str(chunk_id)] = {
+            'outputs': outputs,
+            'committed_at': datetime.now(timezone.utc).isoformat(),
+        }
+        self._save()
+
+    def mark_job_completed(self, report: Dict=None):
+        self.manifest['completed'] = True
+        self.manifest['report'] = report
+        self._save()
+
+    def _save(self):
+        def write_manifest(path: str):
+            with open(path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file, indent=2, default=str)
+        _atomic_write(self.manifest_uri, write_manifest)
+
+
+class CheckpointedSink:
+    """
+    Sink of the batch-scoring engine that commits every chunk: it stores the chunk with 'sink' and then records it
+    in the manifest. If the job fails between both steps, the chunk is scored and stored again in the restart,
+    so 'sink' must store every chunk in its own destination (see 'chunk_output_paths' and 'LocalChunkSink').
+    """
+
+    def __init__(self, sink: Callable[[int, Any], Any], manifest: ChunkManifest):
+        self.sink = sink
+        self.manifest = manifest
+
+    def __call__(self, chunk_id: int, prediction_datasets):
+        outputs = self.sink(chunk_id, prediction_datasets)
+        self.manifest.mark_completed(chunk_id, outputs)
+        return outputs
+
+
+class LocalChunkSink:
+    """
+    Sink that stores every dataset of the predictions of a chunk as an atomic Parquet file in a local directory:
+    <output_dir>/dataset-<index>/chunk-<chunk_id>.parquet. It is a filesystem stand-in for 'prediction_storing'
+    to test chunked and resumed jobs offline.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def __call__(self, chunk_id: int, prediction_datasets) -> List[str]:
+        import pandas as pd
+
+        datasets = prediction_datasets if isinstance(prediction_datasets, tuple) else (prediction_datasets,)
+        output_paths = []
+        for dataset_index, dataset in enumerate(datasets):
+            output_path = os.path.join(self.output_dir, f'dataset-{dataset_index}', f'chunk-{chunk_id:06d}.parquet')
+            if hasattr(dataset, 'column_names'):
+                import pyarrow.parquet as pq
+                _atomic_write(output_path, lambda path: pq.write_table(dataset, path))
+            else:
+                if not isinstance(dataset, pd.DataFrame):
+                    dataset = pd.DataFrame(dataset)
+                _atomic_write(output_path, lambda path: dataset.to_parquet(path, index=False))
+            output_paths.append(output_path)
+        return output_paths
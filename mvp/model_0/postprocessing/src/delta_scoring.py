@@ -0,0 +1,226 @@
+import io
+import os
+import json
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List
+
+try:
+    from stage_data import to_pandas
+except ImportError:
+    from src.stage_data import to_pandas
+
+
+STATE_FILE_NAME = '_state.json'
+FINGERPRINTS_FILE_NAME = 'fingerprints.parquet'
+PREDICTIONS_FILE_NAME = 'predictions.parquet'
+
+
+# Auxiliar functions
+def _write_bytes(uri: str, content: bytes):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        storage.Blob.from_string(uri, client=storage.Client()).upload_from_string(content)
+        return
+    # Local files are replaced atomically, so a failed run never leaves a partial state
+    directory = os.path.dirname(uri) or '.'
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(file_descriptor, 'wb') as output_file:
+        output_file.write(content)
+    os.replace(temporary_path, uri)
+
+
+def _read_bytes(uri: str) -> bytes:
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(uri, client=storage.Client())
+        return blob.download_as_bytes() if blob.exists() else None
+    if not os.path.exists(uri):
+        return None
+    with open(uri, 'rb') as input_file:
+        return input_file.read()
+
+
+def _read_parquet(uri: str):
+    import pandas as pd
+    return pd.read_parquet(io.BytesIO(_read_bytes(uri)))
+
+
+def _write_parquet(uri: str, dataframe):
+    buffer = io.BytesIO()
+    dataframe.to_parquet(buffer, index=False)
+    _write_bytes(uri, buffer.getvalue())
+
+
+def _filter_rows(dataset, mask):
+    if hasattr(dataset, 'num_rows'):
+        return dataset.filter(mask)
+    return dataset[mask]
+
+
+def _column_names(dataset) -> List[str]:
+    return list(dataset.column_names) if hasattr(dataset, 'column_names') else list(dataset.columns)
+
+
+def feature_fingerprints(features, entity_column: str, feature_columns: List[str]=None):
+    """
+    Returns a pandas DataFrame with a 64-bit fingerprint of the features of every entity (entity_column, fingerprint).
+    The fingerprint changes if any feature of the entity changes, so it is used to find the entities that must be
+    scored again. By default, every column except entity_column is a feature. The features are a pandas
+    DataFrame or an Arrow table (read through a pandas view of its columns).
+    """
+    import pandas as pd
+
+    feature_columns = feature_columns or [column for column in _column_names(features) if column != entity_column]
+    if hasattr(features, 'column_names'):
+        features = to_pandas(features, [entity_column] + list(feature_columns))
+    fingerprints = pd.util.hash_pandas_object(features[feature_columns], index=False).to_numpy()
+    return pd.DataFrame({entity_column: features[entity_column].to_numpy(), 'fingerprint': fingerprints})
+
+
+# Main functions
+class DeltaScoring:
+    """
+    This class selects the entities whose features are new or changed since the last run, so only them are scored,
+    and keeps the previous predictions of the unchanged ones. The state of the last run (the fingerprints of the
+    features of every entity and its predictions) is stored in a directory by version and committed by replacing
+    <state_path>/_state.json, so a failed run never mixes the fingerprints of a run with the predictions of another.
+
+    Every entity is scored (full refresh) if there is no previous state, if the model version or the feature
+    columns changed, or if 'full_refresh' is True.
+
+    Parameters:
+    - state_path (str): Local directory or GCS URI (gs://bucket/path) of the state.
+    - entity_column (str): Column that identifies the entities, in the features and in the predictions.
+    - model_version (str): Version of the model that scores the entities.
+    - feature_columns (List[str], optional): Columns used to detect changes. Default: every column except
+      entity_column.
+    - full_refresh (bool): Score every entity, e.g. to refresh the predictions periodically. Default: False.
+    """
+
+    def __init__(
+        self,
+        state_path: str,
+        entity_column: str,
+        model_version: str,
+        feature_columns: List[str]=None,
+        full_refresh: bool=False,
+    ):
+        self.state_path = state_path.rstrip('/')
+        self.entity_column = entity_column
+        self.model_version = model_version
+        self.feature_columns = feature_columns
+        self.fingerprints = None
+        self.stats = {}
+        self._previous_predictions = None
+        self._unchanged_entities = None
+        self._recorded_predictions = []
+
+        state_content = _read_bytes(f'{self.state_path}/{STATE_FILE_NAME}')
+        self.previous_state = json.loads(state_content) if state_content else None
+        self.full_refresh_reason = None
+        if full_refresh:
+            self.full_refresh_reason = 'full refresh requested'
+        elif self.previous_state is None:
+            self.full_refresh_reason = 'there is no previous state'
+        elif self.previous_state['model_version'] != model_version:
+            self.full_refresh_reason = f"the model version changed from {self.previous_state['model_version']} to {model_version}"
+
+    def select(self, feature_datasets):
+        """
+        Returns the rows of the features of the entities that must be scored. If 'feature_datasets' is a tuple (or a
+        StageData), its first dataset must be a pandas DataFrame or an Arrow table with entity_column and the other
+        datasets are filtered in lockstep.
+        """
+        import numpy as np
+
+        datasets = feature_datasets if isinstance(feature_datasets, tuple) else (feature_datasets,)
+        features = datasets[0]
+        self.fingerprints = feature_fingerprints(features, self.entity_column, self.feature_columns)
+        self.feature_columns = self.feature_columns or [column for column in _column_names(features) if column != self.entity_column]
+        if self.fingerprints[self.entity_column].duplicated().any():
+            raise ValueError(f'{self.entity_column} must identify a single row of the features')
+        if self.full_refresh_reason is None and self.previous_state.get('feature_columns') != list(self.feature_columns):
+            self.full_refresh_reason = 'the feature columns changed'
+
+        if self.full_refresh_reason is not None:
+            changed = np.ones(len(features), dtype=bool)
+            previous_entities = 0
+            matched_entities = 0
+        else:
+            state_dir = self.previous_state['state_dir']
+            previous_fingerprints = _read_parquet(f'{state_dir}/{FINGERPRINTS_FILE_NAME}')
+            positions = previous_fingerprints.set_index(self.entity_column).index.get_indexer(self.fingerprints[self.entity_column])
+            found = positions >= 0
+            changed = ~found
+            changed[found] = previous_fingerprints['fingerprint'].to_numpy()[positions[found]] != self.fingerprints['fingerprint'].to_numpy()[found]
+            self._unchanged_entities = self.fingerprints[self.entity_column][~changed]
+            self._previous_predictions = _read_parquet(f'{state_dir}/{PREDICTIONS_FILE_NAME}')
+            previous_entities = len(previous_fingerprints)
+            matched_entities = int(found.sum())
+
+        self.stats = {
+            'entities': len(features),
+            'new_entities': len(features) - matched_entities,
+            'changed_entities': int(changed.sum()) - (len(features) - matched_entities),
+            'unchanged_entities': int((~changed).sum()),
+            'removed_entities': previous_entities - matched_entities,
+            'scored_ratio': round(float(changed.mean()), 6) if len(features) else 0.0,
+            'full_refresh_reason': self.full_refresh_reason,
+        }
+        selected = tuple(_filter_rows(dataset, changed) for dataset in datasets)
+        if not isinstance(feature_datasets, tuple):
+            return selected[0]
+        return selected if type(feature_datasets) is tuple else type(feature_datasets)(selected)
+
+    def record(self, prediction_datasets):
+        """
+        Records the predictions of the scored entities, to be kept as previous predictions in the next run, and
+        returns them as they are, so it can wrap the predictions given to 'prediction_storing'. The first dataset
+        of the predictions must be a pandas DataFrame or an Arrow table with entity_column.
+        """
+        predictions = prediction_datasets[0] if isinstance(prediction_datasets, tuple) else prediction_datasets
+        if hasattr(predictions, 'column_names'):
+            predictions = to_pandas(predictions)
+        self._recorded_predictions.append(predictions)
+        return prediction_datasets
+
+    def unchanged_predictions(self):
+        """
+        Returns a pandas DataFrame with the previous predictions of the unchanged entities, to be stored with
+        'prediction_storing' next to the predictions of the scored ones.
+        """
+        if self._previous_predictions is None:
+            return None
+        return self._previous_predictions[self._previous_predictions[self.entity_column].isin(self._unchanged_entities)]
+
+    def commit(self, version: str) -> Dict:
+        """
+        Stores the fingerprints and the predictions of this run as the state of the next one. Only the entities
+        with a prediction are stored, so entities that weren't scored (e.g. chunks skipped when a job is resumed)
+        are scored again in the next run.
+
+        Returns:
+        - The new state.
+        """
+        import pandas as pd
+
+        predictions = [predictions for predictions in self._recorded_predictions + [self.unchanged_predictions()] if predictions is not None]
+        predictions = pd.concat(predictions, ignore_index=True) if predictions else pd.DataFrame({self.entity_column: []})
+        fingerprints = self.fingerprints[self.fingerprints[self.entity_column].isin(predictions[self.entity_column])]
+
+        state_dir = f'{self.state_path}/{version}'
+        _write_parquet(f'{state_dir}/{FINGERPRINTS_FILE_NAME}', fingerprints)
+        _write_parquet(f'{state_dir}/{PREDICTIONS_FILE_NAME}', predictions)
+        state = {
+            'version': version,
+            'model_version': self.model_version,
+            'feature_columns': self.feature_columns,
+            'state_dir': state_dir,
+            'entities': len(fingerprints),
+            'stats': self.stats,
+            'committed_at': datetime.now(timezone.utc).isoformat(),
+        }
+        _write_bytes(f'{self.state_path}/{STATE_FILE_NAME}', json.dumps(state, indent=2, default=str).encode())
+        return state
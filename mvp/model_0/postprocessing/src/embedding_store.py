@@ -0,0 +1,325 @@
+import os
+import json
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Tuple
+
+
+MANIFEST_FILE_NAME = 'manifest.json'
+SUPPORTED_DTYPES = ('float32', 'float16', 'int8')
+
+
+# Auxiliar functions
+def quantize_embeddings(embeddings, dtype: str='int8') -> Tuple:
+    """
+    Quantizes a (rows, dimensions) array of embeddings.
+
+    Parameters:
+    - embeddings (numpy.ndarray): Embeddings of every row.
+    - dtype (str): 'float32', 'float16' (2x smaller than float32) or 'int8' (4x smaller than float32). int8 values
+      are scaled by dimension, value = round(embedding / scale) with scale = max(|embedding|) / 127 of the dimension.
+
+    Returns:
+    - A tuple (values, scales). scales is None if dtype isn't 'int8'.
+    """
+    import numpy as np
+
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f'dtype must be one of {SUPPORTED_DTYPES}')
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype != 'int8':
+        return np.ascontiguousarray(embeddings, dtype=dtype), None
+
+    scales = np.abs(embeddings).max(axis=0) / 127 if len(embeddings) else np.ones(embeddings.shape[1], dtype=np.float32)
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    values = np.clip(np.rint(embeddings / scales), -127, 127).astype(np.int8)
+    return np.ascontiguousarray(values), scales
+
+
+def dequantize_embeddings(values, scales=None):
+    """
+    Returns the float32 embeddings of quantized values (see 'quantize_embeddings').
+    """
+    import numpy as np
+
+    embeddings = np.asarray(values, dtype=np.float32)
+    return embeddings * scales if scales is not None else embeddings
+
+
+def _ids_array(ids):
+    """
+    Returns the ids as an array that np.save stores without pickling: non-numeric ids (e.g. strings) are cast to a
+    fixed-width unicode array, since the stored ids are loaded with allow_pickle=False.
+    """
+    import numpy as np
+
+    ids = np.asarray(ids)
+    return ids if ids.dtype.kind in 'biufSU' else ids.astype(str)
+
+
+def upload_directory(local_dir: str, output_uri: str, last_file_name: str=MANIFEST_FILE_NAME):
+    """
+    Copies the files of a local directory to a local directory or a GCS URI. 'last_file_name' (the manifest) is
+    copied last, so readers never find a manifest with missing files.
+    """
+    file_names = sorted(os.listdir(local_dir), key=lambda file_name: file_name == last_file_name)
+    if output_uri.startswith('gs://'):
+        from google.cloud import storage
+        client = storage.Client()
+        for file_name in file_names:
+            blob = storage.Blob.from_string(f"{output_uri.rstrip('/')}/{file_name}", client=client)
+            blob.upload_from_filename(os.path.join(local_dir, file_name))
+        return
+    os.makedirs(output_uri, exist_ok=True)
+    for file_name in file_names:
+        shutil.copyfile(os.path.join(local_dir, file_name), os.path.join(output_uri, file_name))
+
+
+def download_directory(input_uri: str, local_dir: str) -> str:
+    """
+    Copies the files of a GCS URI to a local directory and returns the local directory.
+    """
+    from google.cloud import storage
+    client = storage.Client()
+    bucket_name, _, prefix = input_uri[len('gs://'):].partition('/')
+    os.makedirs(local_dir, exist_ok=True)
+    for blob in client.list_blobs(bucket_name, prefix=prefix.rstrip('/') + '/'):
+        blob.download_to_filename(os.path.join(local_dir, os.path.basename(blob.name)))
+    return local_dir
+
+
+# Main functions
+def iter_embedding_batches(embed_fn, inputs, batch_size: int=1024, ids=None) -> Iterator[Tuple]:
+    """
+    Extracts embeddings by batches of 'batch_size' rows, so the full float32 matrix is never held in memory.
+
+    Parameters:
+    - embed_fn (Callable): Function that returns the (rows, dimensions) embeddings of a batch of inputs, e.g. the
+      embedding layer of the model.
+    - inputs: Inputs of the model (pandas DataFrame, numpy array, pyarrow table or a StageData of them).
+    - batch_size (int): Rows by batch. Default: 1024.
+    - ids (optional): Ids of the entities of every input row. Default: the position of the row.
+
+    Returns:
+    - An iterator of (ids, embeddings) batches, to be stored with 'write_embeddings'.
+    """
+    import numpy as np
+
+    try:
+        from batch_scoring import _rows_count, iter_feature_chunks
+    except ImportError:
+        from src.batch_scoring import _rows_count, iter_feature_chunks
+
+    start = 0
+    for batch in iter_feature_chunks(inputs, batch_size):
+        # A batch of a StageData or a tuple of datasets is a tuple: its rows are the rows of its first dataset
+        rows = _rows_count(batch)
+        batch_ids = np.arange(start, start + rows) if ids is None else np.asarray(ids[start:start + rows])
+        yield batch_ids, np.asarray(embed_fn(batch))
+        start += rows
+
+
+class EmbeddingWriter:
+    """
+    This class stores embeddings by batches as contiguous .npy shards of at most 'shard_rows' rows with a manifest:
+    - shard-<n>.npy: (rows, dimensions) array of 'dtype'.
+    - shard-<n>.ids.npy: ids of the rows of the shard.
+    - shard-<n>.scales.npy: scale of every dimension of the shard, only for 'int8'.
+    - manifest.json: version, dtype, dimensions and files of every shard. It is written last, once every shard is
+      written, so an embedding output without manifest is incomplete.
+    The shards are written to a local directory and copied to every output path when the writer is closed.
+
+    Parameters:
+    - output_paths (List[str]): Local directories or GCS URIs (gs://bucket/path) of the embeddings.
+    - version (str): Version of the embeddings.
+    - dtype (str): 'float32', 'float16' or 'int8' (see 'quantize_embeddings'). Default: 'int8'.
+    - shard_rows (int): Maximum rows by shard. Default: 1_000_000.
+    """
+
+    def __init__(self, output_paths: List[str], version: str, dtype: str='int8', shard_rows: int=1_000_000):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f'dtype must be one of {SUPPORTED_DTYPES}')
+        self.output_paths = output_paths
+        self.version = version
+        self.dtype = dtype
+        self.shard_rows = shard_rows
+        self.shards = []
+        self.dimensions = None
+        self.source_bytes = 0
+        self._local_dir = tempfile.mkdtemp(prefix='embeddings-')
+        self._pending_ids = []
+        self._pending_embeddings = []
+        self._pending_rows = 0
+
+    def write(self, ids, embeddings):
+        import numpy as np
+
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2:
+            raise ValueError('embeddings must be a (rows, dimensions) array')
+        if self.dimensions is None:
+            self.dimensions = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dimensions:
+            raise ValueError(f'Every embedding must have {self.dimensions} dimensions, got {embeddings.shape[1]}')
+
+        self.source_bytes += embeddings.nbytes
+        self._pending_ids.append(np.asarray(ids))
+        self._pending_embeddings.append(embeddings)
+        self._pending_rows += len(embeddings)
+        while self._pending_rows >= self.shard_rows:
+            self._flush(self.shard_rows)
+
+    def _flush(self, rows: int):
+        import numpy as np
+
+        ids = np.concatenate(self._pending_ids)
+        embeddings = np.concatenate(self._pending_embeddings)
+        self._pending_ids = [ids[rows:]] if rows < len(ids) else []
+        self._pending_embeddings = [embeddings[rows:]] if rows < len(embeddings) else []
+        self._pending_rows = len(ids) - rows
+
+        values, scales = quantize_embeddings(embeddings[:rows], self.dtype)
+        shard_name = f'shard-{len(self.shards):05d}'
+        shard = {'file': f'{shard_name}.npy', 'ids_file': f'{shard_name}.ids.npy', 'rows': rows}
+        np.save(os.path.join(self._local_dir, shard['file']), values)
+        np.save(os.path.join(self._local_dir, shard['ids_file']), _ids_array(ids[:rows]))
+        if scales is not None:
+            shard['scales_file'] = f'{shard_name}.scales.npy'
+            np.save(os.path.join(self._local_dir, shard['scales_file']), scales)
+        shard['size_bytes'] = sum(os.path.getsize(os.path.join(self._local_dir, shard[key])) for key in ('file', 'ids_file', 'scales_file') if key in shard)
+        self.shards.append(shard)
+
+    def close(self) -> List[str]:
+        """
+        Writes the last shard and the manifest and copies them to every output path.
+
+        Returns:
+        - The output paths.
+        """
+        if self._pending_rows:
+            self._flush(self._pending_rows)
+        stored_bytes = sum(shard['size_bytes'] for shard in self.shards)
+        manifest = {
+            'version': self.version,
+            'dtype': self.dtype,
+            'dimensions': self.dimensions,
+            'rows': sum(shard['rows'] for shard in self.shards),
+            'shards': self.shards,
+            'source_bytes': self.source_bytes,
+            'stored_bytes': stored_bytes,
+            'compression_ratio': round(self.source_bytes / stored_bytes, 2) if stored_bytes else None,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        with open(os.path.join(self._local_dir, MANIFEST_FILE_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        try:
+            for output_path in self.output_paths:
+                upload_directory(self._local_dir, output_path)
+        finally:
+            shutil.rmtree(self._local_dir, ignore_errors=True)
+        return self.output_paths
+
+
+def write_embeddings(
+    embedding_batches: Iterable[Tuple],
+    output_paths: List[str],
+    version: str,
+    dtype: str='int8',
+    shard_rows: int=1_000_000,
+) -> List[str]:
+    """
+    Stores (ids, embeddings) batches (see 'iter_embedding_batches') as quantized .npy shards with a manifest
+    (see 'EmbeddingWriter') and returns the output paths.
+    """
+    writer = EmbeddingWriter(output_paths, version, dtype=dtype, shard_rows=shard_rows)
+    for ids, embeddings in embedding_batches:
+        writer.write(ids, embeddings)
+    return writer.close()
+
+
+class EmbeddingReader:
+    """
+    This class reads the embeddings stored by 'EmbeddingWriter'. The shards are memory-mapped, so opening them is
+    instant and only the rows that are read are loaded from disk. GCS embeddings are downloaded to 'cache_dir'
+    first.
+
+    Parameters:
+    - path (str): Local directory or GCS URI (gs://bucket/path) of the embeddings.
+    - cache_dir (str, optional): Local directory to download GCS embeddings. Default: a temporary directory.
+    """
+
+    def __init__(self, path: str, cache_dir: str=None):
+        import numpy as np
+
+        if path.startswith('gs://'):
+            path = download_directory(path, cache_dir or tempfile.mkdtemp(prefix='embeddings-'))
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.dtype = self.manifest['dtype']
+        self.dimensions = self.manifest['dimensions']
+        self._values = [np.load(os.path.join(path, shard['file']), mmap_mode='r') for shard in self.manifest['shards']]
+        self._scales = [np.load(os.path.join(path, shard['scales_file'])) if 'scales_file' in shard else None for shard in self.manifest['shards']]
+        self._offsets = np.cumsum([0] + [shard['rows'] for shard in self.manifest['shards']])
+        self._ids = None
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+    @property
+    def ids(self):
+        import numpy as np
+
+        if self._ids is None:
+            ids = [np.load(os.path.join(self.path, shard['ids_file']), allow_pickle=False) for shard in self.manifest['shards']]
+            self._ids = np.concatenate(ids) if ids else np.array([])
+        return self._ids
+
+    def iter_shards(self, dequantize: bool=True) -> Iterator[Tuple]:
+        """
+        Yields the (ids, embeddings) of every shard. If 'dequantize' is False, the raw memory-mapped values are
+        yielded with their scales: (ids, values, scales).
+        """
+        import numpy as np
+
+        for shard, values, scales in zip(self.manifest['shards'], self._values, self._scales):
+            ids = np.load(os.path.join(self.path, shard['ids_file']), allow_pickle=False)
+            yield (ids, dequantize_embeddings(values, scales)) if dequantize else (ids, values, scales)
+
+    def read(self, start: int=0, stop: int=None):
+        """
+        Returns the float32 embeddings of the rows [start, stop).
+        """
+        import numpy as np
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        for shard_index, (values, scales) in enumerate(zip(self._values, self._scales)):
+            shard_start, shard_stop = self._offsets[shard_index], self._offsets[shard_index + 1]
+            if shard_stop <= start or shard_start >= stop:
+                continue
+            rows = slice(max(start, shard_start) - shard_start, min(stop, shard_stop) - shard_start)
+            parts.append(dequantize_embeddings(values[rows], scales))
+        return np.concatenate(parts) if parts else np.empty((0, self.dimensions or 0), dtype=np.float32)
+
+    def take(self, rows):
+        """
+        Returns the float32 embeddings of the given row positions.
+        """
+        import numpy as np
+
+        rows = np.asarray(rows, dtype=np.int64)
+        embeddings = np.empty((len(rows), self.dimensions or 0), dtype=np.float32)
+        shard_indexes = np.searchsorted(self._offsets, rows, side='right') - 1
+        for shard_index in np.unique(shard_indexes):
+            selected = shard_indexes == shard_index
+            local_rows = rows[selected] - self._offsets[shard_index]
+            embeddings[selected] = dequantize_embeddings(self._values[shard_index][local_rows], self._scales[shard_index])
+        return embeddings
+
+    def to_numpy(self):
+        """
+        Returns the float32 embeddings of every row.
+        """
+        return self.read()
@@ -0,0 +1,455 @@
+import os
+import time
+import uuid
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+
+# Auxiliar functions
+def _to_arrow(data):
+    import pyarrow as pa
+
+    if isinstance(data, pa.Table):
+        return data
+    if isinstance(data, pa.RecordBatch):
+        return pa.Table.from_batches([data])
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+
+def _iter_batches(data, batch_rows: int):
+    import pyarrow as pa
+
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        for offset in range(0, data.num_rows, batch_rows):
+            yield data.slice(offset, batch_rows)
+    else:
+        # DataFrames are converted by batches, so the first batches are written while the next ones are converted
+        for offset in range(0, len(data), batch_rows):
+            yield _to_arrow(data.iloc[offset:offset + batch_rows])
+
+
+def _remove_directory(uri: str):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        client = storage.Client()
+        bucket_name, _, prefix = uri[len('gs://'):].partition('/')
+        for blob in client.list_blobs(bucket_name, prefix=prefix.rstrip('/') + '/'):
+            blob.delete()
+    else:
+        import shutil
+        shutil.rmtree(uri, ignore_errors=True)
+
+
+def _partition_dir(partition_columns: List[str], values) -> str:
+    values = values if isinstance(values, tuple) else (values,)
+    return '/'.join(f'{column}={value}' for column, value in zip(partition_columns, values))
+
+
+class _PartitionFile:
+    """
+    Parquet file of a partition being written by a writer thread. Every writer thread has its own files, so the
+    writers encode and write in parallel, and the batches of a writer are in the order it wrote them. Local files are
+    written with a temporary name and renamed when they are closed, GCS files are written locally and uploaded when
+    they are closed, so readers never see partial files.
+    """
+
+    def __init__(self, sink, partition_dir: str, writer_id: int):
+        self.sink = sink
+        self.partition_dir = partition_dir
+        self.writer_id = writer_id
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.writer = None
+
+    def _open(self, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.file_name = f'{self.sink.file_prefix}-{self.writer_id:02d}-{self.sequence:05d}.parquet'
+        local_dir = os.path.join(self.sink.staging_dir, self.partition_dir)
+        os.makedirs(local_dir, exist_ok=True)
+        self.local_path = os.path.join(local_dir, f'.{self.file_name}.inprogress')
+        self.stream = pa.OSFile(self.local_path, 'wb')
+        self.writer = pq.ParquetWriter(self.stream, schema, compression=self.sink.compression)
+        self.sequence += 1
+
+    def write(self, table):
+        with self.lock:
+            if self.writer is None:
+                self._open(table.schema)
+            self.writer.write_table(table)
+            # Size-based rollover: the next rows go to a new file
+            if self.stream.tell() >= self.sink.max_file_bytes:
+                self._close()
+
+    def _close(self):
+        self.writer.close()
+        self.stream.close()
+        self.writer = None
+        self.sink._finalize(self.local_path, self.partition_dir, self.file_name)
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self._close()
+
+
+# Main functions
+class ParquetSink:
+    """
+    This class writes rows (pandas DataFrames or pyarrow Tables) as partitioned Parquet files in the background, so
+    the stage that produces the rows keeps computing while the previous rows are written. The rows are buffered
+    and written by batches of 'buffer_rows' rows by a pool of 'n_writers' threads (pyarrow releases the GIL while it
+    encodes and writes). If 'max_pending_batches' batches are waiting to be written, 'write' blocks until one is
+    written (backpressure), so the memory is bounded when the storage is slower than the computation.
+
+    Files are written to <output_path>/<column>=<value>/.../<file_prefix>-<writer>-<n>.parquet (Hive partitioning
+    by 'partition_columns'), every writer thread writing its own files, and a new file is started when a file
+    reaches 'max_file_bytes'. 'output_path' can be a local directory, to test the storing stages offline, or a GCS
+    URI (gs://bucket/path), staged in a local directory and uploaded when every file is closed. Load the files in
+    tables with 'load_parquet_to_bigquery'.
+
+    Parameters:
+    - output_path (str): Local directory or GCS URI of the files.
+    - partition_columns (List[str], optional): Columns used to partition the files. They aren't stored in the files.
+    - max_file_bytes (int): Size of a file before starting a new one. Default: 128 MB.
+    - buffer_rows (int): Rows of every batch written. Default: 100_000.
+    - max_pending_batches (int): Batches waiting to be written before 'write' blocks. Default: 4.
+    - n_writers (int): Threads writing files. Default: 4.
+    - file_prefix (str, optional): Prefix of the file names. Default: a random prefix, so several sinks (e.g.
+      several workers or chunks) can write in the same output path.
+    - compression (str): Parquet compression. Default: 'snappy'.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        partition_columns: List[str]=None,
+        max_file_bytes: int=128 * 1024 ** 2,
+        buffer_rows: int=100_000,
+        max_pending_batches: int=4,
+        n_writers: int=4,
+        file_prefix: str=None,
+        compression: str='snappy',
+    ):
+        import tempfile
+
+        self.output_path = output_path.rstrip('/')
+        self.partition_columns = list(partition_columns or [])
+        self.max_file_bytes = max_file_bytes
+        self.buffer_rows = buffer_rows
+        self.file_prefix = file_prefix or f'part-{uuid.uuid4().hex[:8]}'
+        self.compression = compression
+        self.staging_dir = tempfile.mkdtemp(prefix='parquet-sink-') if self.output_path.startswith('gs://') else self.output_path
+
+        self._buffer = []
+        self._buffered_rows = 0
+        self._executor = ThreadPoolExecutor(max_workers=n_writers, thread_name_prefix='parquet-sink')
+        self._slots = threading.BoundedSemaphore(max_pending_batches)
+        self._futures = set()
+        self._files = {}
+        self._files_lock = threading.Lock()
+        self._writer = threading.local()
+        self._writer_ids = itertools.count()
+        self._error = None
+        self._closed = False
+        self.output_uris = []
+        self.stats = {'rows': 0, 'batches': 0, 'files': 0, 'bytes': 0, 'blocked_seconds': 0.0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f'Error writing {self.output_path}') from self._error
+
+    def write(self, data):
+        """
+        Buffers the rows and writes the buffer in the background when it is full.
+
+        Raises:
+        - RuntimeError: If a previous write failed.
+        """
+        self._raise_error()
+        table = _to_arrow(data)
+        if table.num_rows == 0:
+            return
+        self._buffer.append(table)
+        self._buffered_rows += table.num_rows
+        if self._buffered_rows >= self.buffer_rows:
+            self._submit_buffer(full_batches_only=True)
+
+    def flush(self):
+        """
+        Writes the buffered rows in the background, by batches of 'buffer_rows' rows, blocking while
+        'max_pending_batches' batches are pending.
+        """
+        self._submit_buffer(full_batches_only=False)
+
+    def _submit_buffer(self, full_batches_only: bool):
+        import pyarrow as pa
+
+        if not self._buffer:
+            return
+        table = pa.concat_tables(self._buffer) if len(self._buffer) > 1 else self._buffer[0]
+        submitted_rows = table.num_rows - table.num_rows % self.buffer_rows if full_batches_only else table.num_rows
+        # The rest of a partial batch stays buffered until more rows are written
+        rest = table.slice(submitted_rows)
+        self._buffer = [rest] if rest.num_rows else []
+        self._buffered_rows = rest.num_rows
+
+        for offset in range(0, submitted_rows, self.buffer_rows):
+            wait_start = time.perf_counter()
+            self._slots.acquire()
+            self.stats['blocked_seconds'] += time.perf_counter() - wait_start
+            future = self._executor.submit(self._write_batch, table.slice(offset, min(self.buffer_rows, submitted_rows - offset)))
+            self._futures.add(future)
+            future.add_done_callback(self._batch_done)
+
+    def _batch_done(self, future):
+        self._futures.discard(future)
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _partition_file(self, partition_dir: str) -> _PartitionFile:
+        with self._files_lock:
+            if not hasattr(self._writer, 'id'):
+                self._writer.id = next(self._writer_ids)
+            key = (partition_dir, self._writer.id)
+            if key not in self._files:
+                self._files[key] = _PartitionFile(self, partition_dir, self._writer.id)
+            return self._files[key]
+
+    def _write_batch(self, table):
+        if not self.partition_columns:
+            self._partition_file('').write(table)
+        else:
+            keys = table.select(self.partition_columns).to_pandas()
+            data = table.drop_columns(self.partition_columns)
+            for values, rows in keys.groupby(self.partition_columns, sort=False, dropna=False).indices.items():
+                self._partition_file(_partition_dir(self.partition_columns, values)).write(data.take(rows))
+        with self._files_lock:
+            self.stats['rows'] += table.num_rows
+            self.stats['batches'] += 1
+
+    def _finalize(self, local_path: str, partition_dir: str, file_name: str):
+        relative_path = f'{partition_dir}/{file_name}' if partition_dir else file_name
+        file_bytes = os.path.getsize(local_path)
+        if self.output_path.startswith('gs://'):
+            from google.cloud import storage
+            output_uri = f'{self.output_path}/{relative_path}'
+            storage.Blob.from_string(output_uri, client=storage.Client()).upload_from_filename(local_path)
+            os.remove(local_path)
+        else:
+            output_uri = os.path.join(self.output_path, relative_path)
+            os.replace(local_path, output_uri)
+        with self._files_lock:
+            self.output_uris.append(output_uri)
+            self.stats['files'] += 1
+            self.stats['bytes'] += file_bytes
+
+    def close(self) -> List[str]:
+        """
+        Writes the buffered rows, waits for every pending write and closes the files.
+
+        Returns:
+        - The URIs of the written files.
+
+        Raises:
+        - RuntimeError: If a write failed.
+        """
+        if self._closed:
+            return self.output_uris
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._raise_error()
+        for partition_file in self._files.values():
+            partition_file.close()
+        self._closed = True
+        self.stats['blocked_seconds'] = round(self.stats['blocked_seconds'], 6)
+        return sorted(self.output_uris)
+
+
+def load_parquet_to_bigquery(
+    source_uris: List[str],
+    table_id: str,
+    project_id: str,
+    location: str='us-central1',
+    write_disposition: str='WRITE_APPEND',
+    hive_partitioning_prefix: str=None,
+) -> Dict:
+    """
+    Loads Parquet files (e.g. the output of 'ParquetSink') in a BigQuery table with load jobs, which are free
+    and much faster than streaming inserts or writing DataFrames row by row. GCS files are loaded by a single job
+    (wildcards are allowed, e.g. gs://bucket/path/*.parquet), local files are uploaded one by one.
+
+    Parameters:
+    - source_uris (List[str]): GCS URIs or local paths of the files.
+    - table_id (str): Table (project.dataset.table).
+    - project_id (str): Project of the jobs.
+    - location (str): Location of the jobs. Default: 'us-central1'.
+    - write_disposition (str): 'WRITE_APPEND' or 'WRITE_TRUNCATE' (e.g. to load again every file of a job that
+      was resumed). Default: 'WRITE_APPEND'.
+    - hive_partitioning_prefix (str, optional): Common prefix of partitioned GCS files
+      (<prefix>/<column>=<value>/...). The partition columns are loaded from the paths.
+
+    Returns:
+    - The number of files and rows loaded.
+    """
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=project_id, location=location)
+
+    def job_config(disposition: str):
+        config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=disposition)
+        if hive_partitioning_prefix:
+            hive_partitioning = bigquery.HivePartitioningOptions()
+            hive_partitioning.mode = 'AUTO'
+            hive_partitioning.source_uri_prefix = hive_partitioning_prefix
+            config.hive_partitioning = hive_partitioning
+        return config
+
+    gcs_uris = [uri for uri in source_uris if uri.startswith('gs://')]
+    local_paths = [uri for uri in source_uris if not uri.startswith('gs://')]
+    loaded_rows = 0
+    disposition = write_disposition
+    if gcs_uris:
+        loaded_rows += client.load_table_from_uri(gcs_uris, table_id, job_config=job_config(disposition)).result().output_rows
+        disposition = 'WRITE_APPEND'
+    for local_path in local_paths:
+        with open(local_path, 'rb') as source_file:
+            loaded_rows += client.load_table_from_file(source_file, table_id, job_config=job_config(disposition)).result().output_rows
+        disposition = 'WRITE_APPEND'
+    return {'files': len(source_uris), 'rows': loaded_rows}
+
+
+def load_stored_outputs(
+    stored_outputs: List,
+    output_tables: List[str],
+    project_id: str,
+    location: str='us-central1',
+    write_disposition: str='WRITE_TRUNCATE',
+) -> Dict:
+    """
+    Loads the files written by several calls to 'store_datasets' (e.g. the chunks of a checkpointed job, as
+    returned by 'prediction_storing') in output_tables by a single load by table. Loading once the job is completed,
+    with WRITE_TRUNCATE, makes the tables idempotent: a chunk stored again after a failure replaces its files, and
+    the files are only loaded once.
+
+    Parameters:
+    - stored_outputs (List): The 'files' of every call, a dict {'dataset-<i>': files} or a list of them (one by
+      output path, the GCS ones are loaded if there are any).
+    - output_tables (List[str]): Table of every dataset (project.dataset.table).
+    - project_id (str): Project of the load jobs.
+    - location (str): Location of the load jobs. Default: 'us-central1'.
+    - write_disposition (str): Write disposition of the load jobs. Default: 'WRITE_TRUNCATE'.
+
+    Returns:
+    - The files and rows loaded in every table.
+    """
+    source_uris = [[] for _ in output_tables]
+    for outputs in stored_outputs:
+        outputs = [outputs] if isinstance(outputs, dict) else list(outputs or [])
+        if not outputs:
+            continue
+        files = next((output for output in outputs if any(uri.startswith('gs://') for uris in output.values() for uri in uris)), outputs[0])
+        for index in range(len(output_tables)):
+            source_uris[index] += files.get(f'dataset-{index}', [])
+    return {
+        output_table: load_parquet_to_bigquery(uris, output_table, project_id, location, write_disposition)
+        for output_table, uris in zip(output_tables, source_uris) if uris
+    }
+
+
+def store_datasets(
+    datasets: tuple,
+    output_paths: List[str]=None,
+    output_tables: List[str]=None,
+    project_id: str=None,
+    location: str='us-central1',
+    partition_columns: List[str]=None,
+    write_disposition: str='WRITE_APPEND',
+    **sink_kwargs,
+) -> Dict:
+    """
+    Stores the datasets of a storing stage (e.g. the feature datasets or the prediction datasets). Every dataset i
+    is written by a 'ParquetSink' in <output_path>/dataset-<i> of every output path, by batches written in the
+    background while the next ones are converted, and then loaded in output_tables[i] by a single load job.
+    The previous files of <output_path>/dataset-<i> are removed first, so storing the same datasets again (e.g. a
+    chunk of a resumed job) replaces them. If there aren't output paths, the files of the tables are staged in a
+    temporary directory.
+
+    Parameters:
+    - datasets (tuple): pandas DataFrames or pyarrow Tables.
+    - output_paths (List[str], optional): Local directories or GCS URIs.
+    - output_tables (List[str], optional): Table of every dataset (project.dataset.table).
+    - project_id (str, optional): Project of the load jobs. Required with output_tables.
+    - location (str): Location of the load jobs. Default: 'us-central1'.
+    - partition_columns (List[str], optional): Columns used to partition the files.
+    - write_disposition (str): Write disposition of the load jobs. Default: 'WRITE_APPEND'.
+    - sink_kwargs: Other parameters of 'ParquetSink'.
+
+    Returns:
+    - The files of every dataset and output path, the loaded tables and the stats of the sinks.
+
+    Raises:
+    - ValueError: If the number of output tables and datasets differ.
+    """
+    import shutil
+    import tempfile
+
+    output_tables = list(output_tables or [])
+    if output_tables and len(output_tables) != len(datasets):
+        raise ValueError(f'{len(output_tables)} output tables for {len(datasets)} datasets')
+
+    staging_dir = None
+    output_paths = [output_path.rstrip('/') for output_path in output_paths or []]
+    if output_tables and not output_paths:
+        staging_dir = tempfile.mkdtemp(prefix='store-datasets-')
+        output_paths = [staging_dir]
+
+    sink_kwargs.setdefault('file_prefix', 'part')
+    sinks = []
+    try:
+        for index, dataset in enumerate(datasets):
+            dataset_sinks = []
+            for output_path in output_paths:
+                _remove_directory(f'{output_path}/dataset-{index}')
+                dataset_sinks.append(ParquetSink(f'{output_path}/dataset-{index}', partition_columns=partition_columns, **sink_kwargs))
+            # Every batch is converted once and written to every output path in the background
+            for batch in _iter_batches(dataset, dataset_sinks[0].buffer_rows) if dataset_sinks else []:
+                for sink in dataset_sinks:
+                    sink.write(batch)
+            for output_path, sink in zip(output_paths, dataset_sinks):
+                sink.flush()
+                sinks.append((index, output_path, sink))
+
+        files = {}
+        for index, output_path, sink in sinks:
+            files.setdefault(output_path, {})[f'dataset-{index}'] = sink.close()
+
+        tables = {}
+        for index, output_table in enumerate(output_tables):
+            # GCS files are loaded by a single job, local files are uploaded
+            source_path = next((path for path in output_paths if path.startswith('gs://')), output_paths[0])
+            source_uris = files[source_path][f'dataset-{index}']
+            hive_prefix = f'{source_path}/dataset-{index}' if partition_columns and source_path.startswith('gs://') else None
+            tables[output_table] = load_parquet_to_bigquery(source_uris, output_table, project_id, location, write_disposition, hive_prefix)
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return {
+        'files': {} if staging_dir else files,
+        'tables': tables,
+        'stats': [{'dataset': index, 'output_path': output_path, **sink.stats} for index, output_path, sink in sinks],
+    }
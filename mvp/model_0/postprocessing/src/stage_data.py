@@ -0,0 +1,192 @@
+import threading
+from collections import Counter
+from typing import Dict, List
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+# Auxiliar functions
+def _record(kind: str, copied_bytes: int=0):
+    with _stats_lock:
+        _stats[kind] += 1
+        _stats['copied_bytes'] += copied_bytes
+
+
+def _shares_arrow_memory(array, column) -> bool:
+    """
+    Returns True if the data of a NumPy array is in a buffer of an Arrow column, i.e. it is a view of it.
+    """
+    address = array.__array_interface__['data'][0]
+    for chunk in getattr(column, 'chunks', [column]):
+        for buffer in chunk.buffers():
+            if buffer is not None and buffer.address <= address < buffer.address + max(buffer.size, 1):
+                return True
+    return False
+
+
+def _record_column(array, column):
+    if _shares_arrow_memory(array, column):
+        _record('zero_copy')
+    else:
+        _record('copies', array.nbytes)
+
+
+def _record_conversion(data, table):
+    """
+    Records every column converted to Arrow: a column that wraps the memory of its NumPy source is a view, any other
+    (e.g. strings, objects, nullable or list columns) was copied. The columns are checked one by one, so the count
+    doesn't depend on the threads converting the columns or on what other threads allocate at the same time.
+    """
+    import numpy as np
+
+    if hasattr(data, 'columns') and hasattr(data, 'dtypes'):
+        sources = [data.iloc[:, position] for position in range(data.shape[1])]
+    elif isinstance(data, dict):
+        sources = list(data.values())
+    else:
+        sources = [None] * table.num_columns
+    for source, column in zip(sources, table.columns):
+        dtype = getattr(source, 'dtype', None)
+        if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM' and _shares_arrow_memory(np.asarray(source), column):
+            _record('zero_copy')
+        else:
+            _record('copies', column.nbytes)
+
+
+def to_arrow_table(data):
+    """
+    Returns the data as a pyarrow Table: a Table, a RecordBatch, a RecordBatchReader, a pandas DataFrame, a dict of
+    columns or a list of records. The numeric columns of DataFrames and NumPy arrays without nulls are wrapped
+    without copies, other columns (e.g. strings) are copied once into Arrow memory.
+    """
+    import pyarrow as pa
+
+    if isinstance(data, pa.Table):
+        return data
+    if isinstance(data, pa.RecordBatch):
+        _record('zero_copy')
+        return pa.Table.from_batches([data])
+    if isinstance(data, pa.RecordBatchReader):
+        _record('zero_copy')
+        return data.read_all()
+
+    if hasattr(data, 'columns') and hasattr(data, 'dtypes'):
+        table = pa.Table.from_pandas(data, preserve_index=False)
+    elif isinstance(data, dict):
+        table = pa.table(data)
+    elif isinstance(data, list) and all(isinstance(record, dict) for record in data):
+        table = pa.Table.from_pylist(data)
+    else:
+        raise TypeError(f'{type(data).__name__} can not be converted to an Arrow table')
+    _record_conversion(data, table)
+    return table
+
+
+# Main functions
+def copy_stats() -> Dict[str, int]:
+    """
+    Returns the conversions of the stage data made by this process: 'zero_copy' (views of Arrow memory), 'copies'
+    and 'copied_bytes'. Take the difference of two calls to get the copies of a stage.
+    """
+    with _stats_lock:
+        return {'zero_copy': _stats['zero_copy'], 'copies': _stats['copies'], 'copied_bytes': _stats['copied_bytes']}
+
+
+def to_pandas(table, columns: List[str]=None):
+    """
+    Returns a pandas DataFrame over an Arrow table. Every column is its own block, so the numeric columns without
+    nulls of a single chunk are views of the Arrow memory, instead of copies consolidated by dtype. The DataFrame
+    must be treated as read-only, as the views are.
+    """
+    table = to_arrow_table(table)
+    if columns is not None:
+        table = table.select(columns)
+    dataframe = table.to_pandas(split_blocks=True, self_destruct=False)
+    for name, column in zip(table.column_names, table.columns):
+        _record_column(dataframe[name].to_numpy(), column)
+    return dataframe
+
+
+def to_numpy(table, column: str):
+    """
+    Returns a column of an Arrow table as a NumPy array, a read-only view if it is numeric, without nulls and of
+    a single chunk.
+    """
+    table = to_arrow_table(table)
+    chunked_array = table.column(column)
+    if chunked_array.num_chunks == 1:
+        array = chunked_array.chunk(0).to_numpy(zero_copy_only=False)
+    else:
+        array = chunked_array.to_numpy()
+    _record_column(array, chunked_array)
+    return array
+
+
+def feature_matrix(table, columns: List[str]=None, dtype: str='float64'):
+    """
+    Returns the columns of an Arrow table as a 2D array (rows x columns), e.g. the features of a model. The columns
+    are copied once into a single Fortran-ordered array, so every column is contiguous, instead of being copied
+    into a DataFrame first. A single numeric column of the same dtype is a view. Nulls are NaN.
+    """
+    import numpy as np
+
+    table = to_arrow_table(table)
+    columns = list(columns) if columns is not None else table.column_names
+    if len(columns) == 1:
+        column = table.column(columns[0])
+        if column.num_chunks == 1 and column.null_count == 0 and column.type.to_pandas_dtype() == np.dtype(dtype):
+            return to_numpy(table, columns[0]).reshape(-1, 1)
+
+    matrix = np.empty((table.num_rows, len(columns)), dtype=dtype, order='F')
+    for position, name in enumerate(columns):
+        start = 0
+        for chunk in table.column(name).chunks:
+            matrix[start:start + len(chunk), position] = chunk.to_numpy(zero_copy_only=False)
+            start += len(chunk)
+    _record('copies', matrix.nbytes)
+    return matrix
+
+
+class StageData(tuple):
+    """
+    This class is the data passed between the stages (input_data, feature_datasets, prediction_datasets...): a
+    tuple of pyarrow Tables, one by dataset. The stages read and return Arrow tables, so a wide table is not copied
+    at every boundary, and take pandas or NumPy views of them only where they need them (see 'to_pandas',
+    'to_numpy' and 'feature_matrix'). As it is a tuple, the stages that index or unpack their inputs accept it.
+
+    The same file is copied in the src directory of every component.
+
+    Parameters:
+    - datasets: A dataset or a tuple of datasets: pyarrow Tables, RecordBatches, pandas DataFrames, dicts of
+      columns or lists of records (see 'to_arrow_table'). A StageData is returned as it is.
+    """
+
+    def __new__(cls, datasets=()):
+        if isinstance(datasets, StageData):
+            return datasets
+        # A tuple is a tuple of datasets, a list of dicts is a single dataset of records
+        if not isinstance(datasets, (tuple, list)) or (isinstance(datasets, list) and datasets and all(isinstance(record, dict) for record in datasets)):
+            datasets = (datasets,)
+        return super().__new__(cls, (to_arrow_table(dataset) for dataset in datasets))
+
+    @classmethod
+    def from_request(cls, request) -> 'StageData':
+        """
+        Returns a request of the API (a pydantic model or a dict) as a single dataset of one row.
+        """
+        import pyarrow as pa
+
+        fields = request if isinstance(request, dict) else (request.model_dump() if hasattr(request, 'model_dump') else request.dict())
+        return cls((pa.Table.from_pydict({name: [value] for name, value in fields.items()}),))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(table.nbytes for table in self)
+
+    def to_pandas(self, index: int=0, columns: List[str]=None):
+        return to_pandas(self[index], columns)
+
+    def to_numpy(self, index: int=0, columns: List[str]=None, dtype: str='float64'):
+        return feature_matrix(self[index], columns, dtype)
@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    from embedding_store import EmbeddingReader, _ids_array, download_directory, upload_directory
+except ImportError:
+    from src.embedding_store import EmbeddingReader, _ids_array, download_directory, upload_directory
+
+
+INDEX_FILE_NAME = 'index.ann'
+IDS_FILE_NAME = 'ids.npy'
+INDEX_MANIFEST_FILE_NAME = 'index_manifest.json'
+CURRENT_FILE_NAME = 'CURRENT'
+DELTA_VECTORS_FILE_NAME = 'vectors.npy'
+DELTA_DELETED_IDS_FILE_NAME = 'deleted_ids.npy'
+SUPPORTED_METRICS = ('angular', 'euclidean', 'manhattan', 'hamming', 'dot')
+
+
+# Auxiliar functions
+def _build_index(local_dir: str, batches: Iterable[Tuple], dimensions: int, metric: str, n_trees: int, n_jobs: int, random_seed: int=None) -> Dict:
+    from annoy import AnnoyIndex
+    import numpy as np
+
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError(f'metric must be one of {SUPPORTED_METRICS}')
+
+    build_start = time.perf_counter()
+    index = AnnoyIndex(dimensions, metric)
+    if random_seed is not None:
+        index.set_seed(random_seed)
+    index.on_disk_build(os.path.join(local_dir, INDEX_FILE_NAME))
+
+    ids = []
+    item = 0
+    for batch_ids, batch_vectors in batches:
+        for vector in batch_vectors:
+            index.add_item(item, vector)
+            item += 1
+        ids.append(np.asarray(batch_ids))
+    index.build(n_trees, n_jobs=n_jobs)
+    index.unload()
+
+    np.save(os.path.join(local_dir, IDS_FILE_NAME), _ids_array(np.concatenate(ids) if ids else np.array([])))
+    return {
+        'metric': metric,
+        'dimensions': dimensions,
+        'items': item,
+        'n_trees': n_trees,
+        'build_seconds': round(time.perf_counter() - build_start, 3),
+        'index_bytes': os.path.getsize(os.path.join(local_dir, INDEX_FILE_NAME)),
+    }
+
+
+def _write_index_manifest(local_dir: str, manifest: Dict):
+    with open(os.path.join(local_dir, INDEX_MANIFEST_FILE_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def _read_text(uri: str):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(uri, client=storage.Client())
+        return blob.download_as_text() if blob.exists() else None
+    if not os.path.exists(uri):
+        return None
+    with open(uri) as input_file:
+        return input_file.read()
+
+
+def _write_text_atomically(uri: str, content: str):
+    if uri.startswith('gs://'):
+        # A GCS object is always replaced atomically
+        from google.cloud import storage
+        storage.Blob.from_string(uri, client=storage.Client()).upload_from_string(content)
+        return
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(uri), prefix='.tmp-')
+    with os.fdopen(file_descriptor, 'w') as output_file:
+        output_file.write(content)
+    os.replace(temporary_path, uri)
+
+
+def _remove_directory(uri: str):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        client = storage.Client()
+        bucket_name, _, prefix = uri[len('gs://'):].partition('/')
+        for blob in client.list_blobs(bucket_name, prefix=prefix.rstrip('/') + '/'):
+            blob.delete()
+    else:
+        shutil.rmtree(uri, ignore_errors=True)
+
+
+def _local_copy(uri: str) -> str:
+    return download_directory(uri, tempfile.mkdtemp(prefix='vector-index-')) if uri.startswith('gs://') else uri
+
+
+def merge_delta_segments(segments: List[Tuple]) -> Tuple:
+    """
+    Applies delta segments in order and returns the live rows of the deltas and the ids hidden in the base index.
+
+    Parameters:
+    - segments (List[Tuple]): (ids, vectors, deleted_ids) of every delta segment, oldest first.
+
+    Returns:
+    - A tuple (delta_ids, delta_vectors, hidden_ids). hidden_ids are the ids of the base index that were deleted
+      (tombstones) or replaced by a newer vector in a delta segment.
+    """
+    import numpy as np
+
+    live = {}
+    hidden_ids = set()
+    for ids, vectors, deleted_ids in segments:
+        for entity_id in deleted_ids.tolist():
+            live.pop(entity_id, None)
+            hidden_ids.add(entity_id)
+        for entity_id, vector in zip(ids.tolist(), vectors):
+            live[entity_id] = vector
+            hidden_ids.add(entity_id)
+    delta_ids = list(live)
+    dimensions = segments[0][1].shape[1] if segments else 0
+    delta_vectors = np.vstack(list(live.values())).astype(np.float32) if live else np.empty((0, dimensions), dtype=np.float32)
+    return delta_ids, delta_vectors, hidden_ids
+
+
+def diff_embeddings(previous_embedding_path: str, embedding_path: str, tolerance: float=1e-6, batch_rows: int=100_000) -> Tuple:
+    """
+    Compares two versions of the embeddings stored by 'embedding_storing' by id, shard by shard.
+
+    Returns:
+    - A tuple (ids, vectors, deleted_ids) with the new or changed embeddings (max absolute difference bigger than
+      'tolerance') and the ids that aren't in the new version, as expected by 'SegmentedVectorIndex.update'.
+      Quantized embeddings need a tolerance above their quantization error (scale / 2 for 'int8', see
+      'quantize_embeddings'), otherwise every row is found changed.
+    """
+    import numpy as np
+
+    previous = EmbeddingReader(previous_embedding_path)
+    current = EmbeddingReader(embedding_path)
+    previous_positions = {entity_id: row for row, entity_id in enumerate(previous.ids.tolist())}
+
+    changed_ids, changed_vectors, seen = [], [], set()
+    for start in range(0, len(current), batch_rows):
+        ids = current.ids[start:start + batch_rows].tolist()
+        vectors = current.read(start, start + batch_rows)
+        positions = np.array([previous_positions.get(entity_id, -1) for entity_id in ids], dtype=np.int64)
+        changed = positions < 0
+        found = ~changed
+        if found.any():
+            changed[found] = np.abs(previous.take(positions[found]) - vectors[found]).max(axis=1) > tolerance
+        changed_ids.extend(entity_id for entity_id, is_changed in zip(ids, changed) if is_changed)
+        changed_vectors.append(vectors[changed])
+        seen.update(ids)
+
+    deleted_ids = [entity_id for entity_id in previous_positions if entity_id not in seen]
+    vectors = np.concatenate(changed_vectors) if changed_vectors else np.empty((0, current.dimensions), dtype=np.float32)
+    return np.asarray(changed_ids), vectors, np.asarray(deleted_ids)
+
+
+# Main functions
+def build_vector_index(
+    embedding_path: str,
+    output_paths: List[str],
+    version: str,
+    metric: str='angular',
+    n_trees: int=50,
+    n_jobs: int=-1,
+    random_seed: int=None,
+) -> Dict:
+    """
+    This function builds an Annoy index of the embeddings stored by 'embedding_storing' (see 'EmbeddingReader').
+    The index is built on disk, so the embeddings are read by shards and never held in memory as a whole, and it
+    is served memory-mapped by the inference app (see 'inference/src/vector_search.py').
+
+    Every output path gets:
+    - index.ann: the Annoy index. The item i of the index is the row i of the embeddings.
+    - ids.npy: the id of the entity of every item of the index (id map).
+    - index_manifest.json: version, metric, dimensions and build parameters. It is written last.
+
+    Parameters:
+    - embedding_path (str): Local directory or GCS URI of the embeddings.
+    - output_paths (List[str]): Local directories or GCS URIs where the index is stored.
+    - version (str): Version of the index.
+    - metric (str): 'angular' (cosine), 'euclidean', 'manhattan', 'hamming' or 'dot'. Default: 'angular'.
+    - n_trees (int): Number of trees. More trees give better recall for the same search_k but a bigger index and
+      a slower build. Default: 50.
+    - n_jobs (int): Threads used to build the trees. Default: -1 (every CPU).
+    - random_seed (int, optional): Seed to build reproducible indexes.
+
+    Returns:
+    - The manifest of the index.
+
+    Raises:
+    - ValueError: If the metric isn't supported.
+    """
+    embeddings = EmbeddingReader(embedding_path)
+    local_dir = tempfile.mkdtemp(prefix='vector-index-')
+    try:
+        build_stats = _build_index(local_dir, embeddings.iter_shards(), embeddings.dimensions, metric, n_trees, n_jobs, random_seed)
+        manifest = {
+            'version': version,
+            'embeddings_version': embeddings.manifest['version'],
+            'embedding_path': embedding_path,
+            **build_stats,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        _write_index_manifest(local_dir, manifest)
+
+        # The manifest is copied last, so an index without manifest is incomplete
+        for output_path in output_paths:
+            upload_directory(local_dir, output_path, last_file_name=INDEX_MANIFEST_FILE_NAME)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+    return manifest
+
+
+class SegmentedVectorIndex:
+    """
+    This class maintains a vector index incrementally, so the index is fresh without waiting for full rebuilds.
+    The index is a base Annoy index plus small delta segments searched by brute force next to it:
+    - base-<version>-<id>/: Annoy index built by 'build_vector_index' or by the last compaction. Every build gets a
+      new directory, so a base being served (memory-mapped by the searchers) is never rewritten, even if the same
+      version is built again (e.g. a retried job).
+    - delta-<n>/: vectors.npy and ids.npy of new or changed embeddings, and deleted_ids.npy (tombstones). A newer
+      segment wins over the older ones and over the base index.
+    - CURRENT: JSON with the base index and the delta segments being served. It is replaced atomically, so the
+      searchers (see 'inference/src/vector_search.py') always see a complete index and switch to a new one when
+      they reload it.
+
+    'compact' merges the base index and the deltas in a new base index while updates and queries go on, and only
+    the segments that it merged are removed from CURRENT. There must be a single writer by index root.
+
+    The segments replaced by 'initialize' or 'compact' are listed as retired in CURRENT and their directories are
+    removed by the first swap 'grace_seconds' after, so the searchers that haven't reloaded CURRENT yet keep
+    finding them.
+
+    Parameters:
+    - index_root (str): Local directory or GCS URI (gs://bucket/path) of the index.
+    - metric (str): Metric of the index (see 'build_vector_index'). Default: 'angular'.
+    - n_trees (int): Number of trees of the base indexes. Default: 50.
+    - n_jobs (int): Threads used to build the base indexes. Default: -1 (every CPU).
+    - grace_seconds (float): Seconds a retired segment is kept, longer than the refresh period of the searchers.
+      Default: 3600.
+    """
+
+    def __init__(self, index_root: str, metric: str='angular', n_trees: int=50, n_jobs: int=-1, grace_seconds: float=3600):
+        self.index_root = index_root.rstrip('/')
+        self.metric = metric
+        self.n_trees = n_trees
+        self.n_jobs = n_jobs
+        self.grace_seconds = grace_seconds
+        self._lock = threading.Lock()
+        if not self.index_root.startswith('gs://'):
+            os.makedirs(self.index_root, exist_ok=True)
+
+    def _uri(self, name: str) -> str:
+        return f'{self.index_root}/{name}'
+
+    def current(self) -> Dict:
+        current_text = _read_text(self._uri(CURRENT_FILE_NAME))
+        return json.loads(current_text) if current_text else None
+
+    @staticmethod
+    def _new_base_name(version: str) -> str:
+        return f'base-{version}-{uuid.uuid4().hex[:8]}'
+
+    def _swap(self, current: Dict, retired_segments: List[str]=()):
+        now = datetime.now(timezone.utc)
+        retired = current.get('retired', [])
+        expired = [segment for segment in retired if (now - datetime.fromisoformat(segment['retired_at'])).total_seconds() >= self.grace_seconds]
+        # The expired segments are removed before CURRENT stops listing them, so a failed removal is retried
+        for segment in expired:
+            _remove_directory(self._uri(segment['name']))
+        current['retired'] = [segment for segment in retired if segment not in expired]
+        current['retired'] += [{'name': name, 'retired_at': now.isoformat()} for name in retired_segments]
+        current['updated_at'] = now.isoformat()
+        _write_text_atomically(self._uri(CURRENT_FILE_NAME), json.dumps(current, indent=2))
+
+    def initialize(self, embedding_path: str, version: str) -> Dict:
+        """
+        Builds the base index of the embeddings stored by 'embedding_storing' and serves it without deltas.
+        """
+        base = self._new_base_name(version)
+        manifest = build_vector_index(embedding_path, [self._uri(base)], version, metric=self.metric, n_trees=self.n_trees, n_jobs=self.n_jobs)
+        with self._lock:
+            current = self.current() or {'next_segment': 0}
+            replaced_segments = ([current['base']] if current.get('base') else []) + [delta['name'] for delta in current.get('deltas', [])]
+            current.update({'version': version, 'base': base, 'dimensions': manifest['dimensions'], 'metric': self.metric, 'deltas': []})
+            self._swap(current, replaced_segments)
+        return current
+
+    def update(self, ids=None, vectors=None, deleted_ids=None) -> str:
+        """
+        Adds a delta segment with new or changed embeddings and deleted ids, served as soon as it returns.
+
+        Returns:
+        - The name of the delta segment.
+
+        Raises:
+        - ValueError: If the index isn't initialized or the vectors don't have its dimensions.
+        """
+        import numpy as np
+
+        current = self.current()
+        if current is None:
+            raise ValueError(f'The index {self.index_root} must be initialized before updating it')
+        ids = np.asarray(ids if ids is not None else [])
+        vectors = np.asarray(vectors if vectors is not None else np.empty((0, current['dimensions'])), dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != current['dimensions'] or len(vectors) != len(ids):
+            raise ValueError(f"vectors must be a (len(ids), {current['dimensions']}) array")
+
+        with self._lock:
+            current = self.current()
+            segment = f"delta-{current['next_segment']:06d}"
+            local_dir = tempfile.mkdtemp(prefix='vector-index-')
+            try:
+                np.save(os.path.join(local_dir, IDS_FILE_NAME), _ids_array(ids))
+                np.save(os.path.join(local_dir, DELTA_VECTORS_FILE_NAME), vectors)
+                np.save(os.path.join(local_dir, DELTA_DELETED_IDS_FILE_NAME), _ids_array(deleted_ids if deleted_ids is not None else ids[:0]))
+                upload_directory(local_dir, self._uri(segment), last_file_name=DELTA_DELETED_IDS_FILE_NAME)
+            finally:
+                shutil.rmtree(local_dir, ignore_errors=True)
+            current['next_segment'] += 1
+            current['deltas'].append({'name': segment, 'rows': len(ids), 'deleted': 0 if deleted_ids is None else len(deleted_ids)})
+            self._swap(current)
+        return segment
+
+    def _load_delta(self, segment: str) -> Tuple:
+        import numpy as np
+
+        local_dir = _local_copy(self._uri(segment))
+        return tuple(
+            np.load(os.path.join(local_dir, file_name), allow_pickle=False)
+            for file_name in (IDS_FILE_NAME, DELTA_VECTORS_FILE_NAME, DELTA_DELETED_IDS_FILE_NAME)
+        )
+
+    def should_compact(self, max_delta_rows: int=100_000, max_deltas: int=50) -> bool:
+        """
+        Returns True if the deltas are big enough to slow down the queries: more than 'max_delta_rows' rows
+        (new, changed or deleted) or more than 'max_deltas' segments.
+        """
+        current = self.current()
+        if current is None:
+            return False
+        delta_rows = sum(delta['rows'] + delta['deleted'] for delta in current['deltas'])
+        return delta_rows > max_delta_rows or len(current['deltas']) > max_deltas
+
+    def compact(self, version: str) -> Dict:
+        """
+        Merges the base index and the delta segments in a new base index and swaps it in atomically. The segments
+        added while the compaction runs stay in CURRENT on top of the new base index.
+
+        Returns:
+        - The new CURRENT.
+        """
+        from annoy import AnnoyIndex
+        import numpy as np
+
+        snapshot = self.current()
+        merged_segments = [delta['name'] for delta in snapshot['deltas']]
+        delta_ids, delta_vectors, hidden_ids = merge_delta_segments([self._load_delta(segment) for segment in merged_segments])
+
+        base_dir = _local_copy(self._uri(snapshot['base']))
+        base_index = AnnoyIndex(snapshot['dimensions'], snapshot['metric'])
+        base_index.load(os.path.join(base_dir, INDEX_FILE_NAME))
+        base_ids = np.load(os.path.join(base_dir, IDS_FILE_NAME), allow_pickle=False).tolist()
+
+        def batches():
+            # The base vectors are read back from the base index, so the embeddings aren't needed
+            live_items = [item for item, entity_id in enumerate(base_ids) if entity_id not in hidden_ids]
+            for start in range(0, len(live_items), 10_000):
+                items = live_items[start:start + 10_000]
+                yield [base_ids[item] for item in items], [base_index.get_item_vector(item) for item in items]
+            if delta_ids:
+                yield delta_ids, delta_vectors
+
+        base = self._new_base_name(version)
+        local_dir = tempfile.mkdtemp(prefix='vector-index-')
+        try:
+            build_stats = _build_index(local_dir, batches(), snapshot['dimensions'], snapshot['metric'], self.n_trees, self.n_jobs)
+            _write_index_manifest(local_dir, {
+                'version': version,
+                'compacted_from': [snapshot['base']] + merged_segments,
+                **build_stats,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+            })
+            upload_directory(local_dir, self._uri(base), last_file_name=INDEX_MANIFEST_FILE_NAME)
+        finally:
+            base_index.unload()
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+        with self._lock:
+            current = self.current()
+            replaced_segments = [current['base']] + [delta['name'] for delta in current['deltas'] if delta['name'] in merged_segments]
+            current['version'] = version
+            current['base'] = base
+            current['deltas'] = [delta for delta in current['deltas'] if delta['name'] not in merged_segments]
+            self._swap(current, replaced_segments)
+        return current
+
+    def compact_in_background(self, version: str) -> threading.Thread:
+        """
+        Runs 'compact' in a background thread, so updates go on while the new base index is built.
+        """
+        thread = threading.Thread(target=self.compact, args=(version,), name=f'vector-index-compaction-{version}', daemon=True)
+        thread.start()
+        return thread
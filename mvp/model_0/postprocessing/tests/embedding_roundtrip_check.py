@@ -0,0 +1,89 @@
+"""
+Checks that the entity ids stored with the embeddings and the vector indexes are read back unchanged, both for
+integer and string ids (stored as fixed-width arrays, since every reader loads them with allow_pickle=False):
+- embeddings: ids written by 'write_embeddings' in several shards are read back by 'EmbeddingReader'.
+- vector_index: the id map of 'build_vector_index' matches the ids of the embeddings.
+- segmented_index: the ids of a 'SegmentedVectorIndex' survive an update with tombstones and a compaction.
+It fails (exit code 1) if any check doesn't pass.
+
+Usage: python tests/embedding_roundtrip_check.py [--rows 5000]
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+
+# Run from the component directory: python tests/embedding_roundtrip_check.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.embedding_store import EmbeddingReader, write_embeddings
+from src.vector_index import IDS_FILE_NAME, SegmentedVectorIndex, build_vector_index
+
+
+# Auxiliar functions
+def entity_ids(kind: str, start: int, stop: int) -> np.ndarray:
+    """
+    Returns integer ids or string ids of different lengths. The string ids are an object array, like the id column
+    of a DataFrame.
+    """
+    if kind == 'int':
+        return np.arange(start, stop)
+    return np.array([f'cust-{position}' for position in range(start, stop)], dtype=object)
+
+
+def _load_ids(path: str) -> list:
+    return np.load(os.path.join(path, IDS_FILE_NAME), allow_pickle=False).tolist()
+
+
+# Main functions
+def run_checks(rows: int=5000, dimensions: int=16, seed: int=0) -> List[Dict]:
+    """
+    This function runs every check for integer and string ids in a temporary directory.
+
+    Returns:
+    - The report of every check.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(rows, dimensions)).astype(np.float32)
+    work_dir = tempfile.mkdtemp(prefix='embedding-roundtrip-')
+    reports = []
+    try:
+        for kind in ('int', 'str'):
+            ids = entity_ids(kind, 0, rows)
+            embedding_path = os.path.join(work_dir, kind, 'embeddings')
+            batches = ((ids[start:start + 1000], vectors[start:start + 1000]) for start in range(0, rows, 1000))
+            write_embeddings(batches, [embedding_path], 'v1', shard_rows=rows // 3)
+            reader = EmbeddingReader(embedding_path)
+            reports.append({'check': f'embeddings_{kind}', 'shards': len(reader.manifest['shards']), 'passed': reader.ids.tolist() == ids.tolist()})
+
+            index_path = os.path.join(work_dir, kind, 'index')
+            build_vector_index(embedding_path, [index_path], 'v1', n_trees=2, n_jobs=1)
+            reports.append({'check': f'vector_index_{kind}', 'passed': _load_ids(index_path) == ids.tolist()})
+
+            index = SegmentedVectorIndex(os.path.join(work_dir, kind, 'segmented'), n_trees=2, n_jobs=1)
+            index.initialize(embedding_path, 'v1')
+            new_ids = entity_ids(kind, rows, rows + 10)
+            index.update(new_ids, rng.normal(size=(10, dimensions)), deleted_ids=ids[:5])
+            current = index.compact('v2')
+            expected = ids[5:].tolist() + new_ids.tolist()
+            compacted_ids = _load_ids(index._uri(current['base']))
+            reports.append({'check': f'segmented_index_{kind}', 'items': len(compacted_ids), 'passed': compacted_ids == expected})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', help='Rows of the embeddings. Default: 5000.', type=int, default=5000)
+    args = parser.parse_args()
+
+    reports = run_checks(args.rows)
+    for report in reports:
+        print(report)
+    failed = [report['check'] for report in reports if not report['passed']]
+    print(f'{len(reports) - len(failed)}/{len(reports)} checks passed' + (f', failed: {failed}' if failed else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import numpy as np
+
+# Run from the component directory: python tests/embedding_search_benchmark.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.embedding_store import EmbeddingReader, write_embeddings
+from src.vector_index import build_vector_index, INDEX_FILE_NAME
+
+
+# Auxiliar functions
+def load_vectors(embedding_path: str=None, count: int=100_000, dimensions: int=64, seed: int=0) -> np.ndarray:
+    """
+    Returns the embeddings stored by 'embedding_storing' or, if 'embedding_path' is None, 'count' synthetic vectors
+    of 'dimensions' dimensions. The synthetic vectors are drawn around a few hundred centers, so they have
+    neighborhoods like real embeddings instead of being uniformly spread.
+    """
+    if embedding_path:
+        return EmbeddingReader(embedding_path).to_numpy()
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(count // 500, 1), dimensions))
+    return (centers[rng.integers(len(centers), size=count)] + 0.5 * rng.normal(size=(count, dimensions))).astype(np.float32)
+
+
+def exact_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int, metric: str='angular', batch_size: int=256) -> np.ndarray:
+    """
+    Returns the exact top-k neighbors (rows of 'vectors') of every query by vectorized brute force.
+    """
+    if metric == 'angular':
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    squared_norms = (vectors ** 2).sum(axis=1)
+
+    neighbors = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        if metric in ('angular', 'dot'):
+            scores = -(batch @ vectors.T)
+        elif metric == 'euclidean':
+            scores = squared_norms[None, :] - 2 * batch @ vectors.T
+        else:
+            raise ValueError(f'Exact neighbors are not implemented for the metric {metric}')
+        candidates = np.argpartition(scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(scores, candidates, axis=1), axis=1)
+        neighbors[start:start + batch_size] = np.take_along_axis(candidates, order, axis=1)
+    return neighbors
+
+
+def measure_queries(index, queries: np.ndarray, truth: np.ndarray, k: int, search_k: int) -> Dict:
+    """
+    Runs every query against the index in a single thread and returns its recall@k, QPS and latencies.
+    """
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        query_start = time.perf_counter()
+        found = index.get_nns_by_vector(query.tolist(), k, search_k=search_k)
+        latencies.append(time.perf_counter() - query_start)
+        hits += len(set(found) & set(expected.tolist()))
+    latencies = np.array(latencies)
+    return {
+        'search_k': search_k,
+        'recall_at_k': round(hits / (len(queries) * k), 4),
+        'qps': round(float(len(queries) / latencies.sum()), 1),
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)) * 1000, 3),
+        'latency_ms_p99': round(float(np.percentile(latencies, 99)) * 1000, 3),
+    }
+
+
+# Main functions
+def run_benchmark(
+    vectors: np.ndarray,
+    k: int=10,
+    n_queries: int=1000,
+    metric: str='angular',
+    n_trees_options: List[int]=(10, 50, 100),
+    search_k_options: List[int]=(-1, 1000, 10000),
+    seed: int=0,
+) -> Dict:
+    """
+    This function measures the recall@k, QPS, latency, build time and index size of every combination of
+    n_trees (build) and search_k (query) of the Annoy index built by 'build_vector_index'. The queries are held
+    out of the index, and their exact neighbors are computed by brute force.
+
+    Returns:
+    - A report with the dataset, the ground truth time and the measures of every setting.
+    """
+    from annoy import AnnoyIndex
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    queries, indexed = vectors[order[:n_queries]], vectors[order[n_queries:]]
+
+    truth_start = time.perf_counter()
+    truth = exact_neighbors(indexed, queries, k, metric)
+    ground_truth_seconds = time.perf_counter() - truth_start
+
+    work_dir = tempfile.mkdtemp(prefix='embedding-search-benchmark-')
+    results = []
+    try:
+        embedding_path = os.path.join(work_dir, 'embeddings')
+        write_embeddings([(np.arange(len(indexed)), indexed)], [embedding_path], 'benchmark', dtype='float32')
+        for n_trees in n_trees_options:
+            index_path = os.path.join(work_dir, f'index-{n_trees}')
+            manifest = build_vector_index(embedding_path, [index_path], 'benchmark', metric=metric, n_trees=n_trees, random_seed=seed)
+            index = AnnoyIndex(manifest['dimensions'], metric)
+            index.load(os.path.join(index_path, INDEX_FILE_NAME))
+            for search_k in search_k_options:
+                measures = measure_queries(index, queries, truth, k, search_k)
+                results.append({'n_trees': n_trees, 'build_seconds': manifest['build_seconds'], 'index_bytes': manifest['index_bytes'], **measures})
+                print(results[-1])
+            index.unload()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'dataset': {'vectors': len(indexed), 'dimensions': vectors.shape[1], 'queries': len(queries), 'k': k, 'metric': metric},
+        'ground_truth_seconds': round(ground_truth_seconds, 3),
+        'vectors_bytes': int(indexed.astype(np.float32).nbytes),
+        'results': results,
+    }
+
+
+def write_report(report: Dict, report_path: str, run_name: str):
+    """
+    Adds the report of a run to the JSON report, keyed by run name, so the runs can be compared.
+    """
+    reports = {}
+    if os.path.exists(report_path):
+        with open(report_path) as report_file:
+            reports = json.load(report_file)
+    reports[run_name] = report
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(report_path, 'w') as report_file:
+        json.dump(reports, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embedding_path', help='Embeddings stored by embedding_storing. Default: synthetic vectors.', type=str, default=None)
+    parser.add_argument('--count', help='Number of synthetic vectors. Default: 100000.', type=int, default=100_000)
+    parser.add_argument('--dimensions', help='Dimensions of the synthetic vectors. Default: 64.', type=int, default=64)
+    parser.add_argument('--queries', help='Number of queries held out of the index. Default: 1000.', type=int, default=1000)
+    parser.add_argument('--k', help='Neighbors by query. Default: 10.', type=int, default=10)
+    parser.add_argument('--metric', help="'angular', 'euclidean' or 'dot'. Default: 'angular'.", type=str, default='angular')
+    parser.add_argument('--n_trees', help='Comma separated n_trees to build. Default: 10,50,100.', type=str, default='10,50,100')
+    parser.add_argument('--search_k', help='Comma separated search_k to query (-1 is the Annoy default), e.g. --search_k=-1,1000. Default: -1,1000,10000.', type=str, default='-1,1000,10000')
+    parser.add_argument('--seed', help='Random seed. Default: 0.', type=int, default=0)
+    parser.add_argument('--report_path', help='JSON report. Default: tests/embedding_search_benchmark.json.', type=str, default='tests/embedding_search_benchmark.json')
+    parser.add_argument('--run_name', help='Name of the run in the report. Default: the current UTC time.', type=str, default=None)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.embedding_path, args.count, args.dimensions, args.seed)
+    report = run_benchmark(
+        vectors,
+        k=args.k,
+        n_queries=args.queries,
+        metric=args.metric,
+        n_trees_options=[int(value) for value in args.n_trees.split(',')],
+        search_k_options=[int(value) for value in args.search_k.split(',')],
+        seed=args.seed,
+    )
+    report['source'] = args.embedding_path or 'synthetic'
+    write_report(report, args.report_path, args.run_name or report['generated_at'])
+    print(f'Report written to {args.report_path}')
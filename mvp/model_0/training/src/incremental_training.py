@@ -0,0 +1,223 @@
+import os
+import json
+import pickle
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+TRAINING_STATE_FILE_NAME = 'training_state.json'
+
+
+# Auxiliar functions
+def model_artifact_uri(model_bucket_name: str, model_name: str, version: str, test_mode: bool=False) -> str:
+    """
+    Returns the directory where the model of a version is stored, the same one used as 'artifact_uri' to
+    deploy it (gs://<model_bucket_name>/models/<model_name>/metadata/<version>/). In test mode,
+    'model_bucket_name' is a local directory.
+    """
+    if test_mode:
+        return os.path.join(model_bucket_name, 'models', model_name, 'metadata', version) + os.sep
+    bucket_name = model_bucket_name[len('gs://'):] if model_bucket_name.startswith('gs://') else model_bucket_name
+    return f'gs://{bucket_name}/models/{model_name}/metadata/{version}/'
+
+
+def _write_bytes(uri: str, content: bytes):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        storage.Blob.from_string(uri, client=storage.Client()).upload_from_string(content)
+        return
+    os.makedirs(os.path.dirname(uri), exist_ok=True)
+    with open(uri, 'wb') as output_file:
+        output_file.write(content)
+
+
+def _read_bytes(uri: str) -> bytes:
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        return storage.Blob.from_string(uri, client=storage.Client()).download_as_bytes()
+    with open(uri, 'rb') as input_file:
+        return input_file.read()
+
+
+def _read_optional_bytes(uri: str) -> Optional[bytes]:
+    """Returns the content of a file, or None if it doesn't exist."""
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(uri, client=storage.Client())
+        return blob.download_as_bytes() if blob.exists() else None
+    if not os.path.exists(uri):
+        return None
+    return _read_bytes(uri)
+
+
+# Main functions
+def save_model_artifact(
+    model,
+    model_bucket_name: str,
+    model_name: str,
+    version: str,
+    training_state: Dict=None,
+    model_file_name: str='model.pkl',
+    test_mode: bool=False,
+) -> str:
+    """
+    Stores the model of a version and its training state (training mode, quality, watermark of the data used...)
+    so the next version can be warm started from it. It must be called from 'model_and_metric_storing'.
+
+    Returns:
+    - The directory where the model and its training state were stored.
+    """
+    artifact_uri = model_artifact_uri(model_bucket_name, model_name, version, test_mode)
+    _write_bytes(artifact_uri + model_file_name, pickle.dumps(model))
+    if training_state is not None:
+        _write_bytes(artifact_uri + TRAINING_STATE_FILE_NAME, json.dumps(training_state, indent=2, default=str).encode())
+    return artifact_uri
+
+
+def load_model_artifact(
+    model_bucket_name: str,
+    model_name: str,
+    version: str,
+    model_file_name: str='model.pkl',
+    test_mode: bool=False,
+) -> Tuple[Any, Dict]:
+    """
+    Loads the model of a previous version and its training state from the storage used by
+    'model_and_metric_storing'.
+
+    Returns:
+    - A tuple (model, training_state). training_state is an empty dict if the version didn't store it, and the
+      tuple is (None, {}) if the version has no model, so 'warm_start_training' falls back to a full retrain.
+    """
+    artifact_uri = model_artifact_uri(model_bucket_name, model_name, version, test_mode)
+    model_bytes = _read_optional_bytes(artifact_uri + model_file_name)
+    if model_bytes is None:
+        return None, {}
+    training_state_bytes = _read_optional_bytes(artifact_uri + TRAINING_STATE_FILE_NAME)
+    return pickle.loads(model_bytes), json.loads(training_state_bytes) if training_state_bytes else {}
+
+
+def select_training_delta(feature_data, watermark_column: str, watermark=None):
+    """
+    Returns the rows of a pandas DataFrame that are newer than the watermark of the previous version. All the
+    rows are returned if there is no watermark.
+    """
+    import pandas as pd
+
+    if watermark is None:
+        return feature_data
+    # Watermarks read from the training state are strings
+    if isinstance(watermark, str) and pd.api.types.is_datetime64_any_dtype(feature_data[watermark_column]):
+        watermark = pd.Timestamp(watermark)
+    return feature_data[feature_data[watermark_column] > watermark]
+
+
+def replay_weighted_sample(
+    history,
+    delta,
+    replay_ratio: float=0.2,
+    replay_weight: float=1.0,
+    weight_column: str='sample_weight',
+    random_state: int=None,
+):
+    """
+    Mixes the new rows with a sample of the previous rows to avoid forgetting them when a model is trained
+    only with new data. The number of replayed rows is proportional to the delta ('replay_ratio' * rows of
+    the delta), so the training cost follows the size of the delta and not the size of the history.
+
+    Returns:
+    - A pandas DataFrame with the delta rows (weight 1) and the replayed rows (weight 'replay_weight') and a
+      'weight_column' column to be used as sample weights.
+    """
+    import pandas as pd
+
+    replay_rows = min(len(history), int(round(len(delta) * replay_ratio)))
+    replayed = history.sample(n=replay_rows, random_state=random_state) if replay_rows else history.iloc[:0]
+    return pd.concat(
+        [delta.assign(**{weight_column: 1.0}), replayed.assign(**{weight_column: replay_weight})],
+        ignore_index=True,
+    )
+
+
+def warm_start_training(
+    full_training: Callable[[], Tuple],
+    incremental_training: Callable[[Any], Tuple],
+    get_quality: Callable[[Tuple], float],
+    version: str,
+    previous_model=None,
+    previous_state: Dict=None,
+    max_quality_drop: float=0.01,
+    higher_is_better: bool=True,
+    max_incremental_runs: int=None,
+    watermark=None,
+) -> Tuple[Tuple, Dict]:
+    """
+    This function trains a model incrementally when it is possible and falls back to a full retrain when it isn't.
+    The incremental model continues the training of the previous model with the new data only (or a replay
+    weighted sample). Its quality is compared with the quality of the last full retrain, recorded in the
+    training state of the previous version, and a full retrain is done if the quality drops more than
+    'max_quality_drop'. A full retrain is also done if there is no previous model or after
+    'max_incremental_runs' consecutive incremental runs, to bound the drift of the warm started models.
+
+    Parameters:
+    - full_training (Callable): Function without arguments that trains a model from scratch with the full history
+      and returns its model metadata (the output of 'model_training').
+    - incremental_training (Callable): Function that receives the previous model, continues its training with the
+      new data and returns its model metadata.
+    - get_quality (Callable): Function that returns the quality metric of a model metadata, evaluated in the
+      same validation data for both kinds of training.
+    - version (str): Version that is being trained. It is the base version of the next incremental runs if a
+      full retrain is done.
+    - previous_model (optional): Model of the previous version. If it is None, a full retrain is done.
+    - previous_state (Dict, optional): Training state of the previous version (see 'load_model_artifact').
+    - max_quality_drop (float): Maximum drop of the quality metric allowed to the incremental model. Default: 0.01.
+    - higher_is_better (bool): If the quality metric is better when it is higher. Default: True.
+    - max_incremental_runs (int, optional): Maximum number of consecutive incremental runs.
+    - watermark (optional): Watermark of the data used in this run (e.g. the max timestamp of the features), to
+      select the delta of the next run.
+
+    Returns:
+    - A tuple (model_metadata, training_state). training_state must be stored with the model (see
+      'save_model_artifact') so the next version can be trained from it.
+    """
+    previous_state = previous_state or {}
+    incremental_runs = previous_state.get('incremental_runs', 0)
+    reference_quality = previous_state.get('reference_quality')
+
+    fallback_reason = None
+    if previous_model is None:
+        fallback_reason = 'there is no previous model'
+    elif reference_quality is None:
+        fallback_reason = 'the previous version has no reference quality of a full retrain'
+    elif max_incremental_runs is not None and incremental_runs >= max_incremental_runs:
+        fallback_reason = f'{incremental_runs} consecutive incremental runs'
+
+    if fallback_reason is None:
+        model_metadata = incremental_training(previous_model)
+        quality = get_quality(model_metadata)
+        quality_drop = (reference_quality - quality) if higher_is_better else (quality - reference_quality)
+        if quality_drop <= max_quality_drop:
+            return model_metadata, {
+                'training_mode': 'incremental',
+                'quality': quality,
+                'reference_quality': reference_quality,
+                'quality_drop': quality_drop,
+                'incremental_runs': incremental_runs + 1,
+                'base_version': previous_state.get('base_version'),
+                'watermark': watermark,
+                'trained_at': datetime.now(timezone.utc).isoformat(),
+            }
+        fallback_reason = f'quality dropped {quality_drop} (max allowed {max_quality_drop})'
+
+    model_metadata = full_training()
+    quality = get_quality(model_metadata)
+    return model_metadata, {
+        'training_mode': 'full',
+        'quality': quality,
+        'reference_quality': quality,
+        'incremental_runs': 0,
+        'base_version': version,
+        'fallback_reason': fallback_reason,
+        'watermark': watermark,
+        'trained_at': datetime.now(timezone.utc).isoformat(),
+    }
@@ -0,0 +1,153 @@
+import io
+from typing import Dict, List, Tuple
+
+try:
+    from incremental_training import _write_bytes, model_artifact_uri
+    from linear_scoring import LINEAR_MODEL_FILE_NAME, LinearScorer, check_linear_parity
+except ImportError:
+    from src.incremental_training import _write_bytes, model_artifact_uri
+    from src.linear_scoring import LINEAR_MODEL_FILE_NAME, LinearScorer, check_linear_parity
+
+
+# Auxiliar functions
+def _affine_step(step, n_features: int) -> Tuple:
+    """
+    Returns the (scale, offset) of a scikit-learn scaler, x' = x * scale + offset, by feature.
+
+    Raises:
+    - ValueError: If the step isn't an affine scaler supported by the export.
+    """
+    import numpy as np
+
+    ones, zeros = np.ones(n_features), np.zeros(n_features)
+    name = type(step).__name__
+    if step is None or step == 'passthrough':
+        return ones, zeros
+    if name == 'StandardScaler':
+        # mean_ is fitted even with with_mean=False, but it is only subtracted if with_mean is True
+        scale = 1.0 / step.scale_ if step.with_std and step.scale_ is not None else ones
+        offset = -step.mean_ * scale if step.with_mean and step.mean_ is not None else zeros
+        return scale, offset
+    if name == 'MinMaxScaler' and not getattr(step, 'clip', False):
+        return step.scale_, step.min_
+    if name == 'MaxAbsScaler':
+        return 1.0 / step.scale_, zeros
+    raise ValueError(f'The step {name} can not be exported to a linear kernel')
+
+
+def _link(estimator) -> str:
+    classes = getattr(estimator, 'classes_', None)
+    if classes is None:
+        return 'identity'
+    if len(classes) == 2:
+        return 'logistic'
+    multi_class = getattr(estimator, 'multi_class', 'auto')
+    if type(estimator).__name__ == 'LogisticRegression' and multi_class != 'ovr' and getattr(estimator, 'solver', '') != 'liblinear':
+        return 'softmax'
+    return 'ovr'
+
+
+# Main functions
+def extract_linear_model(model, feature_names: List[str]=None) -> LinearScorer:
+    """
+    Extracts the coefficients of a fitted scikit-learn linear model (LinearRegression, Ridge, Lasso,
+    LogisticRegression, SGDClassifier, LinearSVC...) or of a Pipeline of imputers and scalers (SimpleImputer,
+    StandardScaler, MinMaxScaler, MaxAbsScaler) ending in one. The scalers are folded in the coefficients,
+    so scoring is a single matrix product.
+
+    Parameters:
+    - model: Fitted model or Pipeline.
+    - feature_names (List[str], optional): Names of the features, in order. Default: the names seen in the fit.
+
+    Returns:
+    - A 'LinearScorer' with the arrays of the model.
+
+    Raises:
+    - ValueError: If the model or one of its steps isn't linear.
+    """
+    import numpy as np
+
+    steps = [step for _, step in model.steps] if hasattr(model, 'steps') else [model]
+    estimator = steps[-1]
+    if not hasattr(estimator, 'coef_'):
+        raise ValueError(f'{type(estimator).__name__} is not a linear model')
+
+    coef = np.asarray(estimator.coef_, dtype=np.float64)
+    coef = coef.reshape(-1, 1) if coef.ndim == 1 else coef.T
+    n_features = coef.shape[0]
+    intercept = np.broadcast_to(np.asarray(getattr(estimator, 'intercept_', 0.0), dtype=np.float64), (coef.shape[1],)).copy()
+
+    impute_values = None
+    scale, offset = np.ones(n_features), np.zeros(n_features)
+    for position, step in enumerate(steps[:-1]):
+        if type(step).__name__ == 'SimpleImputer':
+            # Missing values are imputed before any scaling
+            if position != 0 or getattr(step, 'add_indicator', False) or len(step.statistics_) != n_features:
+                raise ValueError('Only a first SimpleImputer without indicators can be exported to a linear kernel')
+            impute_values = np.asarray(step.statistics_, dtype=np.float64)
+            continue
+        step_scale, step_offset = _affine_step(step, n_features)
+        scale, offset = scale * step_scale, offset * step_scale + step_offset
+
+    # (x * scale + offset) @ coef + intercept = x @ (scale * coef) + (offset @ coef + intercept)
+    folded_intercept = offset @ coef + intercept
+    folded_coef = scale[:, None] * coef
+
+    if feature_names is None:
+        feature_names = getattr(model, 'feature_names_in_', None)
+    return LinearScorer(
+        coef=folded_coef,
+        intercept=folded_intercept,
+        link=_link(estimator),
+        classes=getattr(estimator, 'classes_', None),
+        impute_values=impute_values,
+        feature_names=None if feature_names is None else list(feature_names),
+    )
+
+
+def export_linear_model(
+    model,
+    model_bucket_name: str,
+    model_name: str,
+    version: str,
+    feature_names: List[str]=None,
+    parity_features=None,
+    atol: float=1e-6,
+    test_mode: bool=False,
+) -> Dict:
+    """
+    Exports the coefficients and preprocessing constants of a linear model as plain arrays
+    (linear_model.npz, without pickles) next to the model of the version, to be scored by 'LinearScorer' in
+    inference and postprocessing. It must be called from 'model_and_metric_storing'.
+
+    Parameters:
+    - model: Fitted model or Pipeline (see 'extract_linear_model').
+    - model_bucket_name (str): Bucket of the models. In test mode, a local directory.
+    - model_name (str): Name of the model.
+    - version (str): Version of the model.
+    - feature_names (List[str], optional): Names of the features, in order.
+    - parity_features (optional): Features (e.g. the validation data) scored by the model and by the kernel
+      before exporting it.
+    - atol (float): Max absolute difference allowed by the parity check. Default: 1e-6.
+    - test_mode (bool): If the model bucket is a local directory. Default: False.
+
+    Returns:
+    - The URI of the exported arrays and the parity report.
+
+    Raises:
+    - ValueError: If the model isn't linear or the kernel doesn't match the model.
+    """
+    import numpy as np
+
+    scorer = extract_linear_model(model, feature_names)
+    parity = None
+    if parity_features is not None:
+        parity = check_linear_parity(model, scorer, parity_features, atol)
+        if not parity['passed']:
+            raise ValueError(f'The linear kernel does not match the model: {parity}')
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **scorer.to_arrays())
+    output_uri = model_artifact_uri(model_bucket_name, model_name, version, test_mode) + LINEAR_MODEL_FILE_NAME
+    _write_bytes(output_uri, buffer.getvalue())
+    return {'uri': output_uri, 'parity': parity}
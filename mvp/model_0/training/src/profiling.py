@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+try:
+    from stage_data import copy_stats
+except ImportError:
+    from src.stage_data import copy_stats
+
+
+# Auxiliar functions
+def _read_rss_bytes() -> Optional[int]:
+    """Returns the current resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+def _read_max_rss_bytes() -> Optional[int]:
+    """Returns the high-water mark of the resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _read_io_bytes() -> Dict[str, int]:
+    """
+    Returns the bytes read and written by this process. 'read_bytes' and 'written_bytes' count every
+    read/write syscall (sockets included, so BigQuery and GCS transfers are accounted), while the 'disk_*'
+    counters only count what reached the storage layer.
+    """
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return {
+            'read_bytes': int(counters['rchar']),
+            'written_bytes': int(counters['wchar']),
+            'disk_read_bytes': int(counters['read_bytes']),
+            'disk_written_bytes': int(counters['write_bytes']),
+        }
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        io_counters = psutil.Process().io_counters()
+        return {'read_bytes': io_counters.read_bytes, 'written_bytes': io_counters.write_bytes}
+    except Exception:
+        return {}
+
+
+class _RssSampler(threading.Thread):
+    """Polls the resident set size in background to get the peak of a single stage."""
+
+    def __init__(self, interval: float=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss_bytes = _read_rss_bytes() or 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss_bytes = max(self.peak_rss_bytes, _read_rss_bytes() or 0)
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        self.peak_rss_bytes = max(self.peak_rss_bytes, _read_rss_bytes() or 0)
+        return self.peak_rss_bytes
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Low-overhead statistical profiler. It samples the stack of one thread every 'interval' seconds and
+    aggregates the samples as collapsed stacks ('frame;frame;frame count'), the format read by
+    flamegraph.pl, speedscope and most flamegraph viewers.
+    """
+
+    def __init__(self, thread_id: int=None, interval: float=0.01):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> Counter:
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+    def dump(self, file_path: str):
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with open(file_path, 'w') as collapsed_file:
+            for stack, count in self.samples.most_common():
+                collapsed_file.write(f'{stack} {count}\n')
+
+
+# Main functions
+class StageProfiler:
+    """
+    This class wraps every stage of a pipeline and records its cost: wall time, CPU time, CPU utilization,
+    peak RSS, bytes read/written and copies of the stage data (see src/stage_data.py). Optionally, a sampling
+    profiler runs during each stage and its collapsed stacks are dumped in 'sampling_dir'. The measures are
+    written as a JSON report keyed by model version, so the cost of a new version can be compared with the
+    previous ones.
+
+    Parameters:
+    - version (str): Model version that is being generated. It is the key of the report.
+    - report_path (str): Path of the JSON report. It is updated in place to keep the measures of other versions.
+    - sampling_dir (str, optional): Directory to dump one collapsed-stack file per stage. If it isn't provided,
+      the sampling profiler is not started.
+    - sampling_interval (float): Seconds between two samples of the sampling profiler.
+    - labels (Dict, optional): Labels of the component, they are saved with the measures.
+
+    Example:
+        profiler = StageProfiler(version=version, report_path='tests/stage_profiling_metrics.json')
+        with profiler.stage('feature_ingestion'):
+            feature_data = feature_ingestion(...)
+        profiler.write_report()
+    """
+
+    def __init__(
+        self,
+        version: str,
+        report_path: str='tests/stage_profiling_metrics.json',
+        sampling_dir: str=None,
+        sampling_interval: float=0.01,
+        labels: Dict=None,
+    ):
+        self.version = version
+        self.report_path = report_path
+        self.sampling_dir = sampling_dir
+        self.sampling_interval = sampling_interval
+        self.labels = labels or {}
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        sampler = None
+        if self.sampling_dir:
+            sampler = SamplingProfiler(interval=self.sampling_interval)
+            sampler.start()
+        rss_sampler = _RssSampler()
+        rss_sampler.start()
+        io_start = _read_io_bytes()
+        copies_start = copy_stats()
+        max_rss_start = _read_max_rss_bytes()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            max_rss_end = _read_max_rss_bytes()
+            io_end = _read_io_bytes()
+            peak_rss_bytes = rss_sampler.stop()
+            # If the process reached a new high-water mark during the stage, it is the exact stage peak
+            if max_rss_start is not None and max_rss_end > max_rss_start:
+                peak_rss_bytes = max_rss_end
+
+            measures = {
+                'wall_time_seconds': round(wall_time, 6),
+                'cpu_time_seconds': round(cpu_time, 6),
+                'cpu_utilization': round(cpu_time / wall_time, 4) if wall_time > 0 else None,
+                'peak_rss_bytes': peak_rss_bytes,
+            }
+            for counter_name in io_end:
+                measures[counter_name] = io_end[counter_name] - io_start.get(counter_name, 0)
+            # Conversions of the stage data (src/stage_data.py): views of Arrow memory vs copies
+            for counter_name, value in copy_stats().items():
+                measures[f'stage_data_{counter_name}'] = value - copies_start[counter_name]
+
+            if sampler is not None:
+                sampler.stop()
+                sampling_path = os.path.join(self.sampling_dir, self.version, f'{stage_name}.collapsed')
+                sampler.dump(sampling_path)
+                measures['sampling_profile_path'] = sampling_path
+
+            self.stages[stage_name] = measures
+
+    def run(self, stage_name: str, stage_function, *args, **kwargs):
+        """Runs 'stage_function' with the given arguments inside a profiled stage and returns its output."""
+        with self.stage(stage_name):
+            return stage_function(*args, **kwargs)
+
+    def summary(self) -> Dict:
+        stages = list(self.stages.values())
+        wall_time = sum(stage['wall_time_seconds'] for stage in stages)
+        cpu_time = sum(stage['cpu_time_seconds'] for stage in stages)
+        summary = {
+            'wall_time_seconds': round(wall_time, 6),
+            'cpu_time_seconds': round(cpu_time, 6),
+            'cpu_utilization': round(cpu_time / wall_time, 4) if wall_time > 0 else None,
+            'peak_rss_bytes': max((stage['peak_rss_bytes'] for stage in stages), default=None),
+        }
+        for counter_name in ['read_bytes', 'written_bytes', 'disk_read_bytes', 'disk_written_bytes']:
+            if any(counter_name in stage for stage in stages):
+                summary[counter_name] = sum(stage.get(counter_name, 0) for stage in stages)
+        return summary
+
+    def write_report(self) -> str:
+        """
+        Adds the measures of this version to the JSON report and returns its path. If 'report_path' is a
+        GCS URI (gs://bucket/path), the report is read and written through google-cloud-storage.
+        """
+        report = _load_json(self.report_path)
+        report[self.version] = {
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'labels': self.labels,
+            'stages': self.stages,
+            'total': self.summary(),
+        }
+        _dump_json(report, self.report_path)
+        return self.report_path
+
+
+def compare_stage_profiles(
+    report_path: str,
+    baseline_version: str,
+    candidate_version: str,
+    metrics: List[str]=('wall_time_seconds', 'cpu_time_seconds', 'peak_rss_bytes', 'read_bytes', 'written_bytes'),
+) -> Dict:
+    """
+    Compares the stage measures of two model versions saved in the same report.
+
+    Returns:
+    - A dictionary {stage_name: {metric: candidate_value / baseline_value}}. Values greater than 1 are cost
+      regressions of the candidate version. The 'total' key compares the whole pipeline.
+    """
+    report = _load_json(report_path)
+    baseline, candidate = report[baseline_version], report[candidate_version]
+    pairs = {stage_name: (baseline['stages'][stage_name], candidate_stage)
+             for stage_name, candidate_stage in candidate['stages'].items() if stage_name in baseline['stages']}
+    pairs['total'] = (baseline['total'], candidate['total'])
+
+    ratios = {}
+    for stage_name, (baseline_stage, candidate_stage) in pairs.items():
+        ratios[stage_name] = {
+            metric: round(candidate_stage[metric] / baseline_stage[metric], 4)
+            for metric in metrics if baseline_stage.get(metric) and candidate_stage.get(metric) is not None
+        }
+    return ratios
+
+
+def _load_json(path: str) -> Dict:
+    if path.startswith('gs://'):
+        from google.cloud import storage
+        blob = storage.Blob.from_string(path, client=storage.Client())
+        return json.loads(blob.download_as_text()) if blob.exists() else {}
+    if not os.path.exists(path):
+        return {}
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def _dump_json(content: Dict, path: str):
+    text = json.dumps(content, indent=2, sort_keys=True)
+    if path.startswith('gs://'):
+        from google.cloud import storage
+        storage.Blob.from_string(path, client=storage.Client()).upload_from_string(text, content_type='application/json')
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as json_file:
+        json_file.write(text)
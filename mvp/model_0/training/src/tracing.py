@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import inspect
+import threading
+import functools
+import contextvars
+from typing import Callable, Dict, List, Optional
+
+
+TRACEPARENT_HEADER = 'traceparent'
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+# Arguments of the stage functions with the datasets, their rows are recorded in the span
+DATASET_ARGUMENTS = ('input_data', 'feature_data', 'hp_feature_data', 'feature_datasets', 'prediction_datasets', 'embedding_datasets')
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+# Auxiliar functions
+def parse_traceparent(traceparent: str) -> Optional[Dict]:
+    """
+    Returns the trace id, parent span id and sampled flag of a W3C traceparent header
+    ('00-<32 hex trace id>-<16 hex span id>-<2 hex flags>'), or None if it isn't valid.
+    """
+    parts = (traceparent or '').strip().lower().split('-')
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == 'ff' or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return {'trace_id': parts[1], 'span_id': parts[2], 'sampled': bool(flags & 1)}
+
+
+def count_rows(data) -> Optional[int]:
+    """
+    Returns the rows of a dataset (Arrow table, DataFrame, array) or the sum of the rows of a tuple of datasets
+    (e.g. a StageData), or None if they can't be counted.
+    """
+    if hasattr(data, 'num_rows'):
+        return data.num_rows
+    if hasattr(data, 'shape') and getattr(data, 'shape', None):
+        return data.shape[0]
+    if isinstance(data, tuple):
+        counts = [count_rows(dataset) for dataset in data]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _attribute_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _attributes(attributes: Dict) -> List[Dict]:
+    return [{'key': key, 'value': _attribute_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """
+    A timed operation of a trace (a request, a job or a stage call). It is the current span of the context between
+    __enter__ and __exit__, so the spans opened inside it are its children.
+    """
+
+    sampled = True
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_span_id: str=None, kind: str='internal', attributes: Dict=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = None
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+        self._token = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_exception(self, error: BaseException):
+        self.events.append({
+            'timeUnixNano': str(time.time_ns()),
+            'name': 'exception',
+            'attributes': _attributes({'exception.type': type(error).__name__, 'exception.message': str(error)}),
+        })
+        self.status = {'code': 2, 'message': f'{type(error).__name__}: {error}'}
+
+    def end(self):
+        if self.end_time_ns is None:
+            self.end_time_ns = time.time_ns()
+            self.tracer._export(self)
+
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None:
+            self.record_exception(exc_value)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+    def to_otlp(self) -> Dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': SPAN_KINDS.get(self.kind, 1),
+            'startTimeUnixNano': str(self.start_time_ns),
+            'endTimeUnixNano': str(self.end_time_ns),
+            'attributes': _attributes(self.attributes),
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        if self.events:
+            span['events'] = self.events
+        if self.status:
+            span['status'] = self.status
+        return span
+
+
+class _UnsampledSpan(Span):
+    """
+    A span of a trace that isn't sampled: it keeps the trace context, so its children and the downstream services
+    don't sample the trace either, but it records nothing.
+    """
+
+    sampled = False
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def record_exception(self, error: BaseException):
+        pass
+
+    def end(self):
+        pass
+
+
+class FileSpanExporter:
+    """
+    Appends the spans to a local file as OTLP/JSON lines (one ExportTraceServiceRequest by line, the format of
+    the file exporter of the OpenTelemetry Collector), to be read by a collector or inspected offline.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def export(self, request: Dict):
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        with open(self.file_path, 'a') as trace_file:
+            trace_file.write(json.dumps(request) + '\n')
+
+
+class OTLPHttpExporter:
+    """
+    Sends the spans to an OTLP/HTTP collector (<endpoint>/v1/traces) as JSON.
+    """
+
+    def __init__(self, endpoint: str, timeout: float=5.0, headers: Dict=None):
+        self.url = endpoint.rstrip('/') + ('' if endpoint.rstrip('/').endswith('/v1/traces') else '/v1/traces')
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+
+    def export(self, request: Dict):
+        import urllib.request
+
+        http_request = urllib.request.Request(self.url, data=json.dumps(request).encode(), headers=self.headers, method='POST')
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            response.read()
+
+
+# Main functions
+class Tracer:
+    """
+    This class opens the spans of a component (see 'span' and 'wrap_stage') and exports them in background, by
+    batches, to a local file or to an OTLP collector, so tracing adds a few microseconds by span to the traced code.
+    Traces are sampled at their root with probability 'sample_rate' (the decision is kept by the whole trace and
+    propagated in the traceparent header), so the unsampled ones cost a context variable by span. Without an
+    exporter, tracing is disabled and the stage functions are not wrapped.
+
+    The same file is copied in the src directory of every component.
+
+    Parameters:
+    - service_name (str): Name of the component, e.g. 'inference'.
+    - exporter (optional): A FileSpanExporter, an OTLPHttpExporter or any object with an export(request) method.
+    - sample_rate (float): Share of the traces recorded. Default: 1.0.
+    - resource_attributes (Dict, optional): Attributes of every span of the component, e.g. the labels.
+    - max_queue_size (int): Max spans waiting to be exported, the next ones are dropped. Default: 10_000.
+    - export_interval (float): Max seconds between exports. Default: 2.0.
+    - max_batch_size (int): Max spans by export. Default: 512.
+    """
+
+    def __init__(
+        self,
+        service_name: str,
+        exporter=None,
+        sample_rate: float=1.0,
+        resource_attributes: Dict=None,
+        max_queue_size: int=10_000,
+        export_interval: float=2.0,
+        max_batch_size: int=512,
+    ):
+        self.service_name = service_name
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.resource_attributes = {'service.name': service_name, **(resource_attributes or {})}
+        self.export_interval = export_interval
+        self.max_batch_size = max_batch_size
+        self.stats = {'exported_spans': 0, 'dropped_spans': 0, 'export_errors': 0}
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._flush_event = threading.Event()
+        self._stopped = threading.Event()
+        self._worker = None
+        if self.enabled:
+            self._worker = threading.Thread(target=self._export_loop, name='span-exporter', daemon=True)
+            self._worker.start()
+            atexit.register(self.shutdown)
+
+    @classmethod
+    def from_env(cls, service_name: str, file_path: str=None, sample_rate: float=1.0, resource_attributes: Dict=None) -> 'Tracer':
+        """
+        Returns a tracer configured by the environment: TRACE_OTLP_ENDPOINT (URL of an OTLP/HTTP collector) or
+        TRACE_FILE_PATH (OTLP/JSON lines file), default 'file_path', and TRACE_SAMPLE_RATE, default 'sample_rate'.
+        Without an endpoint nor a file, tracing is disabled.
+        """
+        endpoint = os.environ.get('TRACE_OTLP_ENDPOINT')
+        file_path = os.environ.get('TRACE_FILE_PATH', file_path)
+        exporter = OTLPHttpExporter(endpoint) if endpoint else (FileSpanExporter(file_path) if file_path else None)
+        return cls(
+            service_name=service_name,
+            exporter=exporter,
+            sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', sample_rate)),
+            resource_attributes=resource_attributes,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and self.sample_rate > 0
+
+    def span(self, name: str, parent: str=None, kind: str='internal', attributes: Dict=None) -> Span:
+        """
+        Returns a new span, to be used as a context manager. Its parent is the current span or, for the root span of
+        a request, the traceparent header of the caller. A new trace is sampled with probability 'sample_rate'.
+        """
+        parent_span = _current_span.get()
+        if parent_span is not None:
+            trace_id, parent_span_id, sampled = parent_span.trace_id, parent_span.span_id, parent_span.sampled
+        else:
+            context = parse_traceparent(parent) if parent else None
+            if context is not None:
+                trace_id, parent_span_id, sampled = context['trace_id'], context['span_id'], context['sampled']
+            else:
+                trace_id, parent_span_id = f'{random.getrandbits(128):032x}', None
+                sampled = self.enabled and random.random() < self.sample_rate
+        span_class = Span if sampled and self.enabled else _UnsampledSpan
+        return span_class(self, name, trace_id, parent_span_id, kind, attributes)
+
+    def wrap_stage(self, stage_function: Callable) -> Callable:
+        """
+        Returns the stage function traced: every call opens a span named as the function with its labels
+        (application_name, model_name, version, component...), the rows of its input datasets (rows_in) and the
+        rows of its output (rows_out). If tracing is disabled, the function is returned as it is.
+        """
+        if not self.enabled:
+            return stage_function
+
+        parameters = inspect.signature(stage_function).parameters
+        default_labels = parameters['labels'].default if 'labels' in parameters and isinstance(parameters['labels'].default, dict) else {}
+
+        @functools.wraps(stage_function)
+        def traced_stage(*args, **kwargs):
+            with self.span(stage_function.__name__) as span:
+                if span.sampled:
+                    for key, value in (kwargs.get('labels') or default_labels).items():
+                        span.set_attribute(key, value)
+                    rows_in = [count_rows(kwargs[argument]) for argument in DATASET_ARGUMENTS if argument in kwargs]
+                    rows_in = [rows for rows in rows_in if rows is not None]
+                    if rows_in:
+                        span.set_attribute('rows_in', sum(rows_in))
+                output = stage_function(*args, **kwargs)
+                if span.sampled:
+                    span.set_attribute('rows_out', count_rows(output))
+                return output
+
+        return traced_stage
+
+    def _export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.stats['dropped_spans'] += 1
+            return
+        if self._queue.qsize() >= self.max_batch_size:
+            self._flush_event.set()
+
+    def _export_batch(self, spans: List[Span]):
+        request = {'resourceSpans': [{
+            'resource': {'attributes': _attributes(self.resource_attributes)},
+            'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': [span.to_otlp() for span in spans]}],
+        }]}
+        try:
+            self.exporter.export(request)
+            self.stats['exported_spans'] += len(spans)
+        except Exception as e:
+            self.stats['export_errors'] += 1
+            self.stats['dropped_spans'] += len(spans)
+            print(f'Error exporting {len(spans)} spans: {e}')
+
+    def _drain(self):
+        while True:
+            spans = []
+            while len(spans) < self.max_batch_size:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not spans:
+                return
+            self._export_batch(spans)
+
+    def _export_loop(self):
+        while not self._stopped.is_set():
+            self._flush_event.wait(self.export_interval)
+            self._flush_event.clear()
+            self._drain()
+
+    def shutdown(self):
+        """
+        Exports the spans in the queue and stops the exporter thread.
+        """
+        if self._worker is not None and not self._stopped.is_set():
+            self._stopped.set()
+            self._flush_event.set()
+            self._worker.join()
+            self._drain()
@@ -0,0 +1,119 @@
+"""
+Checks that the linear kernel exported by 'export_linear_model' scores like the scikit-learn model it was exported
+from, for every supported scaler and link: every case is fitted on synthetic data (with missing values imputed by a
+first SimpleImputer), exported to linear_model.npz, loaded back by 'LinearScorer' and compared with
+'check_linear_parity'. It fails (exit code 1) if any case doesn't match.
+
+Usage: python tests/linear_export_parity_check.py [--rows 2000] [--atol 1e-6]
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import warnings
+from typing import Dict, List
+
+import numpy as np
+
+# Run from the component directory: python tests/linear_export_parity_check.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.linear_export import export_linear_model
+from src.linear_scoring import LinearScorer, check_linear_parity
+
+
+# Auxiliar functions
+def synthetic_data(rows: int, columns: int=6, seed: int=0) -> Dict:
+    """
+    Returns a DataFrame of features on different scales and offsets (so folding a scaler wrongly shows up), with 2%
+    missing values, and its regression, binary and multiclass targets.
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((rows, columns)) * rng.uniform(0.5, 20, columns) + rng.uniform(-50, 50, columns)
+    signal = (features - features.mean(axis=0)) / features.std(axis=0) @ rng.standard_normal(columns)
+    missing = features.copy()
+    missing[rng.random(missing.shape) < 0.02] = np.nan
+    return {
+        'X': pd.DataFrame(missing, columns=[f'feature_{position}' for position in range(columns)]),
+        'regression': signal + 0.1 * rng.standard_normal(rows),
+        'binary': (signal > 0).astype(int),
+        'multiclass': np.digitize(signal, np.quantile(signal, [1 / 3, 2 / 3])),
+    }
+
+
+def scalers() -> Dict:
+    from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler, StandardScaler
+
+    return {
+        'passthrough': 'passthrough',
+        'standard': StandardScaler(),
+        'standard_without_mean': StandardScaler(with_mean=False),
+        'standard_without_std': StandardScaler(with_std=False),
+        'min_max': MinMaxScaler(),
+        'max_abs': MaxAbsScaler(),
+    }
+
+
+def estimators() -> Dict:
+    """Estimators by expected link, with the target they are fitted on."""
+    from sklearn.linear_model import LinearRegression, LogisticRegression, Ridge
+    from sklearn.svm import LinearSVC
+
+    return {
+        'identity_linear_regression': ('identity', 'regression', LinearRegression()),
+        'identity_ridge': ('identity', 'regression', Ridge(alpha=1.0)),
+        'logistic': ('logistic', 'binary', LogisticRegression(max_iter=5000)),
+        'logistic_decision_function': ('logistic', 'binary', LinearSVC(max_iter=20000)),
+        'softmax': ('softmax', 'multiclass', LogisticRegression(max_iter=5000)),
+        'ovr': ('ovr', 'multiclass', LinearSVC(max_iter=20000)),
+    }
+
+
+# Main functions
+def run_parity_checks(rows: int=2000, atol: float=1e-6, seed: int=0) -> List[Dict]:
+    """
+    This function exports a model of every (scaler, estimator) case and compares the kernel loaded back with the
+    model on held out data.
+
+    Returns:
+    - The parity report of every case, with its expected and exported link.
+    """
+    from sklearn.base import clone
+    from sklearn.impute import SimpleImputer
+    from sklearn.pipeline import Pipeline
+
+    train, test = synthetic_data(rows, seed=seed), synthetic_data(rows // 2, seed=seed + 1)
+    work_dir = tempfile.mkdtemp(prefix='linear-export-parity-')
+    reports = []
+    try:
+        for scaler_name, scaler in scalers().items():
+            for estimator_name, (link, target, estimator) in estimators().items():
+                model = Pipeline([('imputer', SimpleImputer()), ('scaler', clone(scaler) if scaler != 'passthrough' else scaler), ('estimator', clone(estimator))])
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    model.fit(train['X'], train[target])
+                version = f'{scaler_name}-{estimator_name}'
+                export = export_linear_model(model, work_dir, 'parity', version, test_mode=True)
+                scorer = LinearScorer.load(export['uri'])
+                report = {'case': version, 'expected_link': link, 'link': scorer.link, **check_linear_parity(model, scorer, test['X'], atol)}
+                report['passed'] = report['passed'] and scorer.link == link
+                reports.append(report)
+                print(report)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', help='Training rows of every case, half of them are scored. Default: 2000.', type=int, default=2000)
+    parser.add_argument('--atol', help='Max absolute difference allowed. Default: 1e-6.', type=float, default=1e-6)
+    parser.add_argument('--seed', help='Random seed. Default: 0.', type=int, default=0)
+    args = parser.parse_args()
+
+    reports = run_parity_checks(args.rows, args.atol, args.seed)
+    failed = [report['case'] for report in reports if not report['passed']]
+    print(f'{len(reports) - len(failed)}/{len(reports)} cases passed' + (f', failed: {failed}' if failed else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,279 @@
+"""
+Measures how the stage functions of the component scale with the size of their inputs: every stage runs with
+test_mode=True on synthetic inputs of increasing rows and columns, and its wall time and peak memory are recorded by
+size. A power law time = a * rows^b * columns^c (and the same for the memory) is fitted to the measures, so a stage
+that turns quadratic shows up in its exponents before it shows up in production.
+
+The measures are compared with the baselines file: a size whose time or memory falls outside the tolerance band of
+its baseline, or an exponent that moves more than the exponent tolerance, fails the run (exit code 1). The baselines
+are written by the first run of a stage or with --update_baselines, e.g. after an intended change of the stage.
+
+The same benchmark is in the tests directory of every component, with the stages of that component (STAGES).
+
+Usage: python tests/stage_scaling_benchmark.py [--stages model_training] [--rows 1000,10000,100000] [--columns 8,32] [--update_baselines]
+"""
+import os
+import re
+import ast
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+import numpy as np
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, COMPONENT_DIR)
+
+from src.stage_data import StageData
+
+
+# Auxiliar functions
+def synthetic_table(rows: int, columns: int, seed: int=0, label: bool=False) -> Dict:
+    """
+    Returns the columns of a synthetic dataset: an 'id', 'columns' float features ('feature_<i>', 1% missing) and,
+    if 'label' is True, a binary 'label' that depends on the features.
+    """
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((rows, columns))
+    data = {'id': np.arange(rows, dtype=np.int64)}
+    for position in range(columns):
+        feature = features[:, position].copy()
+        feature[rng.random(rows) < 0.01] = np.nan
+        data[f'feature_{position}'] = feature
+    if label:
+        data['label'] = (np.nan_to_num(features) @ rng.standard_normal(columns) > 0).astype(np.int64)
+    return data
+
+
+def load_stage_function(notebook_path: str, function_name: str) -> Callable:
+    """
+    Returns a stage function of a notebook: the tagged cell that defines it is executed, with the component directory
+    in sys.path, as the notebook does.
+    """
+    with open(notebook_path) as notebook_file:
+        cells = json.load(notebook_file)['cells']
+    for index, cell in enumerate(cells):
+        source = ''.join(cell['source'])
+        if cell['cell_type'] != 'code' or not re.match(r"#\s*(.+?)\s*\(DON'T REMOVE THIS COMMENT\)", source.replace('\xa0', ' ')):
+            continue
+        try:
+            names = {node.name for node in ast.parse(source).body if isinstance(node, ast.FunctionDef)}
+        except SyntaxError:  # the step-execution cells have template placeholders
+            continue
+        if function_name in names:
+            namespace = {'__name__': f'stage_scaling_{function_name}', '__file__': notebook_path}
+            exec(compile(source, f'{notebook_path} (cell {index})', 'exec'), namespace)
+            return namespace[function_name]
+    raise ValueError(f'There is no function {function_name} in the tagged cells of {notebook_path}')
+
+
+def output_rows(output) -> int:
+    """Returns the rows of the datasets returned by a stage, or of the (ids, embeddings) batches it yields."""
+    if isinstance(output, StageData):
+        return sum(table.num_rows for table in output)
+    if isinstance(output, (tuple, list)):
+        return sum(output_rows(item) for item in output)
+    return 0
+
+
+def run_stage(function: Callable, kwargs: Dict) -> int:
+    """Runs a stage and consumes its output if it is a stream of batches. Returns the rows of the output."""
+    output = function(**kwargs)
+    if hasattr(output, '__next__'):
+        return sum(len(batch[0]) for batch in output)
+    return output_rows(output)
+
+
+def _arrow_allocated_bytes() -> int:
+    try:
+        import pyarrow as pa
+        return pa.total_allocated_bytes()
+    except ImportError:
+        return 0
+
+
+def measure_stage(function: Callable, kwargs: Dict, repeats: int=3) -> Dict:
+    """
+    Returns the wall time of a stage (the best of 'repeats' runs) and its peak memory: the peak of the Python and
+    NumPy allocations traced by tracemalloc during a separate run, as tracing slows the stage down, plus the Arrow
+    memory still allocated at its end (Arrow allocates outside tracemalloc).
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = run_stage(function, kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    arrow_start = _arrow_allocated_bytes()
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        traced_start, _ = tracemalloc.get_traced_memory()
+        run_stage(function, kwargs)
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    return {
+        'seconds': round(min(seconds), 6),
+        'peak_memory_bytes': max(traced_peak - traced_start, 0) + max(_arrow_allocated_bytes() - arrow_start, 0),
+        'output_rows': rows,
+    }
+
+
+def fit_scaling_curve(measures: List[Dict], metric: str) -> Dict:
+    """
+    Fits log(metric) = log(a) + b * log(rows) + c * log(columns) by least squares. The exponent of a dimension with
+    a single size is None, as it can't be fitted.
+    """
+    points = [measure for measure in measures if measure[metric] > 0]
+    dimensions = [dimension for dimension in ('rows', 'columns') if len({measure[dimension] for measure in points}) > 1]
+    curve = {'coefficient': None, 'rows_exponent': None, 'columns_exponent': None}
+    if not dimensions:
+        return curve
+    X = np.column_stack([np.ones(len(points))] + [np.log([measure[dimension] for measure in points]) for dimension in dimensions])
+    y = np.log([measure[metric] for measure in points])
+    solution, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    curve['coefficient'] = float(np.exp(solution[0]))
+    for dimension, exponent in zip(dimensions, solution[1:]):
+        curve[f'{dimension}_exponent'] = round(float(exponent), 3)
+    return curve
+
+
+def compare_with_baseline(
+    result: Dict,
+    baseline: Dict,
+    time_tolerance: float,
+    memory_tolerance: float,
+    exponent_tolerance: float,
+    min_seconds: float,
+    min_memory_bytes: int,
+) -> List[str]:
+    """
+    Returns the violations of the tolerance band of the baseline of a stage. A size is out of the band if its metric
+    is not within baseline * (1 +- tolerance) +- an absolute floor (min_seconds or min_memory_bytes), that absorbs
+    the noise of the small sizes. Both sides fail: a stage that got much faster may have stopped doing its work.
+    The exponents are only compared if the largest baseline measure is at least 10 times its floor.
+    """
+    violations = []
+    baseline_sizes = {measure['size']: measure for measure in baseline['measures']}
+    for measure in result['measures']:
+        expected = baseline_sizes.get(measure['size'])
+        if expected is None:
+            continue
+        for metric, tolerance, floor in (('seconds', time_tolerance, min_seconds), ('peak_memory_bytes', memory_tolerance, min_memory_bytes)):
+            low, high = expected[metric] * (1 - tolerance) - floor, expected[metric] * (1 + tolerance) + floor
+            if not low <= measure[metric] <= high:
+                violations.append(f"{measure['size']} {metric}: {measure[metric]} is outside [{max(low, 0):.6g}, {high:.6g}]")
+    for metric, floor in (('seconds', min_seconds), ('peak_memory_bytes', min_memory_bytes)):
+        # The exponents fitted to measures within the noise floor are noise too
+        if max(measure[metric] for measure in baseline['measures']) < 10 * floor:
+            continue
+        for dimension in ('rows', 'columns'):
+            exponent, expected = result['curves'][metric][f'{dimension}_exponent'], baseline['curves'][metric][f'{dimension}_exponent']
+            if exponent is not None and expected is not None and abs(exponent - expected) > exponent_tolerance:
+                violations.append(f'{metric} {dimension} exponent: {exponent} differs from {expected} by more than {exponent_tolerance}')
+    return violations
+
+
+# Stages of the component: the notebook of the stage and a function that returns its arguments for a size
+NOTEBOOK_PATH = os.path.join(COMPONENT_DIR, 'training.ipynb')
+STAGES = {
+    'model_training': {
+        'notebook_path': NOTEBOOK_PATH,
+        'kwargs': lambda rows, columns: {
+            'feature_data': StageData(synthetic_table(rows, columns, label=True)),
+            'model_name': 'benchmark',
+            'hyperparameters': {},
+            'is_saved': False,
+            'use_gpu': False,
+        },
+    },
+}
+STAGE_KWARGS = {'project_id': 'benchmark', 'version': 'benchmark', 'test_mode': True}
+
+
+# Main functions
+def run_benchmark(stage_name: str, rows_options: List[int], columns_options: List[int], repeats: int=3) -> Dict:
+    """
+    This function runs a stage of STAGES with test_mode=True on synthetic inputs of every combination of rows and
+    columns, and fits the scaling curves of its time and peak memory.
+
+    Returns:
+    - A report with the measures by size and the fitted curves.
+    """
+    stage = STAGES[stage_name]
+    function = load_stage_function(stage['notebook_path'], stage_name)
+    measures = []
+    for columns in columns_options:
+        for rows in rows_options:
+            kwargs = {**STAGE_KWARGS, **stage['kwargs'](rows, columns)}
+            measure = {'size': f'{rows}x{columns}', 'rows': rows, 'columns': columns, **measure_stage(function, kwargs, repeats)}
+            measures.append(measure)
+            print(stage_name, measure)
+    return {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'repeats': repeats,
+        'measures': measures,
+        'curves': {metric: fit_scaling_curve(measures, metric) for metric in ('seconds', 'peak_memory_bytes')},
+    }
+
+
+def check_baselines(reports: Dict, baselines_path: str, update: bool=False, **tolerances) -> List[str]:
+    """
+    Compares the report of every stage with its baseline and returns the violations. The stages without a baseline
+    (or all of them if 'update' is True) are written as the new baselines.
+    """
+    baselines = {}
+    if os.path.exists(baselines_path):
+        with open(baselines_path) as baselines_file:
+            baselines = json.load(baselines_file)
+    violations = []
+    for stage_name, report in reports.items():
+        if update or stage_name not in baselines:
+            baselines[stage_name] = report
+            print(f'Baseline of {stage_name} written to {baselines_path}')
+        else:
+            violations += [f'{stage_name} {violation}' for violation in compare_with_baseline(report, baselines[stage_name], **tolerances)]
+    with open(baselines_path, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent=2)
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', help=f'Comma separated stages to run. Default: {",".join(STAGES)}.', type=str, default=','.join(STAGES))
+    parser.add_argument('--rows', help='Comma separated rows of the synthetic inputs. Default: 1000,10000,100000.', type=str, default='1000,10000,100000')
+    parser.add_argument('--columns', help='Comma separated feature columns of the synthetic inputs. Default: 8,32.', type=str, default='8,32')
+    parser.add_argument('--repeats', help='Timed runs by size, the best one is kept. Default: 3.', type=int, default=3)
+    parser.add_argument('--baselines_path', help='JSON baselines by stage. Default: tests/stage_scaling_baselines.json.', type=str, default=os.path.join(COMPONENT_DIR, 'tests', 'stage_scaling_baselines.json'))
+    parser.add_argument('--update_baselines', help='Write the measures as the new baselines instead of comparing them.', action='store_true')
+    parser.add_argument('--time_tolerance', help='Relative tolerance of the time by size. Default: 0.5.', type=float, default=0.5)
+    parser.add_argument('--memory_tolerance', help='Relative tolerance of the peak memory by size. Default: 0.25.', type=float, default=0.25)
+    parser.add_argument('--exponent_tolerance', help='Absolute tolerance of the exponents of the curves. Default: 0.25.', type=float, default=0.25)
+    parser.add_argument('--min_seconds', help='Absolute tolerance of the time, for the small sizes. Default: 0.005.', type=float, default=0.005)
+    parser.add_argument('--min_memory_bytes', help='Absolute tolerance of the peak memory. Default: 1048576.', type=int, default=1 << 20)
+    args = parser.parse_args()
+
+    rows_options = [int(value) for value in args.rows.split(',')]
+    columns_options = [int(value) for value in args.columns.split(',')]
+    reports = {stage_name: run_benchmark(stage_name, rows_options, columns_options, args.repeats) for stage_name in args.stages.split(',')}
+    violations = check_baselines(
+        reports,
+        args.baselines_path,
+        update=args.update_baselines,
+        time_tolerance=args.time_tolerance,
+        memory_tolerance=args.memory_tolerance,
+        exponent_tolerance=args.exponent_tolerance,
+        min_seconds=args.min_seconds,
+        min_memory_bytes=args.min_memory_bytes,
+    )
+    for violation in violations:
+        print(f'FAIL {violation}')
+    sys.exit(1 if violations else 0)